@@ -1627,7 +1627,7 @@ class Amcam:
     def put_ColorMatrix(self, v):
         if len(v) == 9:
             a = (ctypes.c_double * 9)(v[0], v[1], v[2], v[3], v[4], v[5], v[6], v[7], v[8])
-            return self.__lib.Amcam_put_ColorMatrix(self.__h, v)
+            return self.__lib.Amcam_put_ColorMatrix(self.__h, a)
         else:
             raise HRESULTException(0x80070057)
 
@@ -0,0 +1,257 @@
+import os, sys, time, queue, hashlib, threading, argparse
+import yaml
+
+ARCHIVE_MANIFEST_SUFFIX = "_archive.yaml"
+PART_SUFFIX = ".part"
+
+
+class Throttle:
+    def __init__(self, bytes_per_second: float = None) -> None:
+        """
+        @brief  Limits the rate data is read or written at by sleeping once ahead of it.
+        @param bytes_per_second Largest average rate, or None for no limit.
+        """
+        self.bytes_per_second = bytes_per_second
+        self._started = time.time()
+        self._bytes = 0
+
+    def consume(self, count: int) -> None:
+        """
+        @brief  Accounts for count bytes, sleeping if they came in faster than the limit.
+        """
+        if not self.bytes_per_second: return
+        self._bytes += count
+        ahead = self._bytes / self.bytes_per_second - (time.time() - self._started)
+        if ahead > 0: time.sleep(ahead)
+
+
+def copy_file(source: str, destination: str, throttle: Throttle = None,
+              chunk_size: int = 1 << 20) -> str:
+    """
+    @brief  Copies a file with chunked reads, hashing it on the way, so it is read only once and
+            never fully loaded. The copy is written next to destination and renamed into place by
+            the caller once it is verified.
+    @param source       File to copy.
+    @param destination  Path of the copy. Its folder must exist.
+    @param throttle     Optional Throttle to limit the bandwidth.
+    @param chunk_size   Bytes read at a time.
+    @return SHA-256 hex digest of the source.
+    """
+    digest = hashlib.sha256()
+    with open(source, "rb") as reader, open(destination, "wb") as writer:
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            digest.update(chunk)
+            writer.write(chunk)
+            if throttle is not None: throttle.consume(len(chunk))
+        writer.flush()
+        os.fsync(writer.fileno())
+    return digest.hexdigest()
+
+
+def hash_file(path: str, throttle: Throttle = None, chunk_size: int = 1 << 20,
+              uncached: bool = False) -> str:
+    """
+    @brief  Hashes a file with chunked reads.
+    @param path         File to hash.
+    @param throttle     Optional Throttle to limit the bandwidth.
+    @param chunk_size   Bytes read at a time.
+    @param uncached     Drop the file from the page cache first where the system allows it, so a
+                        freshly written copy is read back from the disk rather than from memory.
+    @return SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        if uncached and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(stream.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+            if throttle is not None: throttle.consume(len(chunk))
+    return digest.hexdigest()
+
+
+def archive_folder(folder: str, archive_dir: str, bandwidth_mb_s: float = None,
+                   retries: int = 1, progress=None) -> dict:
+    """
+    @brief  Copies a core folder into archive_dir/<folder name>, checks every copy against the
+            original's checksum by reading it back, and writes <folder name>_archive.yaml in the
+            copied folder listing each file with its size and checksum. Each file is copied under
+            a temporary name and only renamed once verified, so a file with its final name in the
+            archive is always complete.
+    @param folder           Core folder to copy.
+    @param archive_dir      Archive location, e.g. a mounted network share.
+    @param bandwidth_mb_s   Largest average transfer rate in MB/s, or None for no limit.
+    @param retries          Times a file that fails verification is copied again.
+    @param progress         Optional function called with (done, total) after each file.
+    @return The manifest: source and destination, the 'files' and the 'failed' ones.
+    """
+    folder = os.path.abspath(folder)
+    name = os.path.basename(folder)
+    destination = os.path.join(archive_dir, name)
+    manifest_name = f"{name}{ARCHIVE_MANIFEST_SUFFIX}"
+    files = []
+    for root, _, names in os.walk(folder):
+        for file_name in sorted(names):
+            if file_name == manifest_name or file_name.endswith(PART_SUFFIX): continue
+            files.append(os.path.relpath(os.path.join(root, file_name), folder))
+
+    throttle = Throttle(bandwidth_mb_s * 1e6 if bandwidth_mb_s else None)
+    started = time.time()
+    entries, failed = [], []
+    for done, relative in enumerate(sorted(files)):
+        source = os.path.join(folder, relative)
+        target = os.path.join(destination, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        entry = {'file': relative.replace(os.sep, '/'), 'bytes': os.path.getsize(source)}
+        for attempt in range(retries + 1):
+            try:
+                checksum = copy_file(source, target + PART_SUFFIX, throttle)
+                copied = hash_file(target + PART_SUFFIX, throttle, uncached=True)
+            except OSError as e:
+                print(f"Could not archive {source}: {e}")
+                checksum, copied = None, None
+                break
+            if copied == checksum:
+                os.replace(target + PART_SUFFIX, target)
+                break
+            print(f"Archived copy of {source} does not match, " +
+                  ("copying again" if attempt < retries else "giving up"))
+        entry['sha256'] = checksum
+        entry['verified'] = checksum is not None and copied == checksum
+        if not entry['verified']:
+            failed.append(entry['file'])
+            if os.path.exists(target + PART_SUFFIX): os.remove(target + PART_SUFFIX)
+        entries.append(entry)
+        if progress is not None: progress(done + 1, len(files))
+
+    manifest = {
+        'source': folder,
+        'destination': os.path.abspath(destination),
+        'archived': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+        'seconds': round(time.time() - started, 2),
+        'bytes': sum(entry['bytes'] for entry in entries),
+        'failed': failed,
+        'files': entries,
+    }
+    os.makedirs(destination, exist_ok=True)
+    with open(os.path.join(destination, manifest_name), "w") as stream:
+        yaml.safe_dump(manifest, stream, sort_keys=False)
+    return manifest
+
+
+def verify_archive(path: str) -> list:
+    """
+    @brief  Checks an archived folder against its manifest again, e.g. before deleting the
+            originals.
+    @param path Archived folder.
+    @return List of the files that are missing or do not match their checksum.
+    """
+    name = os.path.basename(os.path.abspath(path))
+    with open(os.path.join(path, f"{name}{ARCHIVE_MANIFEST_SUFFIX}"), "r") as stream:
+        manifest = yaml.safe_load(stream)
+    bad = []
+    for entry in manifest['files']:
+        target = os.path.join(path, *entry['file'].split('/'))
+        if not os.path.exists(target) or hash_file(target) != entry['sha256']: bad.append(entry['file'])
+    return bad
+
+
+class Archiver:
+    def __init__(self, archive_dir: str = None, bandwidth_mb_s: float = None) -> None:
+        """
+        @brief  Archives finished core folders on a background thread, one at a time, so the next
+                core can be captured meanwhile. The thread lowers its own scheduling priority where
+                the system allows it, and the bandwidth limit keeps it from saturating the disk or
+                network the capture writes to. See archive_folder.
+        @param archive_dir      Archive location, or None to archive nothing.
+        @param bandwidth_mb_s   Largest average transfer rate in MB/s, or None for no limit.
+        """
+        self.archive_dir = archive_dir
+        self.bandwidth_mb_s = bandwidth_mb_s
+        self._folders = queue.Queue()
+        self._thread = None
+        self._current = None
+        self._results = []
+        self.listeners = []  # Called with each manifest once its folder is archived, from the thread
+
+    def add(self, folder: str) -> None:
+        """
+        @brief  Queues a core folder to be archived. Returns immediately.
+        @param folder   Finished core folder.
+        """
+        if not self.archive_dir: return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._archive_folders, daemon=True)
+            self._thread.start()
+        self._folders.put((folder, self.archive_dir, self.bandwidth_mb_s))
+
+    def wait(self) -> None:
+        """
+        @brief  Blocks until every queued folder is archived.
+        """
+        self._folders.join()
+
+    def pending(self) -> int:
+        """
+        @brief  Gets the number of folders queued or being archived.
+        """
+        return self._folders.unfinished_tasks
+
+    def get_status(self) -> str:
+        """
+        @brief  Gets a line describing what is being archived.
+        """
+        return self._current if self._current is not None else "Nothing to archive."
+
+    def take_results(self) -> list:
+        """
+        @brief  Gets the manifests of the folders archived since the last call.
+        """
+        results, self._results = self._results, []
+        return results
+
+    def _archive_folders(self) -> None:
+        if hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+            except OSError:
+                pass
+        while True:
+            folder, archive_dir, bandwidth_mb_s = self._folders.get()
+            name = os.path.basename(os.path.abspath(folder))
+            try:
+                self._current = f"Archiving {name}..."
+                def progress(done, total): self._current = f"Archiving {name}: {done} / {total} files"
+                manifest = archive_folder(folder, archive_dir, bandwidth_mb_s, progress=progress)
+                if manifest['failed']:
+                    print(f"{len(manifest['failed'])} file(s) of {name} could not be archived")
+                self._results.append(manifest)
+                for listener in self.listeners: listener(manifest)
+            except Exception as e:
+                print(f"Archiving {folder} failed: {e}")
+            finally:
+                self._current = None
+                self._folders.task_done()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Copy core folders to an archive with verified "
+                                                 "checksums, or check an archived folder again.")
+    parser.add_argument('folders', nargs='+', help="Core folders to archive (or archived folders with --verify)")
+    parser.add_argument('--archive', default=None, help="Archive location")
+    parser.add_argument('--bandwidth', type=float, default=None, help="Largest transfer rate (MB/s)")
+    parser.add_argument('--verify', action='store_true', help="Check archived folders against their manifests")
+    args = parser.parse_args()
+
+    status = 0
+    for folder in args.folders:
+        if args.verify:
+            bad = verify_archive(folder)
+            print(f"{folder}: " + (f"{len(bad)} bad file(s): {', '.join(bad)}" if bad else "OK"))
+        else:
+            if args.archive is None: parser.error("--archive is needed to archive folders")
+            manifest = archive_folder(folder, args.archive, args.bandwidth)
+            bad = manifest['failed']
+            print(f"{folder}: {len(manifest['files'])} file(s), {manifest['bytes'] / 1e6:.1f} MB "
+                  f"in {manifest['seconds']} s" + (f", {len(bad)} failed" if bad else ""))
+        if bad: status = 1
+    sys.exit(status)
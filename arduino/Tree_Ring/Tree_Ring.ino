@@ -4,17 +4,91 @@ int STEPPER_PIN = 4;
 int LIMIT_SWITCH_PIN = 10;
 int ENABLE_PIN = 9;
 int RESET_PIN = 5;
+int TRIGGER_PIN = 6; // Wired to the camera's trigger input.
 
 int incoming_byte;
 
+// Numbers sent after a command (e.g. the 8000 in "V8000\n") are collected a byte at a time as they
+// arrive, so loop() never waits on the serial port and keeps working out next_ticks during moves.
+const int ARGUMENT_SIZE = 48;
+const unsigned long ARGUMENT_TIMEOUT = 1000; // ms without a byte after which the numbers are taken as complete.
+int pending_command = 0; // Command waiting for its numbers, 0 for none.
+char argument[ARGUMENT_SIZE];
+int argument_length = 0;
+unsigned long argument_since = 0;
+
 bool IS_CLOCKWISE = true;
 bool IS_ACTIVE = false;
 
-int active_counter = 0;
+// The driver is put to sleep once the motor has been idle for idle_timeout ms, unless the host
+// asked for it to be held enabled (e.g. for a whole run).
+unsigned long idle_timeout = 100;
+unsigned long last_busy = 0;
+bool IS_HOLDING = false;
 int rotate_amount = 161;//1600; //steps per revolution for 200 pulses = 360 degree full cycle rotation
 int millimeters = 30;
 int original_millimeters = millimeters;
-int actual_movement = rotate_amount * millimeters;
+long actual_movement = (long)rotate_amount * millimeters;
+
+// Trapezoidal motion profile, settable from the host (see motion.py for the matching model).
+long start_speed = 1000;   // steps/s the motor can start and stop at without stalling.
+long cruise_speed = 8000;  // steps/s once accelerated.
+long acceleration = 20000; // steps/s^2 while speeding up and slowing down.
+
+// The move in progress. Steps are generated by the Timer1 interrupt so loop() keeps serving
+// serial commands while the motor turns.
+volatile bool IS_MOVING = false;
+volatile bool step_high = false;
+volatile long position = 0;       // Absolute position in steps, anticlockwise counts up.
+volatile long steps_done = 0;
+volatile long move_steps = 0;
+volatile int move_direction = 1;
+volatile unsigned int next_ticks = 0; // Half-period of the next step, worked out ahead by loop().
+volatile bool need_next_ticks = false;
+volatile int stop_on_switch = -1; // Limit switch level that ends the move early, -1 to ignore the switch.
+long move_ramp_steps = 0;
+float move_start_squared = 0;
+float move_acceleration = 0;
+
+// Moves sent while another move is running wait here.
+const int QUEUE_SIZE = 8;
+long queue_steps[QUEUE_SIZE];
+bool queue_clockwise[QUEUE_SIZE];
+int queue_head = 0;
+int queue_length = 0;
+long planned_position = 0; // Where the stage ends up once the queue is empty.
+
+// Homing: move clockwise to the limit switch, then back off slowly until it releases. That point
+// is position 0. Both moves run at start_speed without a ramp, so the motor stops on the step that
+// changes the switch instead of slowing down past it.
+const long HOME_MAX_STEPS = 1610000;  // Give up after 1 m of travel.
+const long HOME_BACKOFF_STEPS = 16100; // Give up backing off after 10 mm.
+int home_state = 0; // 0 not homing, 1 looking for the switch, 2 backing off.
+bool IS_HOMED = false;
+
+// Hardware trigger: once the stage stops and has had trigger_delay ms to settle, pulse
+// TRIGGER_PIN so the camera takes the picture without waiting for the host.
+const int TRIGGER_PULSE_US = 500;
+unsigned long trigger_delay = 0; // 0 turns the trigger off.
+unsigned long stopped_at = 0;
+bool trigger_pending = false;
+bool was_moving = false;
+
+// Scan program: the firmware runs a whole capture on its own. At each position it waits for the
+// stage to settle, reports "Q <position index> <position>" (and triggers the camera), waits for
+// the dwell time, then moves on.
+const int PROGRAM_IDLE = 0;
+const int PROGRAM_MOVING = 1;
+const int PROGRAM_SETTLING = 2;
+const int PROGRAM_DWELLING = 3;
+int program_state = PROGRAM_IDLE;
+long program_moves = 0;
+long program_index = 0;
+long program_steps = 0;
+unsigned long program_settle = 0;
+unsigned long program_dwell = 0;
+bool program_trigger = false;
+unsigned long program_since = 0;
 
 void setup()
 {
@@ -25,38 +99,440 @@ void setup()
   pinMode(DIRECTION_PIN, OUTPUT);
   pinMode(STEPPER_PIN, OUTPUT);
   pinMode(LIMIT_SWITCH_PIN, INPUT_PULLUP);
+  pinMode(TRIGGER_PIN, OUTPUT);
+  digitalWrite(TRIGGER_PIN, LOW);
   digitalWrite(DIRECTION_PIN, LOW);
   digitalWrite(STEPPER_PIN, LOW);
   activate();
   Serial.begin(9600);
+
+  // Timer1 in CTC mode with a /8 prescaler ticks at 2 MHz. Its interrupt is only enabled
+  // while a move runs.
+  noInterrupts();
+  TCCR1A = 0;
+  TCCR1B = (1 << WGM12) | (1 << CS11);
+  TCNT1 = 0;
+  OCR1A = 1000;
+  interrupts();
+}
+
+
+unsigned int half_period_ticks(long i)
+{
+  /*
+	@brief   Timer ticks (0.5 us) of each half of step i's pulse. The speed comes from the
+           distance to the nearest end of the move, so the motor speeds up from start_speed to
+           cruise_speed and slows down again before it stops.
+  @param i   Index of the step in the move.
+  */
+  long n = min(min(i, move_steps - 1 - i), move_ramp_steps);
+  return 1000000.0 / sqrt(move_start_squared + move_acceleration * n);
+}
+
+
+long stopping_steps()
+{
+  /*
+	@brief   Steps the motor needs to slow down from the current step to a stop.
+  */
+  return min(min(steps_done, move_steps - 1 - steps_done), move_ramp_steps);
 }
 
 
-void step(boolean dir,int steps)
+ISR(TIMER1_COMPA_vect)
+{
+  /*
+	@brief   Timer1 interrupt. Toggles the step pin, counting a step on each falling edge. The
+           square root for the next step's speed is too slow for an interrupt at cruise speed,
+           so loop() computes it ahead of time; if loop() is late the speed holds.
+  */
+  if(!step_high) {
+    digitalWrite(STEPPER_PIN, HIGH);
+    step_high = true;
+    return;
+  }
+  digitalWrite(STEPPER_PIN, LOW);
+  step_high = false;
+  position += move_direction;
+  steps_done++;
+  if(stop_on_switch >= 0 && digitalRead(LIMIT_SWITCH_PIN) == stop_on_switch) {
+    // Slow down to a stop, like stop_moving().
+    stop_on_switch = -1;
+    move_steps = min(move_steps, steps_done + stopping_steps());
+  }
+  if(steps_done >= move_steps) {
+    TIMSK1 &= ~(1 << OCIE1A);
+    IS_MOVING = false;
+    return;
+  }
+  OCR1A = next_ticks;
+  need_next_ticks = true;
+}
+
+
+void step(boolean dir, long steps, long top_speed)
  {
   /*
-	@brief   This makes the motor move by a set amount. 
+	@brief   Starts moving the motor by a set amount. Returns straight away; the Timer1
+           interrupt generates the steps.
   @param dir   Direction the Motor Moves.
-  @param stepts   Steps for the motor to turn. Minimum number of steps is 600, add more to go slower.
+  @param steps   Steps for the motor to turn.
+  @param top_speed   Speed (steps/s) to accelerate to, e.g. cruise_speed.
   */
-
+ if(steps <= 0) return;
+ activate();
  digitalWrite(DIRECTION_PIN,dir);
 
- for(int i=0;i<steps;i++)
- {
-   digitalWrite(STEPPER_PIN, HIGH);
-   delayMicroseconds(150);//Adjust the speed of motor. Increase the value, motor speed become slower.
-   digitalWrite(STEPPER_PIN, LOW);
-   delayMicroseconds(150);
+ // Steps needed to reach cruise speed, from v^2 = v0^2 + 2an.
+ move_start_squared = (float)start_speed * start_speed;
+ move_acceleration = 2.0 * acceleration;
+ move_ramp_steps = 0;
+ if(top_speed > start_speed) {
+   move_ramp_steps = ((float)top_speed * top_speed - move_start_squared) / move_acceleration;
  }
+
+ noInterrupts();
+ move_direction = dir ? -1 : 1;
+ move_steps = steps;
+ steps_done = 0;
+ step_high = false;
+ OCR1A = half_period_ticks(0);
+ next_ticks = half_period_ticks(1);
+ need_next_ticks = false;
+ TCNT1 = 0;
+ IS_MOVING = true;
+ TIMSK1 |= (1 << OCIE1A);
+ interrupts();
+}
+
+
+void queue_move(boolean dir, long steps)
+{
+  /*
+	@brief   Adds a move to the queue. It starts as soon as the moves before it finish.
+  @param dir   Direction the Motor Moves.
+  @param steps   Steps for the motor to turn.
+  */
+  if(queue_length == QUEUE_SIZE) {
+    Serial.println("E queue full");
+    return;
+  }
+  int slot = (queue_head + queue_length) % QUEUE_SIZE;
+  queue_steps[slot] = steps;
+  queue_clockwise[slot] = dir;
+  queue_length++;
+  planned_position += dir ? -steps : steps;
+}
+
+
+void queue_move_to(long target)
+{
+  /*
+	@brief   Queues a move to an absolute position, counted from where the moves already queued
+           end.
+  @param target   Position in steps.
+  */
+  long distance = target - planned_position;
+  if(distance != 0) queue_move(distance < 0, abs(distance));
+}
+
+
+void start_next_move()
+{
+  /*
+	@brief   Starts the next queued move if the motor is free.
+  */
+  if(IS_MOVING || queue_length == 0 || home_state != 0) return;
+  step(queue_clockwise[queue_head], queue_steps[queue_head], cruise_speed);
+  queue_head = (queue_head + 1) % QUEUE_SIZE;
+  queue_length--;
+}
+
+
+void update_next_ticks()
+{
+  /*
+	@brief   Works out the half-period of the step after the one in progress.
+  */
+  if(!need_next_ticks) return;
+  noInterrupts();
+  long next_step = steps_done + 1;
+  need_next_ticks = false;
+  interrupts();
+  unsigned int ticks = half_period_ticks(next_step);
+  noInterrupts();
+  next_ticks = ticks;
+  interrupts();
+}
+
+
+void stop_moving()
+{
+  /*
+	@brief   Drops the queued moves and ends the current one as quickly as the motor can slow
+           down without missing steps.
+  */
+  queue_length = 0;
+  if(home_state != 0) {
+    home_state = 0;
+    Serial.println("E home stopped");
+  }
+  if(program_state != PROGRAM_IDLE) {
+    program_state = PROGRAM_IDLE;
+    Serial.println("Q stopped");
+  }
+  noInterrupts();
+  stop_on_switch = -1;
+  if(IS_MOVING) {
+    move_steps = steps_done + stopping_steps() + 1;
+    need_next_ticks = true;
+  }
+  planned_position = position + (IS_MOVING ? (move_steps - steps_done) * move_direction : 0);
+  interrupts();
+}
+
+
+void start_homing()
+{
+  /*
+	@brief   Starts looking for the limit switch. The motor must be stopped.
+  */
+  if(IS_MOVING) {
+    Serial.println("E busy");
+    return;
+  }
+  queue_length = 0;
+  home_state = 1;
+  stop_on_switch = LOW;
+  step(true, HOME_MAX_STEPS, start_speed);
+}
+
+
+void update_homing()
+{
+  /*
+	@brief   Moves homing on once each of its moves ends. Replies "Z <offset>" when homed, where
+           offset is the old position of the new position 0, or "E home failed".
+  */
+  if(home_state == 0 || IS_MOVING) return;
+  if(home_state == 1) {
+    if(digitalRead(LIMIT_SWITCH_PIN) == LOW) {
+      // Back off at start speed so the switch releases at a repeatable point.
+      home_state = 2;
+      stop_on_switch = HIGH;
+      step(false, HOME_BACKOFF_STEPS, start_speed);
+      return;
+    }
+  }
+  else if(digitalRead(LIMIT_SWITCH_PIN) == HIGH) {
+    home_state = 0;
+    noInterrupts();
+    long offset = position;
+    position = 0;
+    interrupts();
+    planned_position = 0;
+    IS_HOMED = true;
+    was_moving = false; // Homing does not trigger the camera.
+    Serial.print("Z ");
+    Serial.println(offset);
+    return;
+  }
+  home_state = 0;
+  stop_on_switch = -1;
+  planned_position = position;
+  was_moving = false;
+  Serial.println("E home failed");
+}
+
+
+void fire_trigger()
+{
+  /*
+	@brief   Pulses the camera trigger line and replies "T <position>".
+  */
+  trigger_pending = false;
+  digitalWrite(TRIGGER_PIN, HIGH);
+  delayMicroseconds(TRIGGER_PULSE_US);
+  digitalWrite(TRIGGER_PIN, LOW);
+  noInterrupts();
+  long current_position = position;
+  interrupts();
+  Serial.print("T ");
+  Serial.println(current_position);
+}
+
+
+void update_trigger()
+{
+  /*
+	@brief   Fires the trigger once the motor has been stopped for trigger_delay ms. A move that
+           starts in the meantime cancels it.
+  */
+  if(program_state != PROGRAM_IDLE) {
+    // Scan programs trigger the camera themselves.
+    trigger_pending = false;
+    was_moving = false;
+    return;
+  }
+  bool moving = IS_MOVING || queue_length > 0 || home_state != 0;
+  if(moving) {
+    trigger_pending = false;
+  }
+  else if(was_moving) {
+    trigger_pending = trigger_delay > 0;
+    stopped_at = millis();
+  }
+  was_moving = moving;
+  if(trigger_pending && millis() - stopped_at >= trigger_delay) {
+    fire_trigger();
+  }
+}
+
+
+void start_program()
+{
+  /*
+	@brief   Reads "<moves> <steps> <settle ms> <dwell ms> <trigger 0/1>" sent after Q and starts
+           the program at the current position. Negative steps move clockwise.
+  */
+  char *cursor = argument;
+  long moves = strtol(cursor, &cursor, 10);
+  long steps = strtol(cursor, &cursor, 10);
+  long settle = strtol(cursor, &cursor, 10);
+  long dwell = strtol(cursor, &cursor, 10);
+  long trigger = strtol(cursor, &cursor, 10);
+  if(IS_MOVING || queue_length > 0 || home_state != 0 || moves < 0 || steps == 0) {
+    Serial.println("E busy");
+    return;
+  }
+  program_moves = moves;
+  program_index = 0;
+  program_steps = steps;
+  program_settle = max(settle, 0L);
+  program_dwell = max(dwell, 0L);
+  program_trigger = trigger != 0;
+  program_state = PROGRAM_SETTLING;
+  program_since = millis();
+}
+
+
+void update_program()
+{
+  /*
+	@brief   Moves the scan program on: settle, report (and trigger), dwell, move.
+  */
+  if(program_state == PROGRAM_IDLE) return;
+  unsigned long now = millis();
+  if(program_state == PROGRAM_MOVING) {
+    if(IS_MOVING || queue_length > 0) return;
+    program_state = PROGRAM_SETTLING;
+    program_since = now;
+  }
+  else if(program_state == PROGRAM_SETTLING && now - program_since >= program_settle) {
+    if(program_trigger) {
+      digitalWrite(TRIGGER_PIN, HIGH);
+      delayMicroseconds(TRIGGER_PULSE_US);
+      digitalWrite(TRIGGER_PIN, LOW);
+    }
+    noInterrupts();
+    long current_position = position;
+    interrupts();
+    Serial.print("Q ");
+    Serial.print(program_index);
+    Serial.print(' ');
+    Serial.println(current_position);
+    program_state = PROGRAM_DWELLING;
+    program_since = now;
+  }
+  else if(program_state == PROGRAM_DWELLING && now - program_since >= program_dwell) {
+    if(program_index == program_moves) {
+      program_state = PROGRAM_IDLE;
+      Serial.println("Q done");
+      return;
+    }
+    program_index++;
+    queue_move(program_steps < 0, abs(program_steps));
+    program_state = PROGRAM_MOVING;
+  }
+}
+
+
+void report_status()
+{
+  /*
+	@brief   Replies "S <moving> <position> <steps left in this move> <queued moves> <homed>".
+  */
+  noInterrupts();
+  bool moving = IS_MOVING || home_state != 0 || program_state != PROGRAM_IDLE;
+  long current_position = position;
+  long remaining = move_steps - steps_done;
+  interrupts();
+  Serial.print("S ");
+  Serial.print(moving ? 1 : 0);
+  Serial.print(' ');
+  Serial.print(current_position);
+  Serial.print(' ');
+  Serial.print(moving ? remaining : 0);
+  Serial.print(' ');
+  Serial.print(queue_length);
+  Serial.print(' ');
+  Serial.println(IS_HOMED ? 1 : 0);
+}
+
+long read_number(long minimum){
+  /* 
+	@brief   Reads the number sent after a command, e.g. the 8000 in "V8000\n".
+  @param minimum   Smallest value accepted.
+  */
+  long value = strtol(argument, NULL, 10);
+  if(value < minimum) value = minimum;
+  return value;
+}
+
+
+bool collect_argument(int byte){
+  /* 
+	@brief   Adds a byte to the numbers of the pending command. A number ends at the first byte
+           that is not part of it, the numbers of a scan program at the end of the line.
+  @param byte   Byte read from the serial port.
+  @return Whether the byte belonged to the numbers.
+  */
+  bool belongs;
+  if(pending_command == 'Q') belongs = byte != '\n' && byte != '\r';
+  else belongs = (byte >= '0' && byte <= '9') || (byte == '-' && argument_length == 0);
+  if(belongs && argument_length < ARGUMENT_SIZE - 1) argument[argument_length++] = byte;
+  argument_since = millis();
+  return belongs;
+}
+
+
+void run_pending_command(){
+  /* 
+	@brief   Runs the pending command once its numbers have arrived.
+  */
+  argument[argument_length] = 0;
+  int command = pending_command;
+  pending_command = 0;
+  argument_length = 0;
+  if(command == 'S') start_speed = read_number(100);
+  if(command == 'V') cruise_speed = read_number(100);
+  if(command == 'A') acceleration = read_number(100);
+  if(command == 'G') queue_move_to(strtol(argument, NULL, 10));
+  if(command == 'T') trigger_delay = read_number(0);
+  if(command == 'I') idle_timeout = read_number(0);
+  if(command == 'K') {
+    IS_HOLDING = read_number(0) != 0;
+    if(IS_HOLDING) activate();
+  }
+  if(command == 'Q') start_program();
 }
 
 void activate(){
   /* 
 	@brief   Wake up the motor driver.
   */
+  last_busy = millis();
   if(!IS_ACTIVE){
-    active_counter = 0;
     digitalWrite(ENABLE_PIN, LOW);
     digitalWrite(RESET_PIN, LOW);
     IS_ACTIVE = true;
@@ -80,41 +556,89 @@ void loop()
   /* 
 	@brief   Update loop.
   */
+  if(pending_command != 0 && millis() - argument_since >= ARGUMENT_TIMEOUT) {
+    run_pending_command();
+  }
   if(Serial.available()) {
     incoming_byte = Serial.read();
+    if(pending_command != 0 && !collect_argument(incoming_byte)) {
+      run_pending_command();
+      if(incoming_byte == '\n' || incoming_byte == '\r') incoming_byte = -1; // Ended the numbers.
+    }
+    else if(pending_command != 0) {
+      incoming_byte = -1; // Part of the numbers.
+    }
     if(incoming_byte == 72) { // H Set platform to rotate clockwise.
-      Serial.write("Clockwise");
+      Serial.println("Clockwise");
       IS_CLOCKWISE = true;
     } 
     if(incoming_byte == 76) { // L Set platform to rotate anticlockwise.
-      Serial.write("AntiClockwise");
+      Serial.println("AntiClockwise");
       IS_CLOCKWISE = false;
     }
     if(incoming_byte == 77) { // M Move the platform.
-      activate();
-      step(IS_CLOCKWISE, actual_movement);
+      queue_move(IS_CLOCKWISE, actual_movement);
     }
     if(incoming_byte == 82) { // R Reset Rotation Amount.
       millimeters = original_millimeters;
-      Serial.write(millimeters);
+      Serial.println(millimeters);
     }
     if(incoming_byte == 43) { // + Increase Rotation Amount.
       millimeters = millimeters + 1;
-      Serial.write(millimeters);
+      Serial.println(millimeters);
     }
     if(incoming_byte == 45) { // - Decrease Rotation amount.
       millimeters = millimeters - 1;
-      Serial.write(millimeters);
+      Serial.println(millimeters);
     }
     if(incoming_byte == 61) { // = Get current Rotation Amount.
-      Serial.write(millimeters);
+      Serial.println(millimeters);
+    }
+    if(incoming_byte == 83 || incoming_byte == 86 || incoming_byte == 65 || incoming_byte == 71 ||
+       incoming_byte == 84 || incoming_byte == 73 || incoming_byte == 75 || incoming_byte == 81) {
+      // S<steps/s> Set start speed. V<steps/s> Set cruise speed. A<steps/s^2> Set acceleration.
+      // G<steps> Move to an absolute position. T<ms> Trigger the camera this long after each move,
+      // 0 for never. I<ms> Set how long the motor may be idle before the driver sleeps.
+      // K<0/1> Hold the driver enabled, e.g. for a whole run.
+      // Q<moves> <steps> <settle ms> <dwell ms> <trigger> Run a scan program.
+      // These run from run_pending_command() once their numbers have arrived.
+      pending_command = incoming_byte;
+      argument_length = 0;
+      argument_since = millis();
+    }
+    if(incoming_byte == 63) { // ? Report status.
+      report_status();
+    }
+    if(incoming_byte == 80) { // P Report position.
+      noInterrupts();
+      long current_position = position;
+      interrupts();
+      Serial.print("P ");
+      Serial.println(current_position);
+    }
+    if(incoming_byte == 88) { // X Stop moving and clear the queue.
+      stop_moving();
     }
-    actual_movement = rotate_amount * millimeters;
+    if(incoming_byte == 90) { // Z Home to the limit switch.
+      start_homing();
+    }
+    if(incoming_byte == 70) { // F Trigger the camera now.
+      fire_trigger();
+    }
+    actual_movement = (long)rotate_amount * millimeters;
   }
 
+  update_next_ticks();
+  update_homing();
+  update_program();
+  start_next_move();
+  update_trigger();
+
   // Put motor to sleep if not in use.
-  active_counter++;
-  if(active_counter == 6000) {
+  if(IS_HOLDING || IS_MOVING || queue_length > 0 || home_state != 0 || program_state != PROGRAM_IDLE) {
+    last_busy = millis();
+  }
+  else if(IS_ACTIVE && millis() - last_busy >= idle_timeout) {
     deactivate();
   }
 }
\ No newline at end of file
@@ -1,34 +1,67 @@
 from camera import Camera, CriticalIOError
-from PyQt5.QtWidgets import QMessageBox, QWidget
+from job_queue import JobQueue, CoreJob, RUNNING, DONE, STOPPED, write_manifest, timing_summary
+from journal import CaptureJournal, read_journal, resume_point, file_checksum, captured_images
+from session_container import SessionContainer, CONTAINER_SUFFIX, register_container, frame_exists
+from settle import SettleDetector
+from motion import MotionProfile, STEPS_PER_TENTH_MM, HOME_MAX_STEPS, HOME_BACKOFF_STEPS
+from stitching import LivePanorama
+from thumbnails import ThumbnailWriter
+from quality import QualityChecker
+from archive import Archiver
 import serial.tools.list_ports
 import serial
 from datetime import datetime
 import time
 import threading
 import os
+import re
+import cv2
+import numpy as np
 
 class Arduino:
-    def __init__(self) -> None:
+    def __init__(self, port: str = None) -> None:
         """
         @brief  Starts Arduino class.
+        @param port     Serial port to connect to. If None, the first CH340 port found is used.
         """
 
-        self._port = None
+        self._port = port
         self._arduino = None
         self._IS_CONNECTED = False
-        self._error_box = QWidget()
+        self._connection_error = None
 
         self.current_shift_length = 30
         self._SHIFT_LENGTH_CHANGE = 0.1  # Increment to change shift length (mm) 
+        self.motion_profile = MotionProfile()  # Firmware defaults
+        self._lock = threading.Lock()
+        self._HAS_STATUS = False  # Whether the firmware answers '?' (moves in the background)
+        self._IS_HOMED = False
+        self._partial_line = b''
 
         try:
             self._IS_CONNECTED = self.connect_to_arduino()
                 
             if self._IS_CONNECTED:
                 self._arduino.write(bytes('R',  'utf-8'))
+                self.set_motion_profile(self.motion_profile)
+                self._HAS_STATUS = self.get_status() is not None
         except Exception as e:
-            QMessageBox.critical(self._error_box, "Error Encountered",
-                                e.msg, QMessageBox.Ok)
+            self._connection_error = getattr(e, 'msg', str(e))
+            print(self._connection_error)
+
+    def is_connected(self) -> bool:
+        """
+        @brief  Gets whether the arduino is connected.
+        @return True if connected, false otherwise.
+        """
+        return self._IS_CONNECTED
+
+    def get_connection_error(self) -> str:
+        """
+        @brief  Gets the error raised while connecting, so the caller can decide how to show it.
+        @return Error message, or None if the connection succeeded.
+        """
+        return self._connection_error
 
 
     def connect_to_arduino(self) -> None:
@@ -36,10 +69,11 @@ class Arduino:
         @brief  Connects to arduino port.
         """
         try:
-            for p in list(serial.tools.list_ports.comports()):
-                if "CH340" in p.description:
-                    self._port = p.device
-                    break
+            if self._port is None:
+                for p in list(serial.tools.list_ports.comports()):
+                    if "CH340" in p.description:
+                        self._port = p.device
+                        break
         
             self._arduino = serial.Serial(port=self._port,  baudrate=9600, timeout=.1)
             if not self._arduino.is_open:
@@ -63,19 +97,251 @@ class Arduino:
         @param char     Character to send to arduino to trigger functions.
         """
         if self._IS_CONNECTED:
-            self._arduino.write(bytes(char,  'utf-8'))
+            with self._lock:
+                self._arduino.write(bytes(char,  'utf-8'))
+
+    def _query(self, command: str, pattern: str, timeout: float = 0.5):
+        """
+        @brief  Sends a command and reads lines until one matches the expected reply. Other lines the
+                firmware sends, such as the direction and shift length echoes, are skipped.
+        @param command  Command character.
+        @param pattern  Regular expression of the reply.
+        @param timeout  Seconds to wait for the reply.
+        @return Match object, or None if the arduino did not answer.
+        """
+        if not self._IS_CONNECTED: return None
+        with self._lock:
+            self._arduino.reset_input_buffer()
+            self._partial_line = b''
+            self._arduino.write(bytes(command, 'utf-8'))
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                line = self._arduino.readline().decode('ascii', errors='ignore')
+                match = re.search(pattern, line)
+                if match: return match
+        return None
+
+    def get_status(self) -> dict:
+        """
+        @brief  Asks the arduino what the motor is doing. Works during a move.
+        @return Dictionary with 'moving', 'position' (steps), 'remaining' steps of the current move,
+                'queued' moves and whether the stage is 'homed', or None if the firmware does not
+                support status requests.
+        """
+        match = self._query('?', r'S (\d) (-?\d+) (\d+) (\d+)(?: (\d))?')
+        if match is None: return None
+        moving, position, remaining, queued = (int(value) for value in match.groups()[:4])
+        self._IS_HOMED = match.group(5) == '1'
+        return {'moving': bool(moving), 'position': position, 'remaining': remaining,
+                'queued': queued, 'homed': self._IS_HOMED}
+
+    def is_homed(self) -> bool:
+        """
+        @brief  Gets whether positions are measured from the limit switch, as of the last status.
+        """
+        return self._IS_HOMED
+
+    def home(self, return_to_start: bool = False, timeout: float = None) -> bool:
+        """
+        @brief  Moves the stage to the limit switch and makes the point where it releases position 0.
+                Blocking.
+        @param return_to_start  If True, the stage moves back to where it was before homing.
+        @param timeout          Seconds to wait for homing to finish. Defaults to the longest
+                                the firmware can take, as it homes at the start speed.
+        @return True if homed, false if the switch was not found or the firmware cannot home.
+        """
+        if not self._HAS_STATUS:
+            print("ERROR Arduino firmware does not support homing.")
+            return False
+        if timeout is None:
+            timeout = MotionProfile.constant(self.motion_profile.start_speed).move_time(
+                HOME_MAX_STEPS + HOME_BACKOFF_STEPS) + 5.0
+        start = self.get_position_steps()
+        match = self._query('Z', r'(Z (-?\d+)|E \w+)', timeout)
+        if match is None or match.group(2) is None:
+            print("ERROR Homing failed:", match.group(1) if match else "no reply")
+            return False
+        self._IS_HOMED = True
+        if return_to_start and start is not None:
+            # The reply is the old position of the new position 0.
+            self.move_to_steps(start - int(match.group(2)))
+        return True
+
+    def position(self) -> float:
+        """
+        @brief  Gets the stage position. Once homed it is measured from the limit switch, before
+                that from where the arduino was powered on.
+        @return Position in mm, or None if unknown.
+        """
+        steps = self.get_position_steps()
+        return None if steps is None else steps / (STEPS_PER_TENTH_MM * 10.0)
+
+    def move_to(self, millimeters: float, wait: bool = True) -> None:
+        """
+        @brief  Moves the stage to an absolute position.
+        @param millimeters  Position in mm, see position().
+        @param wait         If True, blocks until the stage gets there.
+        """
+        self.move_to_steps(self.motion_profile.steps_for_mm(millimeters), wait)
+
+    def move_to_steps(self, steps: int, wait: bool = True) -> None:
+        """
+        @brief  Moves the stage to an absolute position in steps, see move_to.
+        """
+        current = self.get_position_steps() if wait else None
+        self.write_to_arduino(f'G{steps}\n')
+        if wait:
+            distance = abs(steps - current) if current is not None else abs(steps)
+            self.wait_for_move(self.motion_profile.move_time(distance) + 5.0)
+
+    def get_position_steps(self) -> int:
+        """
+        @brief  Gets the motor position counted by the arduino since it was homed or powered on.
+        @return Position in steps (anticlockwise is positive), or None if unknown.
+        """
+        if not self._HAS_STATUS: return None
+        match = self._query('P', r'P (-?\d+)')
+        return int(match.group(1)) if match else None
+
+    def stop(self) -> None:
+        """
+        @brief  Stops the motor: drops queued moves and slows the current move to a stop.
+        """
+        self.write_to_arduino('X')
+
+    def set_idle_timeout(self, timeout_ms: int) -> None:
+        """
+        @brief  Sets how long the motor may stand still before the arduino puts the driver to sleep.
+                A sleeping driver saves power and keeps the motor cool, but the next move has to
+                wake it up and the stage is not held in place meanwhile.
+        @param timeout_ms   Idle time in milliseconds (100 by default).
+        """
+        self.write_to_arduino(f'I{int(timeout_ms)}\n')
+
+    def set_hold(self, enabled: bool) -> None:
+        """
+        @brief  Keeps the motor driver enabled between moves, whatever the idle timeout.
+        @param enabled  True to hold the stage, false to let the driver sleep when idle again.
+        """
+        self.write_to_arduino(f'K{1 if enabled else 0}\n')
+
+    def set_trigger(self, delay_ms: int) -> None:
+        """
+        @brief  Makes the arduino pulse the camera's trigger input whenever the stage stops.
+        @param delay_ms Milliseconds to let the stage settle before triggering, 0 to turn it off.
+        """
+        self.write_to_arduino(f'T{int(delay_ms)}\n')
+
+    def fire_trigger(self) -> None:
+        """
+        @brief  Pulses the camera's trigger input now.
+        """
+        self.write_to_arduino('F')
+
+    def run_program(self, moves: int, steps: int, settle_ms: int, dwell_ms: int,
+                    trigger: bool = False) -> None:
+        """
+        @brief  Starts a scan program that the arduino runs on its own: at each position it waits
+                settle_ms, reports the position (see read_program_event) and pulses the camera
+                trigger if asked, waits dwell_ms, then moves on. Do not send other requests while it
+                runs, as they would discard its reports.
+        @param moves    Number of moves; the program visits moves + 1 positions.
+        @param steps    Steps per move, negative to move clockwise.
+        @param settle_ms    Time for the stage to settle after each move.
+        @param dwell_ms     Time to stay at each position after it is reported, e.g. the exposure.
+        @param trigger      Whether to pulse the camera trigger at each position.
+        """
+        self.write_to_arduino(f'Q{int(moves)} {int(steps)} {int(settle_ms)} {int(dwell_ms)} '
+                              f'{1 if trigger else 0}\n')
+
+    def read_program_event(self, timeout: float):
+        """
+        @brief  Waits for the next report from a scan program.
+        @param timeout  Seconds to wait.
+        @return (position index, position in steps) tuple when a position is reached, 'done' when
+                the program has finished, 'stopped' if it was stopped, or None on timeout.
+        """
+        if not self._IS_CONNECTED: return None
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:  # Released between reads so stop() is never held up
+                self._partial_line += self._arduino.readline()
+                if not self._partial_line.endswith(b'\n'): continue  # Timed out mid-line
+                line = self._partial_line.decode('ascii', errors='ignore')
+                self._partial_line = b''
+                match = re.search(r'Q (\d+) (-?\d+)|Q (done|stopped)|E busy', line)
+                if match is None: continue
+                if match.group(1) is not None: return (int(match.group(1)), int(match.group(2)))
+                return match.group(3) or 'stopped'
+        return None
 
+    def wait_for_move(self, timeout: float, progress=None, should_stop=None) -> bool:
+        """
+        @brief  Blocks until the arduino has finished every move it was sent. Firmware without
+                status requests is waited for using the motion profile's estimate instead.
+        @param timeout      Maximum seconds to wait.
+        @param progress     Optional function called with the remaining steps while moving.
+        @param should_stop  Optional function; when it returns True the motor is stopped.
+        @return True if the motor stopped, false if the timeout was reached first.
+        """
+        if not self._HAS_STATUS:
+            time.sleep(min(self.estimate_move_time(), timeout))
+            return True
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if should_stop is not None and should_stop():
+                self.stop()
+                should_stop = None
+            status = self.get_status()
+            if status is not None:
+                if not status['moving'] and status['queued'] == 0: return True
+                if progress is not None: progress(status['remaining'])
+            time.sleep(0.02)
+        return False
 
-    def shift_right(self) -> None:
+
+    def shift_right(self, wait: bool = True) -> None:
         """
         @brief  Sends command to arduino turn the motor left to shift the platform right by the shift 
                 length. Blocking.
+        @param wait     If False, returns as soon as the command is sent instead of sleeping 1 s.
         """
         if self._IS_CONNECTED:
-            self._arduino.write(bytes('L',  'utf-8'))
-            self._arduino.write(bytes('M',  'utf-8'))
-            time.sleep(1)
+            with self._lock:
+                self._arduino.write(bytes('L',  'utf-8'))
+                self._arduino.write(bytes('M',  'utf-8'))
+            if wait: time.sleep(1)
+
+    def estimate_move_time(self) -> float:
+        """
+        @brief  Estimates how long the arduino takes to move by the shift length.
+        @return Seconds.
+        """
+        return self.motion_profile.move_time(int(STEPS_PER_TENTH_MM * self.current_shift_length))
+
+    def set_motion_profile(self, profile: MotionProfile) -> None:
+        """
+        @brief  Sends the start speed, cruise speed and acceleration for moves to the arduino.
+        @param profile  Motion profile to use.
+        """
+        self.motion_profile = profile
+        if self._IS_CONNECTED:
+            self.write_to_arduino(f'S{int(profile.start_speed)}\n'
+                                  f'V{int(profile.cruise_speed)}\n'
+                                  f'A{int(profile.acceleration)}\n')
+
 
+    def shift_left(self, wait: bool = True) -> None:
+        """
+        @brief  Sends command to arduino turn the motor right to shift the platform left by the shift 
+                length. Blocking.
+        @param wait     If False, returns as soon as the command is sent instead of sleeping 1 s.
+        """
+        if self._IS_CONNECTED:
+            with self._lock:
+                self._arduino.write(bytes('H',  'utf-8'))
+                self._arduino.write(bytes('M',  'utf-8'))
+            if wait: time.sleep(1)
     
     def update_shift_length(self, shift_length: float) -> None:
         """
@@ -105,17 +371,42 @@ class Arduino:
 
 class Automation():
 
-    def __init__(self, camera: Camera) -> None:
+    _STILL_TIMEOUT = 10.0  # Seconds to wait for a still before treating the camera as dropped
+    _PROGRAM_SETTLE_MS = 300  # Settle time of scan programs without the hardware trigger
+
+    def __init__(self, camera: Camera, arduino: Arduino = None) -> None:
         """
         @brief  Starts the automation class.
         @param camera   Instance of type Camera
+        @param arduino  Instance of type Arduino. If None, one is created and connected.
         """
 
         self._camera = camera
-        self._arduino = Arduino()
+        self._arduino = arduino if arduino is not None else Arduino()
         self._counter = 0
         self._image_counter = 0
         self._capture_dir = "tree_core"
+        self._total_shifts = 0
+        self._capture_log = []
+        self._journal = None
+        self._capture_failed = False
+        self._completed = False
+        self._settle_detector = SettleDetector(camera)
+        self._trigger_delay_ms = None
+        self._armed_path = None
+        self._scan_program = False
+        self._program_dwell_ms = None
+        self._live_panorama = LivePanorama()
+        self._thumbnails = ThumbnailWriter()
+        self._archiver = Archiver()
+        self._quality = QualityChecker()
+        self._thumbnails.listeners.append(self._quality.check)
+        self._max_retakes = 1
+        self._retakes = {}
+        self._use_container = False
+        self._container = None
+        self._container_path = None
+        self._container_capacity = 4096
         self._status = False
         self._last_status = False
         self._status_message = ""
@@ -125,8 +416,9 @@ class Automation():
     def change_status(self, value: bool) -> None:
         """
         @brief  Sets automation status.
-        @param value  True/False status to set.
+        @param value  True/False status to set. Stopping an active run also stops the motor.
         """
+        if self._status and not value: self._arduino.stop()
         self._status = value
 
     def is_active(self) -> bool: 
@@ -173,6 +465,119 @@ class Automation():
         @return Return status as string
         """
         return self._status_message
+
+    def get_progress(self) -> tuple:
+        """
+        @brief  Gets how far the current run is.
+        @return (shifts done, total shifts) tuple.
+        """
+        return (self._counter, self._total_shifts)
+
+    def set_settle_detection(self, enabled: bool, threshold: float = None) -> None:
+        """
+        @brief Chooses how to wait for the stage before each picture. When enabled, the picture is
+            taken as soon as the preview stops changing (up to the old fixed wait). When disabled, the
+            fixed sleeps are used.
+        @param enabled      Whether to detect settling from the preview.
+        @param threshold    Mean frame difference (grey levels) that counts as still.
+        """
+        self._settle_detector = SettleDetector(self._camera) if enabled else None
+        if enabled and threshold is not None: self._settle_detector.set_threshold(threshold)
+
+    def set_hardware_trigger(self, enabled: bool, delay_ms: int = 300) -> None:
+        """
+        @brief Chooses how pictures are started. When enabled, the arduino triggers the camera
+            itself once each move ends and delay_ms has passed, so the host only collects the
+            frames. The camera must be wired to the arduino's trigger pin. Triggered pictures
+            come from the microscope's video stream, which Camera.set_trigger_mode switches to the
+            still resolution for the run, so they are as large as snapped stills. The preview
+            is back at its own resolution once the run ends.
+        @param enabled  Whether to use the hardware trigger.
+        @param delay_ms Settle time after each move before the picture.
+        """
+        self._trigger_delay_ms = delay_ms if enabled else None
+
+    def set_scan_program(self, enabled: bool, dwell_ms: int = None) -> None:
+        """
+        @brief Chooses whether the arduino runs the whole capture as a scan program, so no serial
+            commands or host sleeps are needed between positions. The host only collects the
+            pictures. Best combined with the hardware trigger. Pausing has no effect while a
+            program runs.
+        @param enabled  Whether to use scan programs.
+        @param dwell_ms Time the stage stays at each position after the picture starts. By default
+            the exposure time plus 50 ms with the hardware trigger, and 1 s for software snaps.
+        """
+        self._scan_program = enabled
+        self._program_dwell_ms = dwell_ms
+
+    def set_auto_retake(self, enabled: bool, max_retakes: int = 1) -> None:
+        """
+        @brief Chooses whether stills that fail the quality check (see QualityChecker) are taken
+            again. Stills are checked in the background as they are saved; a failed one is retaken
+            as soon as its result is in, usually from the next position, and the stage then
+            carries on from where it was.
+        @param enabled      Whether to retake failed stills.
+        @param max_retakes  Times a position is retaken at most. A still that keeps failing is
+            usually right, e.g. at the ends of the core, and is kept.
+        """
+        self._max_retakes = max_retakes if enabled else 0
+
+    def set_session_container(self, enabled: bool) -> None:
+        """
+        @brief Chooses whether runs store their stills in a single session container file,
+            <name>_session.frames in the capture location, instead of one file per position. This
+            is much faster on network shares and in folders a virus scanner watches. Stills keep
+            their usual paths, which the stitching, ring analysis and review tools read from the
+            container (see session_container.py), and the container can be exported to loose files.
+        @param enabled  Whether to use a session container.
+        """
+        self._use_container = enabled
+
+    def set_archive(self, archive_dir: str, bandwidth_mb_s: float = None) -> None:
+        """
+        @brief Chooses whether each completed core folder is copied to an archive, e.g. a mounted
+            network share. The copy runs in the background while the next core is captured, and
+            each file is checked against its checksum after copying (see archive.py).
+        @param archive_dir      Archive location, or None to archive nothing.
+        @param bandwidth_mb_s   Largest average transfer rate in MB/s, or None for no limit.
+        """
+        self._archiver.archive_dir = archive_dir
+        self._archiver.bandwidth_mb_s = bandwidth_mb_s
+
+    def get_archiver(self) -> Archiver: return self._archiver
+
+    def get_quality_checker(self) -> QualityChecker:
+        """
+        @brief  Gets the checker that judges the stills of the current run, to change thresholds.
+        """
+        return self._quality
+
+    def is_completed(self) -> bool:
+        """
+        @brief  Tells whether the last run started with start_automation captured every position,
+                or the last queue started with start_queue captured every core.
+        """
+        return self._completed
+
+    def get_capture_log(self) -> list:
+        """
+        @brief  Gets the images saved by the current or last run.
+        @return List of {'index', 'file', 'time', 'stage_mm'} dictionaries.
+        """
+        return self._capture_log
+
+    def get_live_panorama(self) -> LivePanorama:
+        """
+        @brief  Gets the low resolution panorama that is built while a run captures.
+        """
+        return self._live_panorama
+
+    def get_connection_error(self) -> str:
+        """
+        @brief  Gets the error raised while connecting to the arduino.
+        @return Error message, or None if the arduino connected.
+        """
+        return self._arduino.get_connection_error()
     
     def set_counter_value(self, number:str) -> None:
         """
@@ -220,54 +625,533 @@ class Automation():
 
 
     @run_in_thread
-    def start_automation(self, image_name:str, core_length:float, shift_length:float):
+    def start_automation(self, image_name:str, core_length:float, shift_length:float,
+                         resume: bool = False):
         """
         @brief Starts the automation process. Non-blocking,
         @param image_name   Name to Save Image under (with image count added).
         @param core_length  Core size (in mm).
         @param shift_length Length to shift motor each turn (in cm).
+        @param resume       See run_automation.
+        """
+        self._completed = False
+        self._completed = self.run_automation(image_name, core_length, shift_length, resume)
+        if self._completed: self._archiver.add(self._capture_dir)
+
+    def run_automation(self, image_name:str, core_length:float, shift_length:float,
+                       resume: bool = False) -> bool:
+        """
+        @brief Runs the automation process. Blocking, see start_automation for the threaded version.
+            Progress is written to a journal in the capture location so an interrupted run can be
+            resumed.
+        @param image_name   Name to Save Image under (with image count added).
+        @param core_length  Core size (in mm).
+        @param shift_length Length to shift motor each turn (in cm).
+        @param resume       Continue the last run journaled under image_name instead of starting
+            over. The run's own core and shift lengths are used. Starts a new run if there is
+            nothing to resume.
+        @return True if the run finished, false if it was stopped.
         """
 
         self._status_message = "Automation Started..."
 
         self.change_status(True)
+        self.check_capture_location()
+        self._capture_log = []
+        self._capture_failed = False
+        self._live_panorama.reset()
+        self._quality.reset()
+        self._retakes = {}
 
-        motor_shifts_needed = int(core_length * 10  / (shift_length)) + 1
+        journal_path = self.get_journal_path(image_name)
+        entries = read_journal(journal_path) if resume else []
+        point = resume_point(entries, self._capture_dir) if resume else None
+        if point is not None and point['finished']:
+            self.change_status(False)
+            self._status_message = "Automation Stopped. Nothing to resume, the core is complete."
+            return True
+
+        if point is not None:
+            shift_length = point['start']['shift_length']
+            motor_shifts_needed = point['start']['total']
+            first_position = point['position']
+            self._image_counter = point['index']
+            self._journal = CaptureJournal(journal_path)
+            self._thumbnails.open(self.get_thumbnail_pack_path(image_name))
+            self.open_container(image_name, True, motor_shifts_needed)
+            self._journal.record('resume', position=first_position)
+            self.show_captured(entries, first_position, shift_length)
+            print(f"Resuming {image_name} at position {first_position} / {motor_shifts_needed}")
+        else:
+            motor_shifts_needed = int(core_length * 10  / (shift_length)) + 1
+            first_position = 0
+            self._journal = CaptureJournal(journal_path, append=False)
+            self._thumbnails.open(self.get_thumbnail_pack_path(image_name), append=False)
+            self.open_container(image_name, False, motor_shifts_needed)
+            self._journal.record('start', image_name=image_name, core_length=core_length,
+                                 shift_length=shift_length, total=motor_shifts_needed,
+                                 first_index=self._image_counter, homed=self._arduino.is_homed(),
+                                 pixel_size_um=self._camera.get_pixel_size())
+        self._total_shifts = motor_shifts_needed
+        self._quality.last_position = motor_shifts_needed  # Positions run from 0 to the last shift
         self._arduino.update_shift_length(shift_length)
-        self.check_capture_location()
 
-        self._counter = 0
-        for self._counter in range(motor_shifts_needed):
-            self._status_message = f"Automation Started...  Shifting {self._counter} / {motor_shifts_needed} time(s) by  {shift_length} mm"
-            while (self._IS_PAUSED and self.is_active()): pass
-            if not self.is_active(): break
-
-            self.get_picture(image_name)
-            time.sleep(1.0)
-
-            while (self._IS_PAUSED and self.is_active()): pass
-            if not self.is_active(): break
-            time.sleep(0.5)
-            self.shift_sample()
-            time.sleep(self._arduino.current_shift_length / 20.0)
-            self._image_counter += 1
-        
-        time.sleep(self._arduino.current_shift_length / 20.0)
-        self.get_picture(image_name)
+        completed = False
+        self._arduino.set_hold(True)  # No wake-up delay or drift between shifts
+        try:
+            if point is not None:
+                self.return_to_position(point['stage_position'], first_position)
+
+            if self._trigger_delay_ms is not None:
+                self._camera.set_trigger_mode(True)
+                self._arduino.set_trigger(self._trigger_delay_ms)
+                self._armed_path = None
+            elif self._settle_detector is not None: self._settle_detector.calibrate()
+
+            self._counter = first_position
+            if self._scan_program:
+                completed = self.run_scan_program(image_name, first_position, motor_shifts_needed)
+            else:
+                for self._counter in range(first_position, motor_shifts_needed):
+                    self._status_message = f"Automation Started...  Shifting {self._counter} / {motor_shifts_needed} time(s) by  {shift_length} mm"
+                    while (self._IS_PAUSED and self.is_active()): pass
+                    if not self.is_active(): break
+
+                    if not self.capture_position(image_name, self._counter): break
+                    if not self.retake_failed(image_name, self._counter): break
+
+                    while (self._IS_PAUSED and self.is_active()): pass
+                    if not self.is_active(): break
+                    if self._trigger_delay_ms is not None:
+                        # The arduino takes the next picture when this move ends
+                        self.arm_picture(image_name, self._image_counter + 1)
+                        self.shift_and_record(self._counter + 1)
+                    else:
+                        if self._settle_detector is None: time.sleep(0.5)
+                        self.shift_and_record(self._counter + 1)
+                        self.wait_for_stage()
+                    self._image_counter += 1
+                else:
+                    if self._settle_detector is None and self._trigger_delay_ms is None:
+                        time.sleep(self._arduino.current_shift_length / 20.0)
+                    completed = self.is_active() and self.capture_position(image_name, motor_shifts_needed)
+            if completed:
+                # The last stills are checked after the loop ends
+                self._thumbnails.wait()
+                completed = self.retake_failed(image_name, motor_shifts_needed)
+            if completed: self._journal.record('finished')
+        finally:
+            self._journal.close()
+            self._thumbnails.wait()  # The last stills' thumbnails, before the program can exit
+            self._camera.set_still_sink(None)
+            if self._container is not None:
+                self._container.close()
+                self._container = None
+            self._arduino.set_hold(False)
+            if self._trigger_delay_ms is not None:
+                self._arduino.set_trigger(0)
+                self._camera.set_trigger_mode(False)
+
         self.change_status(False)
         print("Automation Stopped")
-        self._status_message = "Automation Stopped."
+        if not self._capture_failed: self._status_message = "Automation Stopped."
+        return completed
+
+    def capture_position(self, image_name: str, position: int) -> bool:
+        """
+        @brief Takes the picture for a position, waits for it to be saved, and journals it with its
+            checksum.
+        @param image_name   Name to Save Image under (with image count added).
+        @param position     Position in the run.
+        @return True if the picture was saved, false if the run has to stop.
+        """
+        started = time.time()
+        timeout = self._STILL_TIMEOUT
+        if self._trigger_delay_ms is None:
+            path = self.get_picture(image_name)
+        else:
+            if self._armed_path is None:
+                # Nothing is moving, e.g. at the first position
+                self.arm_picture(image_name, self._image_counter)
+                self._arduino.fire_trigger()
+            path, self._armed_path = self._armed_path, None
+            timeout += self._arduino.estimate_move_time() + self._trigger_delay_ms / 1000.0
+        saved = self._camera.wait_for_still_image(timeout)
+        if not self.record_picture(path, position, saved, self._arduino.position()): return False
+        if self._settle_detector is None and self._trigger_delay_ms is None:
+            time.sleep(max(0.0, 1.0 - (time.time() - started)))
+        return True
+
+    def record_picture(self, path: str, position: int, saved: bool, stage_mm: float) -> bool:
+        """
+        @brief Journals a picture with its checksum, or stops the run if it was not saved.
+        @param path         Path the picture was saved to.
+        @param position     Position in the run.
+        @param saved        Whether the camera reported the picture as written.
+        @param stage_mm     Stage position the picture was taken at, if known.
+        @return True if the picture was saved, false if the run has to stop.
+        """
+        if not saved or not frame_exists(path):
+            self._capture_failed = True
+            self._journal.record('failed', position=position, file=os.path.basename(path))
+            self._status_message = f"{os.path.basename(path)} was not saved. Stopped, resume to continue."
+            print(self._status_message)
+            self.change_status(False)
+            return False
+        self.log_picture(path, stage_mm)
+        self._live_panorama.add_frame(path, stage_mm if stage_mm is not None else
+                                      position * self._arduino.current_shift_length / 10.0)
+        self._thumbnails.add(path, self._image_counter, stage_mm, position)
+        self._journal.record('captured', position=position, index=self._image_counter,
+                             file=os.path.basename(path), sha256=file_checksum(path),
+                             stage_position=position, stage_mm=stage_mm)
+        if self._container is not None and os.path.basename(path) in self._container:
+            self._container.annotate(os.path.basename(path), index=self._image_counter,
+                                     position=position, stage_mm=stage_mm)
+        return True
+
+    def show_captured(self, entries: list, positions: int, shift_length: float) -> None:
+        """
+        @brief Adds the pictures an interrupted run already took to the live panorama.
+        @param entries      Journal entries of the run.
+        @param positions    Number of positions already captured.
+        @param shift_length Shift length of the run (mm).
+        """
+        captured = {entry['position']: entry for entry in entries if entry['event'] == 'captured'}
+        for position in range(positions):
+            entry = captured[position]
+            stage_mm = entry.get('stage_mm')
+            if stage_mm is None: stage_mm = position * shift_length
+            self._live_panorama.add_frame(os.path.join(self._capture_dir, entry['file']), stage_mm)
+
+    def run_scan_program(self, image_name: str, first_position: int, total: int) -> bool:
+        """
+        @brief Captures positions first_position to total with a scan program on the arduino (see
+            set_scan_program). The arduino moves, settles and triggers on its own; this only waits
+            for its report of each position, collects the picture and journals it.
+        @param image_name       Name to Save Image under (with image count added).
+        @param first_position   Position the stage is at.
+        @param total            Last position.
+        @return True if every position was captured.
+        """
+        trigger = self._trigger_delay_ms is not None
+        settle_ms = self._trigger_delay_ms if trigger else self._PROGRAM_SETTLE_MS
+        dwell_ms = self._program_dwell_ms
+        if dwell_ms is None:
+            dwell_ms = int(self._camera.get_exposure_time() * 1000) + 50 if trigger else 1000
+        steps = int(STEPS_PER_TENTH_MM * self._arduino.current_shift_length)
+        timeout = self._arduino.estimate_move_time() + (settle_ms + dwell_ms) / 1000.0 + self._STILL_TIMEOUT
+
+        if trigger:
+            self._arduino.set_trigger(0)  # The program triggers the camera itself
+            for index in range(total - first_position + 1):
+                path = self.picture_path(image_name, self._image_counter + index)
+                self.clear_picture(path)
+                self._camera.arm_trigger(path)
+        # The arduino finishes the program even if this program dies, so journal where it ends.
+        self._journal.record('shifting', stage_position=total,
+                             shift_length=self._arduino.current_shift_length)
+        self._arduino.run_program(total - first_position, steps, settle_ms, dwell_ms, trigger)
+
+        reached = None
+        for self._counter in range(first_position, total + 1):
+            self._status_message = f"Automation Started...  Scan program at {self._counter} / {total} by  {self._arduino.current_shift_length / 10} mm"
+            event = self._arduino.read_program_event(timeout)
+            if not isinstance(event, tuple) or not self.is_active(): break
+            reached = event
+            stage_mm = event[1] / (STEPS_PER_TENTH_MM * 10.0)
+            if trigger:
+                path = self._camera.wait_for_triggered_image(self._STILL_TIMEOUT)
+                saved = path is not None
+                if path is None: path = self.picture_path(image_name, self._image_counter)
+            else:
+                path = self.get_picture(image_name)
+                saved = self._camera.wait_for_still_image(self._STILL_TIMEOUT)
+            if not self.record_picture(path, self._counter, saved, stage_mm): break
+            if self._counter < total: self._image_counter += 1
+        else:
+            return True
+
+        # Stopped part way: put the stage back on the last position it reported.
+        self._arduino.stop()
+        self._arduino.wait_for_move(self._arduino.estimate_move_time() + 2.0)
+        stage_position = first_position
+        if reached is not None:
+            self._arduino.move_to_steps(reached[1])
+            stage_position += reached[0]
+        self._journal.record('shifted', stage_position=stage_position)
+        return False
+
+    def retake_failed(self, image_name: str, stage_position: int) -> bool:
+        """
+        @brief Retakes the stills that failed the quality check since the last call (see
+            set_auto_retake), then returns the stage to where it was. Does nothing if no results
+            came in, so the capture never waits for the check.
+        @param image_name       Name to Save Image under (with image count added).
+        @param stage_position   Position the stage is at, with nothing armed or moving.
+        @return True if the run can go on, false if it has to stop.
+        """
+        failures = self._quality.take_failures()
+        failures = [failure for failure in failures
+                    if self._retakes.get(failure['position'], 0) < self._max_retakes]
+        if not failures: return True
+        if self._trigger_delay_ms is not None:
+            self._arduino.set_trigger(0)  # Only the retakes are triggered, by fire_trigger
+        message = self._status_message
+        image_counter = self._image_counter
+        position = stage_position
+        try:
+            for failure in sorted(failures, key=lambda failure: failure['position']):
+                if not self.is_active(): return False
+                self._retakes[failure['position']] = self._retakes.get(failure['position'], 0) + 1
+                self._status_message = (f"Retaking {failure['file']} "
+                                        f"({', '.join(failure['reasons'])})")
+                print(self._status_message)
+                self._journal.record('retake', position=failure['position'],
+                                     file=failure['file'], reasons=failure['reasons'])
+                self.return_to_position(position, failure['position'])
+                position = failure['position']
+                if not self.is_active(): return False
+                self._image_counter = failure['index']
+                if not self.capture_position(image_name, position): return False
+            self.return_to_position(position, stage_position)
+        finally:
+            self._image_counter = image_counter
+            self._status_message = message
+            if self._trigger_delay_ms is not None:
+                self._arduino.set_trigger(self._trigger_delay_ms)
+        return self.is_active()
+
+    def shift_and_record(self, stage_position: int) -> None:
+        """
+        @brief Shifts the sample one position, journaling the move before and after it.
+        @param stage_position   Position the stage is moving to.
+        """
+        self._journal.record('shifting', stage_position=stage_position,
+                             shift_length=self._arduino.current_shift_length)
+        self.shift_sample(wait=self._settle_detector is None and self._trigger_delay_ms is None)
+        self._journal.record('shifted', stage_position=stage_position)
 
+    def wait_for_stage(self) -> None:
+        """
+        @brief Waits after a shift until the stage has stopped moving and vibrating. With settle
+            detection this ends as soon as the preview is still, and never takes longer than the
+            fixed wait used without it.
+        """
+        settle_wait = self._arduino.current_shift_length / 20.0
+        move_time = self._arduino.estimate_move_time()
+        if self._settle_detector is None:
+            time.sleep(max(settle_wait, move_time))
+            return
+
+        message = self._status_message
+        def show_progress(remaining: int) -> None:
+            if not self._IS_PAUSED: self._status_message = f"{message} (moving, {remaining} steps left)"
+        started = time.time()
+        self._arduino.wait_for_move(move_time + 1.0, show_progress, lambda: not self.is_active())
+        if not self._IS_PAUSED: self._status_message = message
+        remaining = max(move_time + 1.0, 1.0 + settle_wait) - (time.time() - started)
+        self._settle_detector.wait(0, max(remaining, 0.5))
+
+    def return_to_position(self, stage_position: int, position: int) -> None:
+        """
+        @brief Moves the stage from where the journal says it is to a position, e.g. back to a
+            position whose picture was lost or failed the quality check.
+        @param stage_position   Position the stage was last sent to.
+        @param position         Position to move to.
+        """
+        wait = self._settle_detector is None
+        while stage_position != position and self.is_active():
+            if stage_position < position:
+                stage_position += 1
+                self._journal.record('shifting', stage_position=stage_position,
+                                     shift_length=self._arduino.current_shift_length)
+                self._arduino.shift_right(wait)
+            else:
+                stage_position -= 1
+                self._journal.record('shifting', stage_position=stage_position,
+                                     shift_length=self._arduino.current_shift_length)
+                self._arduino.shift_left(wait)
+            if wait: time.sleep(self._arduino.current_shift_length / 20.0)
+            else: self.wait_for_stage()
+            self._journal.record('shifted', stage_position=stage_position)
+
+    def get_journal_path(self, image_name: str) -> str:
+        """
+        @brief Gets the progress journal for runs saved under image_name.
+        @param image_name   Name images are saved under.
+        @return Path of the journal.
+        """
+        return os.path.join(self._capture_dir, f"{image_name}_journal.jsonl")
+
+    def get_thumbnail_pack_path(self, image_name: str) -> str:
+        """
+        @brief Gets the thumbnail pack of runs saved under image_name, which holds a thumbnail and
+            summary of every still (see thumbnails.py).
+        @param image_name   Name images are saved under.
+        @return Path of the pack.
+        """
+        return os.path.join(self._capture_dir, f"{image_name}_thumbnails.pack")
+
+    def get_thumbnail_writer(self) -> ThumbnailWriter: return self._thumbnails
+
+    def open_container(self, image_name: str, resume: bool, positions: int) -> None:
+        """
+        @brief Prepares the session container of a run if containers are enabled (see
+            set_session_container) and makes the camera store stills in it. A new run replaces the
+            previous container, a resumed run adds to it. The container itself is created with the
+            first still, once the still size is known.
+        @param image_name   Name the images are saved under.
+        @param resume       Whether the run is resumed.
+        @param positions    Positions in the run, to size the container's frame table.
+        """
+        self._container = None
+        if not self._use_container: return
+        self._container_path = os.path.join(self._capture_dir, f"{image_name}{CONTAINER_SUFFIX}")
+        self._container_capacity = max(4096, 4 * (positions + 1))  # Room for retakes
+        if resume and os.path.exists(self._container_path):
+            self._container = SessionContainer(self._container_path, writable=True)
+            register_container(self._container)
+        elif os.path.exists(self._container_path):
+            os.remove(self._container_path)
+        self._camera.set_still_sink(self.store_still)
+
+    def store_still(self, path: str, still: np.ndarray) -> None:
+        """
+        @brief Stores a still in the run's session container under its file name. Called by the
+            camera in place of writing the file.
+        @param path     Path the still would have been saved to.
+        @param still    RGB image.
+        """
+        try:
+            if self._container is None:
+                self._container = SessionContainer.create(self._container_path, still.shape[0], still.shape[1],
+                                                          max_frames=self._container_capacity,
+                                                          image_name=os.path.basename(path).rsplit('_', 1)[0])
+                register_container(self._container)
+            self._container.write(os.path.basename(path), cv2.cvtColor(still, cv2.COLOR_RGB2BGR))
+        except ValueError as e:
+            raise IOError(f"Could not store {os.path.basename(path)} in {self._container_path}: {e}")
+
+    @run_in_thread
+    def start_queue(self, queue: JobQueue, prompt: callable = None):
+        """
+        @brief Runs the queue of cores. Non-blocking, see run_queue.
+        """
+        self._completed = False
+        summaries = self.run_queue(queue, prompt)
+        self._completed = queue.next_pending() is None and all(job.status == DONE for job, _ in summaries)
+
+    def run_queue(self, queue: JobQueue, prompt: callable = None) -> list:
+        """
+        @brief Captures every pending job in the queue one after another. Blocking. Before each
+            core after the first the operator is asked to load the next core, and a manifest with
+            the images and timings is written in each core's folder. Completed cores are archived in
+            the background if an archive is set (see set_archive).
+        @param queue    The JobQueue to run.
+        @param prompt   Called with the next CoreJob, returns False to stop the queue. If None,
+            automation pauses until the operator presses play.
+        @return List of (job, timing summary) tuples for the cores that were captured.
+        """
+        summaries = []
+        self.change_status(True)
+        job = queue.next_pending()
+        while job is not None:
+            if summaries and not self.wait_for_operator(job, prompt): break
+
+            self._camera.load_profile(job.profile)
+            self.set_capture_location(job.capture_dir())
+            self.set_counter_value("0")
+            resume = job.started is not None  # Interrupted earlier, continue where it stopped
+            queue.mark(job, RUNNING)
 
-    def get_picture(self, image_name:str) -> None:
+            started = time.time()
+            completed = self.run_automation(job.core_id, job.core_length, job.shift_length, resume)
+            self._camera.wait_for_still_image(10.0)
+            finished = time.time()
+
+            queue.mark(job, DONE if completed else STOPPED)
+            entries = read_journal(self.get_journal_path(job.core_id))
+            run_started = [entry['time'] for entry in entries if entry['event'] == 'start']
+            write_manifest(job, captured_images(entries), run_started[-1] if run_started else started, finished)
+            summaries.append((job, timing_summary(self._capture_log, started, finished)))
+            if not completed: break
+            self._archiver.add(job.capture_dir())
+            self.change_status(True)
+            job = queue.next_pending()
+
+        self.change_status(False)
+        total_minutes = sum(summary['total_s'] for _, summary in summaries) / 60.0
+        self._status_message = f"Queue stopped. {len(summaries)} core(s) captured in {total_minutes:.1f} min."
+        return summaries
+
+    def wait_for_operator(self, job: CoreJob, prompt: callable = None) -> bool:
+        """
+        @brief Asks the operator to load the next core.
+        @param job      The next job.
+        @param prompt   See run_queue.
+        @return True to continue with the job, false to stop the queue.
+        """
+        if prompt is not None:
+            return prompt(job)
+        self.set_pause(True)
+        self._status_message = f"Load core '{job.core_id}' and press Play to continue."
+        while self._IS_PAUSED and self.is_active(): time.sleep(0.05)
+        self.set_pause(False)
+        return self.is_active()
+
+    def get_picture(self, image_name:str) -> str:
         """
         @brief    Tells the camera to take a picture.
-        @
+        @return   Path the picture is saved to.
         """
-        self.check_capture_location()
-        image_number = str(self._image_counter).zfill(4) # Add 0s in front so 4 digits long
-        self._camera.set_capture_path(f'{self._capture_dir}/{image_name}_{image_number}.{self._camera.get_image_file_format()}')
+        path = self.picture_path(image_name, self._image_counter)
+        self.clear_picture(path)
+        self._camera.set_capture_path(path)
         self._camera.take_still_image()
+        return path
+
+    def picture_path(self, image_name: str, index: int) -> str:
+        """
+        @brief    Gets the path a picture is saved to, creating the capture location if needed.
+        @param index  Image number of the picture.
+        """
+        self.check_capture_location()
+        image_number = str(index).zfill(4) # Add 0s in front so 4 digits long
+        return f'{self._capture_dir}/{image_name}_{image_number}.{self._camera.get_image_file_format()}'
+
+    def arm_picture(self, image_name: str, index: int) -> str:
+        """
+        @brief    Tells the camera where to save the next hardware-triggered picture.
+        @param index  Image number of the picture.
+        @return   Path the picture is saved to.
+        """
+        path = self.picture_path(image_name, index)
+        self.clear_picture(path)
+        self._camera.arm_trigger(path)
+        self._armed_path = path
+        return path
+
+    def clear_picture(self, path: str) -> None:
+        """
+        @brief    Deletes an earlier file at a picture's path, e.g. of a resumed or retaken
+                  position, so a picture that is not saved cannot pass for the old one. Frames in
+                  a session container are replaced by new records instead.
+        @param path   Path the picture is about to be saved to.
+        """
+        try:
+            if os.path.exists(path): os.remove(path)
+        except OSError as e:
+            print(f"Could not remove the old {path}: {e}")
+
+    def log_picture(self, path: str, stage_mm: float = None) -> None:
+        """
+        @brief    Records a picture taken during a run in the capture log.
+        @param path       Path the picture is saved to.
+        @param stage_mm   Stage position the picture was taken at, if known.
+        """
+        self._capture_log.append({'index': self._image_counter, 'file': path, 'time': time.time(),
+                                  'stage_mm': stage_mm})
         
 
     @run_in_thread
@@ -278,12 +1162,12 @@ class Automation():
         self.get_picture(image_name)
         self._status_message = "Image taken."
 
-    def shift_sample(self):
+    def shift_sample(self, wait: bool = True):
         """
         @brief  Rotates motor to shift sample. Rotates by 3mm each shift
-        @param shift_length   Length to shift motor each turn (in cm).
+        @param wait   If False, returns as soon as the move is sent (see Arduino.shift_right).
         """
-        self._arduino.shift_right()
+        self._arduino.shift_right(wait)
 
 
 
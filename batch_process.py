@@ -0,0 +1,246 @@
+import os, sys, json, time, hashlib, argparse, multiprocessing
+import yaml
+from journal import file_checksum
+from session_container import frame_checksum
+from shading import profile_path
+from stitching import find_frames
+
+
+def stitch_step(folder: str, name: str, settings: dict) -> list:
+    """
+    @brief  Stitches a core into <name>_panorama.dzi.
+    """
+    from stitching import Stitcher, DziSink, stitch_folder
+    output = os.path.join(folder, f"{name}_panorama.dzi")
+    sink = DziSink(output, workers=settings['threads'])
+    stitch_folder(folder, name, sink, Stitcher(settings['feather']), shading=settings['shading'])
+    return [output, os.path.join(folder, f"{name}_panorama_files")]
+
+
+def rings_step(folder: str, name: str, settings: dict) -> list:
+    """
+    @brief  Measures a core's rings into <name>.rwl and <name>.pos.
+    """
+    from ring_analysis import analyze_capture
+    return analyze_capture(folder, name, pith=settings['pith'], last_year=settings['last_year'],
+                           shading=settings['shading'])['files']
+
+
+# Steps in the order they run. Each takes (folder, name, settings) and returns its output paths.
+STEPS = {
+    'stitch': stitch_step,
+    'rings': rings_step,
+}
+STEP_SETTINGS = {  # Settings that change a step's output, so changing them reprocesses the core
+    'stitch': ('feather', 'shading'),
+    'rings': ('pith', 'last_year', 'shading'),
+}
+
+
+def find_cores(root: str) -> list:
+    """
+    @brief  Finds the core folders under a root folder, i.e. folders like the ones
+            Automation.set_capture_location creates, holding <name>_NNNN images.
+    @param root Folder of core folders.
+    @return List of (folder, name) tuples.
+    """
+    cores = []
+    for entry in sorted(os.listdir(root)):
+        folder = os.path.join(root, entry)
+        if not os.path.isdir(folder): continue
+        frames = find_frames(folder, entry) or find_frames(folder)
+        if frames: cores.append((folder, os.path.basename(frames[0]).rsplit('_', 1)[0]))
+    return cores
+
+
+def fingerprint(folder: str, name: str, step: str, settings: dict, checksum: bool = False) -> str:
+    """
+    @brief  Identifies the inputs of a step, so a step whose inputs have not changed since it
+            last ran can be skipped.
+    @param folder   Core folder.
+    @param name     Image name.
+    @param step     Step name.
+    @param settings Batch settings.
+    @param checksum Hash file contents instead of using sizes and modification times. Slower,
+                    but survives copying the archive.
+    @return Hex digest.
+    """
+    inputs = find_frames(folder, name)
+    journal_path = os.path.join(folder, f"{name}_journal.jsonl")
+    if os.path.exists(journal_path): inputs.append(journal_path)
+    if settings.get('shading') and os.path.exists(profile_path(folder, name)):
+        inputs.append(profile_path(folder, name))  # E.g. estimated again from blank captures
+    files = []
+    for path in inputs:
+        if checksum:
+            files.append((os.path.basename(path), file_checksum(path)))
+        elif not os.path.exists(path):  # A session container frame: the checksum it was written with
+            files.append((os.path.basename(path), frame_checksum(path)))
+        else:
+            stat = os.stat(path)
+            files.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    values = {key: settings.get(key) for key in STEP_SETTINGS[step]}
+    return hashlib.sha256(json.dumps([step, values, files]).encode()).hexdigest()
+
+
+def load_state(folder: str, name: str) -> dict:
+    try:
+        with open(os.path.join(folder, f"{name}_batch.yaml"), "r") as stream:
+            return yaml.safe_load(stream) or {}
+    except (OSError, yaml.YAMLError):
+        return {}
+
+
+def save_state(folder: str, name: str, state: dict) -> None:
+    """
+    @brief  Atomically writes <name>_batch.yaml, which records what each step last processed.
+            Output paths are kept relative to the core folder, so the archive can be moved.
+    """
+    path = os.path.join(folder, f"{name}_batch.yaml")
+    with open(path + '.tmp', "w") as stream:
+        yaml.safe_dump(state, stream, sort_keys=False)
+    os.replace(path + '.tmp', path)
+
+
+def process_core(task: tuple) -> dict:
+    """
+    @brief  Runs the batch steps on one core, skipping steps that are up to date. Runs in a
+            worker process.
+    @param task (folder, name, steps, settings) tuple.
+    @return Dictionary with the 'core', its 'status' (done, skipped or failed), what happened to
+            each of its 'steps', the 'seconds' it took and any 'error'.
+    """
+    folder, name, steps, settings = task
+    started = time.time()
+    state = load_state(folder, name)
+    result = {'core': os.path.basename(folder), 'folder': folder, 'status': 'skipped', 'steps': {},
+              'error': None}
+    try:
+        for step in steps:
+            current = fingerprint(folder, name, step, settings, settings['checksum'])
+            previous = state.get(step, {})
+            if (not settings['force'] and previous.get('fingerprint') == current and
+                    all(os.path.exists(os.path.join(folder, path))
+                        for path in previous.get('outputs', []))):
+                result['steps'][step] = 'skipped'
+                continue
+            step_started = time.time()
+            estimated = settings.get('shading') and not os.path.exists(profile_path(folder, name))
+            outputs = STEPS[step](folder, name, settings)
+            if estimated:  # The step estimated the shading profile it used, which is an input now
+                current = fingerprint(folder, name, step, settings, settings['checksum'])
+            state[step] = {
+                'fingerprint': current,
+                'outputs': [os.path.relpath(path, folder) for path in outputs],
+                'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'seconds': round(time.time() - step_started, 2),
+            }
+            save_state(folder, name, state)
+            result['steps'][step] = 'done'
+            result['status'] = 'done'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = round(time.time() - started, 2)
+    return result
+
+
+def _start_worker(threads: int, memory_limit_mb: int) -> None:
+    """
+    @brief  Keeps each worker to its share of the machine: OpenCV's own threads are limited, and
+            on Linux and macOS the worker's memory is capped so one core cannot exhaust the host.
+    """
+    import cv2
+    cv2.setNumThreads(threads)
+    if memory_limit_mb:
+        try:
+            import resource
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            print(f"Could not limit worker memory: {e}")
+
+
+def run_batch(root: str, steps: list = None, workers: int = None, settings: dict = None,
+              progress=None) -> dict:
+    """
+    @brief  Processes every core folder under root on a pool of worker processes. Each worker
+            handles one core and is then replaced, so memory a core used is returned to the
+            system before the next.
+    @param root     Folder of core folders.
+    @param steps    Step names to run, in order. Defaults to all of STEPS.
+    @param workers  Worker processes. Defaults to the number of CPUs.
+    @param settings Settings: threads (per worker), memory_limit_mb, force, checksum, and the
+                    steps' own settings (see STEP_SETTINGS).
+    @param progress Optional function called with each core's result as it finishes.
+    @return Summary with every core's result and the throughput.
+    """
+    steps = list(STEPS) if steps is None else steps
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown: raise ValueError(f"Unknown step(s): {', '.join(unknown)}")
+    values = {'threads': 1, 'memory_limit_mb': None, 'force': False, 'checksum': False,
+              'feather': 64, 'shading': False, 'pith': 'left', 'last_year': None}
+    values.update(settings or {})
+    workers = workers or os.cpu_count() or 1
+
+    started = time.time()
+    tasks = [(folder, name, steps, values) for folder, name in find_cores(root)]
+    results = []
+    # Spawned rather than forked workers, as on Windows, so OpenCV's threads are never forked
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(workers, max(len(tasks), 1)), _start_worker,
+                      (values['threads'], values['memory_limit_mb']), maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(process_core, tasks):
+            results.append(result)
+            if progress is not None: progress(result)
+    elapsed = time.time() - started
+
+    processed = sum(1 for result in results if result['status'] == 'done')
+    return {
+        'cores': len(results),
+        'processed': processed,
+        'skipped': sum(1 for result in results if result['status'] == 'skipped'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'elapsed_s': round(elapsed, 1),
+        'cores_per_hour': round(processed * 3600.0 / elapsed, 1) if processed and elapsed > 0 else 0.0,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Process every captured core under a folder.")
+    parser.add_argument('root', help="Folder of core folders")
+    parser.add_argument('--steps', default=','.join(STEPS),
+                        help=f"Comma-separated steps to run (default: {','.join(STEPS)})")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPUs)")
+    parser.add_argument('--threads', type=int, default=1, help="Threads per worker")
+    parser.add_argument('--memory-limit', type=int, default=None,
+                        help="Memory limit per worker in MB (Linux and macOS)")
+    parser.add_argument('--force', action='store_true', help="Reprocess cores that are up to date")
+    parser.add_argument('--checksum', action='store_true',
+                        help="Decide what is up to date from file contents instead of times")
+    parser.add_argument('--feather', type=int, default=64, help="Stitching seam blend width (px)")
+    parser.add_argument('--shading', action='store_true',
+                        help="Correct vignetting before stitching and measuring (see shading.py)")
+    parser.add_argument('--pith', choices=('left', 'right'), default='left',
+                        help="End of the images the pith is at")
+    parser.add_argument('--last-year', type=int, default=None,
+                        help="Year of the outermost complete ring (default: last year)")
+    args = parser.parse_args()
+
+    def report(result: dict) -> None:
+        steps = ', '.join(f"{step} {status}" for step, status in result['steps'].items())
+        line = f"[{time.strftime('%H:%M:%S')}] {result['core']}: {result['status']} in {result['seconds']} s"
+        if steps: line += f" ({steps})"
+        if result['error']: line += f" - {result['error']}"
+        print(line, flush=True)
+
+    summary = run_batch(args.root, args.steps.split(','), args.workers, {
+        'threads': args.threads, 'memory_limit_mb': args.memory_limit, 'force': args.force,
+        'checksum': args.checksum, 'feather': args.feather, 'shading': args.shading, 'pith': args.pith,
+        'last_year': args.last_year,
+    }, report)
+    print(f"{summary['cores']} core(s): {summary['processed']} processed, {summary['skipped']} "
+          f"up to date, {summary['failed']} failed in {summary['elapsed_s']} s "
+          f"({summary['cores_per_hour']} cores/hour)")
+    sys.exit(1 if summary['failed'] else 0)
@@ -5,7 +5,12 @@ from PyQt5.QtGui import QImage
 from PyQt5.QtWidgets import QMessageBox, QWidget
 from PIL import Image
 import cv2
+import numpy as np
 import threading
+import collections
+import queue
+from color_calibration import apply_matrix
+from encoders import make_encoder
 
 # Some code borrowed from https://stackoverflow.com/questions/44404349/pyqt-showing-video-stream-from-opencv
 
@@ -30,18 +35,32 @@ class WarningIOError(IOError):
 class WarningCameraError(WarningIOError): pass
 
 class Camera:
-    def __init__(self) -> None:
+    def __init__(self, config_path: str = "camera_configuration.yaml") -> None:
         """
         @brief Camera class that runs the camera operations and modifies camera settings.
+        @param config_path  Camera profile to load settings from and save settings to.
         """
+        self._config_path = config_path
+        self._still_saved = threading.Event()
+        self._still_saved.set()  # No still is pending
+        self._still_failed = False # A still since the last take_still_image or arm_trigger was not written
         self._hcam = None
         self._buffer = None
         self._width = 0 # Video width
         self._height = 0 # Video height
         self._cam_name = ''
         self._image = None
+        self._preview_array = None
+        self._frame_number = 0
+        self._trigger_mode = False
+        self._preview_size = None # Video resolution index to go back to after trigger mode
+        self._armed_paths = collections.deque()
+        self._triggered_paths = queue.Queue()
         self._cam_type = camera_type.UNKNOWN
         self._capture_path = ""
+        self._software_color_matrix = None # Applied to stills when the camera cannot do it
+        self._still_sink = None
+        self._hardware_color_matrix = False
         self._runtime = 0
         try:
             self.load_camera()
@@ -150,10 +169,13 @@ class Camera:
         self._hcam_linear = 0 # Optimal is 0
         self._hcam_curve = 'Polynomial' # Optimal is Polynomial
         self._hcam_image_file_format = 'jpg'
+        self._hcam_color_matrix = None # Off
+        self._hcam_encoder = None # Qt with its default quality
+        self._encoder = make_encoder()
 
     def load_camera_image_settings(self) -> None: # With code borrowed from https://stackoverflow.com/questions/1773805/how-can-i-parse-a-yaml-file-in-python
         try:
-            with open("camera_configuration.yaml", "r") as stream:
+            with open(self._config_path, "r") as stream:
                 try:
                     settings = yaml.safe_load(stream)
                     self._hcam_auto_expo = settings['auto_expo']
@@ -172,6 +194,9 @@ class Camera:
                     self._hcam_linear = settings['linear']
                     self._hcam_curve = settings['curve']
                     self._hcam_image_file_format = settings['fformat']
+                    self._hcam_color_matrix = settings.get('color_matrix') # Missing in older profiles
+                    self._hcam_encoder = settings.get('encoder')
+                    self._encoder = make_encoder(self._hcam_encoder, self._hcam_image_file_format)
                 except yaml.YAMLError as e:
                     print('YAML ERROR >', e)
                 except OSError as e:
@@ -180,6 +205,24 @@ class Camera:
             print('GENERAL ERROR >', e)
 
 
+    def load_profile(self, config_path: str) -> None:
+        """
+        @brief Switches to another camera profile and applies its settings.
+        @param config_path  Camera profile to load settings from and save settings to.
+        """
+        if config_path == self._config_path: return
+        self._config_path = config_path
+        self.reset_camera_image_settings()
+        self.load_camera_image_settings()
+        self.set_camera_image_settings()
+
+    def get_profile(self) -> str:
+        """
+        @brief Gets the camera profile in use.
+        @return Path of the profile.
+        """
+        return self._config_path
+
     def get_slider_values(self) -> tuple:
         # if not self.is_microscope(): raise ValueError("Could not load camera settings")
         return (
@@ -221,6 +264,10 @@ class Camera:
          - linear: Whether to use linear (...) or not (1/0).
          - curve: Whether to use curve (...) or not (2/1/0).
          - fformat: The image file format to save as (png/jpg).
+         - color_matrix: 3x3 color correction matrix (rows of RGB weights), see
+                         color_calibration.py, or None for no correction.
+         - encoder: How stills are written: {'backend': opencv/pillow/qt/threaded,
+                    'jpeg_quality', 'png_compression', 'tiff_compression'}, see encoders.py.
 
         """
 
@@ -270,6 +317,11 @@ class Camera:
             self._hcam_curve = kwargs.get('curve', '')
         if 'fformat' in kwargs:
             self._hcam_image_file_format = kwargs.get('fformat', '')
+        if 'color_matrix' in kwargs:
+            self._hcam_color_matrix = kwargs.get('color_matrix')
+        if 'encoder' in kwargs or 'fformat' in kwargs:
+            if 'encoder' in kwargs: self._hcam_encoder = kwargs.get('encoder')
+            self._encoder = make_encoder(self._hcam_encoder, self._hcam_image_file_format)
 
         if kwargs: print(kwargs)
         if self._runtime % 2 == 0 and self.is_microscope():
@@ -296,6 +348,40 @@ class Camera:
                 print(e)
             except AttributeError as e:
                 print(e)
+        self.apply_color_matrix()
+
+    def set_color_matrix(self, matrix) -> None:
+        """
+        @brief Sets the color correction matrix and applies it. Save the settings to keep it in the
+            profile.
+        @param matrix   3x3 matrix (nested lists or array), or None to turn correction off.
+        """
+        self._hcam_color_matrix = None if matrix is None else np.asarray(matrix, dtype=float).reshape(3, 3).tolist()
+        self.apply_color_matrix()
+
+    def get_color_matrix(self) -> list:
+        """
+        @brief Gets the color correction matrix of the profile.
+        @return 3x3 nested lists, or None if there is no correction.
+        """
+        return self._hcam_color_matrix
+
+    def apply_color_matrix(self) -> None:
+        """
+        @brief Applies the color correction matrix. The microscope applies it in hardware, to the
+            preview as well. Otherwise, e.g. on the webcam, it is applied to each still as it is
+            saved, in a single pass over the image.
+        """
+        matrix = self._hcam_color_matrix
+        self._software_color_matrix = None
+        if self.is_microscope() and (matrix is not None or self._hardware_color_matrix):
+            try:
+                self._hcam.put_ColorMatrix(np.ravel(matrix if matrix is not None else np.eye(3)).tolist())
+                self._hardware_color_matrix = matrix is not None
+                return
+            except (amcam.HRESULTException, AttributeError) as e:
+                print(e) # Not supported, correct stills in software
+        if matrix is not None: self._software_color_matrix = np.array(matrix, dtype=np.float32)
         
     def save_camera_settings(self):
         """Saves the current camera settings to a file."""
@@ -330,15 +416,19 @@ class Camera:
             'linear': self._hcam_linear,
             'curve': self._hcam_curve,
             'fformat': self._hcam_image_file_format,
+            'color_matrix': self._hcam_color_matrix,
+            'encoder': self._hcam_encoder,
         }
-        output = open("camera_configuration.yaml","w")
-        yaml.dump(settings, output)
+        with open(self._config_path, "w") as output:
+            yaml.dump(settings, output)
 
 
     @staticmethod
     def camera_callback(event, _self: 'Camera'):
         if event == amcam.AMCAM_EVENT_STILLIMAGE:
             _self.save_still_image()
+        elif event == amcam.AMCAM_EVENT_IMAGE and _self._trigger_mode:
+            _self.save_triggered_image()
         elif event == amcam.AMCAM_EVENT_IMAGE:
             _self.stream()
         elif event == amcam.AMCAM_EVENT_EXPO_START:
@@ -358,6 +448,7 @@ class Camera:
             except amcam.HRESULTException as e: print(e)
             else:
                 self._image = QImage(self._buffer, self._width, self._height, (self._width * 24 + 31) // 32 * 4, QImage.Format_RGB888)
+                self._frame_number += 1
 
             
         # Use webcam
@@ -368,6 +459,32 @@ class Camera:
                 h, w, ch = rgbImage.shape
                 bytesPerLine = ch * w
                 self._image = QImage(rgbImage.data, w, h, bytesPerLine, QImage.Format_RGB888)
+                self._preview_array = rgbImage
+                self._frame_number += 1
+
+    def get_frame_number(self) -> int:
+        """
+        @brief Gets the number of preview frames received so far, so callers can tell new frames apart.
+        """
+        return self._frame_number
+
+    def get_preview_array(self, step: int = 1) -> np.ndarray:
+        """
+        @brief Returns a copy of the most recent preview frame as an RGB array, optionally downsampled.
+
+        @param step Keep every step-th row and column.
+        @return Array of shape (height / step, width / step, 3), or None if no frame arrived yet.
+
+        """
+        if self._cam_type == camera_type.MICROSCOPE and self._buffer is not None and self._frame_number:
+            stride = (self._width * 24 + 31) // 32 * 4
+            rows = np.frombuffer(self._buffer, dtype=np.uint8).reshape(self._height, stride)
+            frame = rows[:, :self._width * 3].reshape(self._height, self._width, 3)
+        elif self._preview_array is not None:
+            frame = self._preview_array
+        else:
+            return None
+        return frame[::step, ::step].copy()
 
     def set_capture_path(self, path:str) -> None:
         """
@@ -387,13 +504,18 @@ class Camera:
 
     def take_still_image(self) -> None:
         """Takes a still image or saves an image from the webcam if the microscope is not available."""
+        self._still_failed = False
+        self._still_saved.clear()
         if self._hcam and self._cam_type == camera_type.MICROSCOPE:
             self._hcam.Snap(0) # Triggers saving with callback
         elif self._hcam and self._cam_type == camera_type.WEBCAM:
             self.save_still_image()
 
-    def save_still_image(self) -> None:
-        """Saves the captured still image to the directory stored in the camera."""
+    def save_still_image(self) -> bool:
+        """Saves the captured still image to the directory stored in the camera. Returns whether
+        it was written."""
+        still = None
+        written = False
         if self._hcam and self._cam_type == camera_type.MICROSCOPE:
             width = self._hcam.get_StillResolution(0)[0]
             height = self._hcam.get_StillResolution(0)[1]
@@ -404,26 +526,188 @@ class Camera:
                 self._hcam.PullStillImageV2(buf, 24, None)
             except amcam.HRESULTException as e: print(e)
             else:
-                img = QImage(
-                    buf,
-                    width,
-                    height,
-                    (width * 24 + 31) // 32 * 4,
-                    QImage.Format_RGB888,
-                )
+                stride = (width * 24 + 31) // 32 * 4
+                rows = np.frombuffer(buf, dtype=np.uint8, count=stride * height).reshape(height, stride)
+                still = rows[:, :width * 3].reshape(height, width, 3)
 
         elif  self._hcam and self._cam_type == camera_type.WEBCAM:
             success, frame = self._hcam.read()
             if success:
-                rgbImage = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                h, w, ch = rgbImage.shape
-                bytesPerLine = ch * w
-                img = QImage(rgbImage.data, w, h, bytesPerLine, QImage.Format_RGB888)
+                still = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         try:
-            if img:
-                img.save(self._capture_path, format=self.get_image_file_format())
+            if still is not None:
+                self.write_still(self._capture_path, still)
+                written = True
         except IOError as e:
             print(e)
+        finally:
+            if not written: self._still_failed = True
+            self._still_saved.set()
+        return written
+
+    def write_still(self, path: str, still: np.ndarray) -> None:
+        """
+        @brief Color corrects a still if the camera could not (see apply_color_matrix) and writes
+            it with the profile's encoder and file format, or hands it to the still sink.
+        @param path     The path to the file.
+        @param still    RGB image.
+        """
+        if self._software_color_matrix is not None: still = apply_matrix(still, self._software_color_matrix)
+        if self._still_sink is not None: self._still_sink(path, still)
+        else: self._encoder.write(path, still, self.get_image_file_format())
+
+    def set_still_sink(self, sink) -> None:
+        """
+        @brief Hands stills to a function instead of writing them to files, e.g. to store them in
+            a session container.
+        @param sink Function called with (path, RGB image) for each still, raising IOError if it
+            could not keep it, or None to write files again.
+        """
+        self._still_sink = sink
+
+    def set_trigger_mode(self, enabled: bool) -> None:
+        """
+        @brief Switches between the live preview and external trigger mode. In trigger mode the
+            microscope only sends a frame when its trigger input is pulsed (by the arduino), and
+            that frame is saved to the path given to arm_trigger. The preview stops meanwhile.
+            Triggered frames come from the video stream, so the video is switched to the still
+            resolution for trigger mode and back to the preview resolution afterwards.
+
+        @param enabled True for external trigger mode, false for the live preview.
+
+        """
+        self._trigger_mode = enabled
+        self._armed_paths.clear()
+        self._triggered_paths = queue.Queue()
+        if self._hcam and self._cam_type == camera_type.MICROSCOPE:
+            try:
+                if enabled and self._preview_size is None:
+                    self._preview_size = self._hcam.get_eSize()
+                    self.set_video_size(self.still_size_index())
+                elif not enabled and self._preview_size is not None:
+                    self.set_video_size(self._preview_size)
+                    self._preview_size = None
+                if enabled:
+                    self._hcam.IoControl(0, amcam.AMCAM_IOCONTROLTYPE_SET_TRIGGERSOURCE, 0) # Opto-isolated input
+                    self._hcam.IoControl(0, amcam.AMCAM_IOCONTROLTYPE_SET_INPUTACTIVATION, 0) # Rising edge
+                self._hcam.put_Option(amcam.AMCAM_OPTION_TRIGGER, 2 if enabled else 0)
+            except amcam.HRESULTException as e: print(e)
+
+    def is_trigger_mode(self) -> bool: return self._trigger_mode
+
+    def still_size_index(self) -> int:
+        """
+        @brief Finds the video resolution that matches the still resolution.
+
+        @return Resolution index for put_eSize. The largest (0) if none matches.
+
+        """
+        still = self._hcam.get_StillResolution(0)
+        for index in range(self._hcam.ResolutionNumber()):
+            if self._hcam.get_Resolution(index) == still: return index
+        return 0
+
+    def set_video_size(self, index: int) -> None:
+        """
+        @brief Changes the microscope's video resolution. The camera only takes a new resolution
+            while stopped, so the stream is restarted.
+
+        @param index Resolution index, see the table above take_still_image.
+
+        """
+        self._hcam.Stop()
+        self._hcam.put_eSize(index)
+        self._width, self._height = self._hcam.get_Size()
+        self._buffer = bytes(((self._width * 24 + 31) // 32 * 4) * self._height)
+        self._hcam.StartPullModeWithCallback(self.camera_callback, self)
+
+    def arm_trigger(self, path: str) -> None:
+        """
+        @brief Adds a path for a triggered frame to be saved to. Triggered frames are saved to the
+            armed paths in order. wait_for_still_image waits until every armed frame is saved, and
+            wait_for_triggered_image waits for the next one.
+
+        @param path The path to the file.
+
+        """
+        if self._still_saved.is_set(): self._still_failed = False # Nothing else is pending
+        self._still_saved.clear()
+        self._armed_paths.append(path)
+
+    def save_triggered_image(self) -> None:
+        """Saves a frame sent because of a hardware trigger. Frames that arrive unarmed only
+        update the preview."""
+        try:
+            self._capture_path = self._armed_paths.popleft()
+        except IndexError:
+            self.stream()
+            return
+        written = False
+        try:
+            if self._cam_type != camera_type.MICROSCOPE:
+                written = self.save_still_image() # The webcam has no trigger input, save the current frame
+            else:
+                self.stream() # Trigger mode runs the video at still resolution
+                if self._image:
+                    self.write_still(self._capture_path, self.get_preview_array())
+                    written = True
+        except IOError as e:
+            print(e)
+        finally:
+            if not written: self._still_failed = True
+            self._triggered_paths.put(self._capture_path if written else None)
+            if not self._armed_paths: self._still_saved.set()
+
+    def wait_for_triggered_image(self, timeout: float = None) -> str:
+        """
+        @brief Waits for the next armed frame to be saved.
+
+        @param timeout Maximum seconds to wait, or None to wait forever.
+        @return The frame's path, or None if the wait timed out or the frame could not be written.
+
+        """
+        try:
+            return self._triggered_paths.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_exposure_time(self) -> float:
+        """
+        @brief Gets how long one frame is exposed for.
+
+        @return Seconds. The webcam's exposure is unknown, so one frame at 30 fps is assumed.
+
+        """
+        if self._hcam and self._cam_type == camera_type.MICROSCOPE:
+            try:
+                return self._hcam.get_ExpoTime() / 1e6
+            except amcam.HRESULTException as e: print(e)
+        return 1 / 30
+
+    def get_pixel_size(self) -> tuple:
+        """
+        @brief Gets the size of the sensor's pixels at the still resolution.
+
+        @return (width, height) in um, or None if the camera does not report it (webcam).
+
+        """
+        if self._hcam and self._cam_type == camera_type.MICROSCOPE:
+            try:
+                return self._hcam.get_PixelSize(0)
+            except amcam.HRESULTException as e: print(e)
+        return None
+
+    def wait_for_still_image(self, timeout: float = None) -> bool:
+        """
+        @brief Waits until the still image requested by take_still_image (or every armed frame)
+            has been saved.
+
+        @param timeout Maximum seconds to wait, or None to wait forever.
+        @return True if the stills were written, false if the wait timed out or one could not be
+            written.
+
+        """
+        return self._still_saved.wait(timeout) and not self._still_failed
 
     def get_image(self) -> QImage:
         """
@@ -0,0 +1,157 @@
+import sys, time, argparse
+import cv2
+import numpy as np
+import yaml
+
+# sRGB values of the 24 patches of a ColorChecker Classic chart, row by row from the brown patch
+COLORCHECKER_24 = [
+    (115, 82, 68), (194, 150, 130), (98, 122, 157), (87, 108, 67), (133, 128, 177), (103, 189, 170),
+    (214, 126, 44), (80, 91, 166), (193, 90, 99), (94, 60, 108), (157, 188, 64), (224, 163, 46),
+    (56, 61, 150), (70, 148, 73), (175, 54, 60), (231, 199, 31), (187, 86, 149), (8, 133, 161),
+    (243, 243, 242), (200, 200, 200), (160, 160, 160), (122, 122, 121), (85, 85, 85), (52, 52, 52),
+]
+
+
+def load_reference(path: str = None) -> tuple:
+    """
+    @brief  Loads the layout and colors of a reference target.
+    @param path YAML file with the target's 'rows', 'cols' and the sRGB 'colors' of its patches
+                row by row. If None, a ColorChecker Classic (4 x 6) is assumed.
+    @return (rows, cols, colors) tuple, colors as an N x 3 array.
+    """
+    if path is None: return 4, 6, np.array(COLORCHECKER_24, dtype=np.float64)
+    with open(path, "r") as stream:
+        target = yaml.safe_load(stream)
+    colors = np.array(target['colors'], dtype=np.float64).reshape(-1, 3)
+    if len(colors) != target['rows'] * target['cols']:
+        raise ValueError(f"{path} has {len(colors)} colors for {target['rows']} x {target['cols']} patches")
+    return target['rows'], target['cols'], colors
+
+
+def sample_patches(image: np.ndarray, rows: int, cols: int, box: tuple = None,
+                   inset: float = 0.25) -> np.ndarray:
+    """
+    @brief  Measures the mean color of each patch of a target photographed square to the camera.
+    @param image    RGB image of the target.
+    @param rows     Rows of patches.
+    @param cols     Columns of patches.
+    @param box      (left, top, right, bottom) edges of the patch grid as fractions of the image.
+                    Defaults to the whole image.
+    @param inset    Fraction of each patch left out at every edge, so the borders between patches
+                    and small misalignments are not measured.
+    @return rows * cols x 3 array of mean colors, row by row.
+    """
+    height, width = image.shape[:2]
+    left, top, right, bottom = box if box is not None else (0.0, 0.0, 1.0, 1.0)
+    xs = np.linspace(left * width, right * width, cols + 1)
+    ys = np.linspace(top * height, bottom * height, rows + 1)
+    patches = []
+    for row in range(rows):
+        for col in range(cols):
+            x0, x1 = xs[col], xs[col + 1]
+            y0, y1 = ys[row], ys[row + 1]
+            dx, dy = (x1 - x0) * inset, (y1 - y0) * inset
+            patch = image[int(y0 + dy):int(np.ceil(y1 - dy)), int(x0 + dx):int(np.ceil(x1 - dx))]
+            patches.append(patch.reshape(-1, 3).mean(axis=0))
+    return np.array(patches)
+
+
+def solve_matrix(measured: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """
+    @brief  Finds the 3 x 3 color correction matrix that maps the measured patch colors closest
+            to the reference colors (least squares). Patches that are clipped in the measurement
+            are left out, as their true color is unknown.
+    @param measured     N x 3 measured colors (0~255).
+    @param reference    N x 3 reference colors (0~255).
+    @return 3 x 3 matrix M such that corrected = M @ measured for each pixel.
+    """
+    usable = np.all((measured > 2) & (measured < 253), axis=1)
+    if usable.sum() < 3: raise ValueError("Fewer than 3 patches are correctly exposed")
+    solution, _, _, _ = np.linalg.lstsq(measured[usable], reference[usable], rcond=None)
+    return solution.T
+
+
+def apply_matrix(image: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """
+    @brief  Color corrects an 8 bit image in one pass, saturating at 0 and 255.
+    @param image    RGB image (H x W x 3, uint8).
+    @param matrix   3 x 3 matrix from solve_matrix.
+    @return Corrected image.
+    """
+    return cv2.transform(image, np.asarray(matrix, dtype=np.float32))
+
+
+def color_error(measured: np.ndarray, reference: np.ndarray) -> float:
+    """
+    @brief  Root mean square distance between measured and reference patch colors (0~255 units).
+    """
+    return float(np.sqrt(np.mean(np.sum((measured - reference) ** 2, axis=1))))
+
+
+def calibrate(image: np.ndarray, reference: str = None, box: tuple = None) -> dict:
+    """
+    @brief  Solves the color correction of a camera from a picture of a reference target.
+    @param image        RGB picture of the target, taken without color correction.
+    @param reference    Target file for load_reference, or None for a ColorChecker Classic.
+    @param box          Edges of the patch grid, see sample_patches.
+    @return Dictionary with the 'matrix' (nested lists) and the patch color error 'before' and
+            'after' correcting.
+    """
+    rows, cols, colors = load_reference(reference)
+    measured = sample_patches(image, rows, cols, box)
+    matrix = solve_matrix(measured, colors)
+    return {
+        'matrix': np.round(matrix, 5).tolist(),
+        'before': round(color_error(measured, colors), 2),
+        'after': round(color_error(np.clip(measured @ matrix.T, 0, 255), colors), 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Solve a camera's color correction matrix from a "
+                                                 "picture of a reference target and save it to a "
+                                                 "camera profile.")
+    parser.add_argument('image', nargs='?', help="Picture of the target. Without one, the target "
+                                                 "is photographed with the profile's camera")
+    parser.add_argument('--profile', default="camera_configuration.yaml", help="Camera profile")
+    parser.add_argument('--reference', default=None,
+                        help="Target file with rows, cols and colors (default: ColorChecker Classic)")
+    parser.add_argument('--box', type=float, nargs=4, default=None,
+                        metavar=('LEFT', 'TOP', 'RIGHT', 'BOTTOM'),
+                        help="Edges of the patch grid as fractions of the picture (default: all of it)")
+    parser.add_argument('--dry-run', action='store_true', help="Do not save the matrix")
+    args = parser.parse_args()
+
+    if args.image:
+        picture = cv2.imread(args.image)
+        if picture is None:
+            print(f"ERROR Could not read {args.image}", file=sys.stderr)
+            sys.exit(1)
+        picture = cv2.cvtColor(picture, cv2.COLOR_BGR2RGB)
+    else:
+        from camera import Camera
+        camera = Camera(args.profile)
+        try:
+            camera.set_color_matrix(None)  # Photograph the target uncorrected
+            frame = camera.get_frame_number()
+            started = time.time()
+            while camera.get_frame_number() < frame + 3 and time.time() - started < 10.0:
+                time.sleep(0.05)
+            picture = camera.get_preview_array()
+        finally:
+            camera.close()
+        if picture is None:
+            print("ERROR The camera sent no picture", file=sys.stderr)
+            sys.exit(1)
+
+    result = calibrate(picture, args.reference, args.box)
+    print(f"Patch color error {result['before']} before and {result['after']} after correcting")
+    print("Matrix:")
+    for row in result['matrix']: print("  " + "  ".join(f"{value:8.4f}" for value in row))
+    if not args.dry_run:
+        with open(args.profile, "r") as stream:
+            settings = yaml.safe_load(stream) or {}
+        settings['color_matrix'] = result['matrix']
+        with open(args.profile, "w") as output:
+            yaml.dump(settings, output)
+        print(f"Saved to {args.profile}")
@@ -0,0 +1,308 @@
+import os, sys, time, zlib, struct, tempfile, argparse
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+# libtiff compression codes
+TIFF_COMPRESSION = {'none': 1, 'lzw': 5, 'deflate': 8, 'zstd': 50000}
+FORMATS = {'jpg': 'jpg', 'jpeg': 'jpg', 'tif': 'tif', 'tiff': 'tif', 'png': 'png'}
+
+
+class Encoder:
+    name = None
+
+    def __init__(self, jpeg_quality: int = None, png_compression: int = None,
+                 tiff_compression: str = None) -> None:
+        """
+        @brief  Writes stills to image files with explicit quality and compression settings.
+                Settings left as None use the library's own default.
+        @param jpeg_quality     JPEG quality (0~100).
+        @param png_compression  PNG zlib compression level (0~9). Low levels are much faster and
+                                only slightly bigger.
+        @param tiff_compression TIFF compression: none, lzw, deflate or zstd (all lossless).
+        """
+        if tiff_compression is not None and tiff_compression not in TIFF_COMPRESSION:
+            raise ValueError(f"Unknown TIFF compression {tiff_compression}, "
+                             f"use one of {', '.join(TIFF_COMPRESSION)}")
+        self.jpeg_quality = jpeg_quality
+        self.png_compression = png_compression
+        self.tiff_compression = tiff_compression
+
+    def settings(self) -> dict:
+        """
+        @brief  Gets the encoder's settings as they are kept in a camera profile.
+        """
+        return {'backend': self.name, 'jpeg_quality': self.jpeg_quality,
+                'png_compression': self.png_compression, 'tiff_compression': self.tiff_compression}
+
+    def write(self, path: str, image: np.ndarray, fformat: str) -> None:
+        """
+        @brief  Writes an image to a file.
+        @param path     File to write.
+        @param image    RGB image (H x W x 3, uint8). Rows may be padded.
+        @param fformat  File format: jpg, jpeg, tif, tiff or png.
+        @exception IOError  If the file could not be written.
+        """
+        raise NotImplementedError
+
+    def supports(self, fformat: str) -> bool:
+        """
+        @brief  Checks that this encoder can write a format with its settings, e.g. that its
+                libtiff was built with the TIFF compression asked for.
+        """
+        path = os.path.join(tempfile.gettempdir(), f"encoder_check_{os.getpid()}.{FORMATS[fformat]}")
+        try:
+            self.write(path, np.zeros((8, 8, 3), dtype=np.uint8), fformat)
+            return cv2.imread(path) is not None
+        except (IOError, ValueError, KeyError):
+            return False
+        finally:
+            if os.path.exists(path): os.remove(path)
+
+
+class OpenCVEncoder(Encoder):
+    name = 'opencv'
+
+    def write(self, path: str, image: np.ndarray, fformat: str) -> None:
+        fformat = FORMATS[fformat]
+        params = []
+        if fformat == 'jpg' and self.jpeg_quality is not None:
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(self.jpeg_quality)]
+        elif fformat == 'png' and self.png_compression is not None:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(self.png_compression)]
+        elif fformat == 'tif' and self.tiff_compression is not None:
+            params = [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION[self.tiff_compression]]
+        if not cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params):
+            raise IOError(f"OpenCV could not write {path}")
+
+
+class PillowEncoder(Encoder):
+    name = 'pillow'
+    _TIFF_COMPRESSION = {'none': 'raw', 'lzw': 'tiff_lzw', 'deflate': 'tiff_adobe_deflate', 'zstd': 'zstd'}
+
+    def write(self, path: str, image: np.ndarray, fformat: str) -> None:
+        from PIL import Image
+        fformat = FORMATS[fformat]
+        options = {}
+        if fformat == 'jpg' and self.jpeg_quality is not None: options['quality'] = int(self.jpeg_quality)
+        elif fformat == 'png' and self.png_compression is not None:
+            options['compress_level'] = int(self.png_compression)
+        elif fformat == 'tif' and self.tiff_compression is not None:
+            options['compression'] = self._TIFF_COMPRESSION[self.tiff_compression]
+        try:
+            Image.fromarray(np.ascontiguousarray(image)).save(
+                path, format={'jpg': 'JPEG', 'png': 'PNG', 'tif': 'TIFF'}[fformat], **options)
+        except (OSError, KeyError, ValueError) as e:
+            raise IOError(f"Pillow could not write {path}: {e}")
+
+
+class QtEncoder(Encoder):
+    name = 'qt'
+
+    def write(self, path: str, image: np.ndarray, fformat: str) -> None:
+        from PyQt5.QtGui import QImage, QImageWriter
+        fformat = FORMATS[fformat]
+        image = np.ascontiguousarray(image)
+        writer = QImageWriter(path, fformat.encode())
+        if fformat == 'jpg' and self.jpeg_quality is not None: writer.setQuality(int(self.jpeg_quality))
+        elif fformat == 'png' and self.png_compression is not None:
+            writer.setQuality(int(round((9 - self.png_compression) * 100 / 9)))  # Qt: 0 is smallest
+        elif fformat == 'tif' and self.tiff_compression is not None:
+            if self.tiff_compression not in ('none', 'lzw'):
+                raise IOError(f"Qt cannot write {self.tiff_compression} TIFF")
+            writer.setCompression(1 if self.tiff_compression == 'lzw' else 0)
+        qimage = QImage(image.data, image.shape[1], image.shape[0], image.shape[1] * 3,
+                        QImage.Format_RGB888)
+        if not writer.write(qimage):
+            raise IOError(f"Qt could not write {path}: {writer.errorString()}")
+
+
+def write_tiff(path: str, image: np.ndarray, compress: bool = True, level: int = 1,
+               workers: int = None, rows_per_strip: int = 64) -> None:
+    """
+    @brief  Writes an RGB image as a baseline TIFF whose strips are deflate compressed in
+            parallel. Each strip is compressed on its own, and zlib releases the interpreter while
+            it compresses, so the strips are spread over the CPU cores. The horizontal
+            differencing predictor makes photographs compress much better.
+    @param path             File to write.
+    @param image            RGB image (H x W x 3, uint8).
+    @param compress         Deflate compress the strips, otherwise they are stored as they are.
+    @param level            zlib compression level (1~9).
+    @param workers          Compression threads. Defaults to the number of CPUs.
+    @param rows_per_strip   Image rows in each strip.
+    """
+    height, width = image.shape[:2]
+    starts = range(0, height, rows_per_strip)
+
+    def encode(start: int) -> bytes:
+        strip = image[start:start + rows_per_strip]
+        if not compress: return np.ascontiguousarray(strip).tobytes()
+        difference = strip.copy()
+        difference[:, 1:] -= strip[:, :-1]  # Predictor 2, wrapping like the TIFF decoder
+        return zlib.compress(difference.tobytes(), level)
+
+    offsets, counts = [], []
+    with open(path, 'wb') as stream:
+        stream.write(b'II*\x00\x00\x00\x00\x00')  # IFD offset is filled in at the end
+        with ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+            for strip in executor.map(encode, starts):
+                offsets.append(stream.tell())
+                counts.append(len(strip))
+                stream.write(strip)
+
+        def array(kind: str, values: list) -> int:
+            if stream.tell() % 2: stream.write(b'\x00')  # Values start on a word boundary
+            offset = stream.tell()
+            stream.write(struct.pack(f'<{len(values)}{kind}', *values))
+            return offset
+
+        SHORT, LONG = 3, 4
+        entries = [(256, LONG, 1, width), (257, LONG, 1, height),
+                   (258, SHORT, 3, array('H', [8, 8, 8])), (259, SHORT, 1, 8 if compress else 1),
+                   (262, SHORT, 1, 2),  # RGB
+                   (273, LONG, len(offsets), array('I', offsets) if len(offsets) > 1 else offsets[0]),
+                   (277, SHORT, 1, 3), (278, LONG, 1, rows_per_strip),
+                   (279, LONG, len(counts), array('I', counts) if len(counts) > 1 else counts[0]),
+                   (284, SHORT, 1, 1)]  # Interleaved samples
+        if compress: entries.append((317, SHORT, 1, 2))  # Horizontal differencing predictor
+        if stream.tell() % 2: stream.write(b'\x00')
+        ifd = stream.tell()
+        stream.write(struct.pack('<H', len(entries)))
+        for tag, kind, count, value in entries:
+            packed = struct.pack('<H', value) + b'\x00\x00' if kind == SHORT and count == 1 \
+                else struct.pack('<I', value)
+            stream.write(struct.pack('<HHI', tag, kind, count) + packed)
+        stream.write(struct.pack('<I', 0))  # No further images
+        stream.seek(4)
+        stream.write(struct.pack('<I', ifd))
+
+
+class ThreadedEncoder(PillowEncoder):
+    name = 'threaded'
+
+    def __init__(self, jpeg_quality: int = None, png_compression: int = None,
+                 tiff_compression: str = None, threads: int = None) -> None:
+        """
+        @brief  Uses the fastest writer for each format: write_tiff for uncompressed and deflate
+                TIFFs, compressing on several threads, OpenCV for PNGs and Pillow, whose
+                libjpeg-turbo is the fastest JPEG encoder here, for everything else. See Encoder
+                for the settings.
+        @param threads  Compression threads. Defaults to the number of CPUs.
+        """
+        super().__init__(jpeg_quality, png_compression, tiff_compression)
+        self.threads = threads
+
+    def settings(self) -> dict:
+        return dict(super().settings(), threads=self.threads)
+
+    def write(self, path: str, image: np.ndarray, fformat: str) -> None:
+        if FORMATS[fformat] == 'png': return OpenCVEncoder.write(self, path, image, fformat)
+        if FORMATS[fformat] != 'tif' or self.tiff_compression not in (None, 'none', 'deflate'):
+            return super().write(path, image, fformat)
+        try:
+            write_tiff(path, image, self.tiff_compression == 'deflate', workers=self.threads)
+        except OSError as e:
+            raise IOError(f"Could not write {path}: {e}")
+
+
+ENCODERS = {encoder.name: encoder for encoder in (OpenCVEncoder, PillowEncoder, QtEncoder, ThreadedEncoder)}
+
+
+def make_encoder(settings: dict = None, fformat: str = None) -> Encoder:
+    """
+    @brief  Creates the encoder a camera profile asks for.
+    @param settings Profile's 'encoder' settings: 'backend' (opencv, pillow, qt or threaded)
+                    and the arguments of its class. None gives Qt with its defaults, as older profiles used.
+    @param fformat  Format the profile saves in. If the encoder cannot write it with these
+                    settings, the same settings without a TIFF compression are used instead.
+    @return Encoder.
+    """
+    settings = dict(settings or {})
+    backend = settings.pop('backend', 'qt')
+    if backend not in ENCODERS:
+        print(f"Unknown encoder {backend}, using qt")
+        backend = 'qt'
+    options = ('jpeg_quality', 'png_compression', 'tiff_compression')
+    if backend == 'threaded': options += ('threads',)
+    encoder = ENCODERS[backend](**{key: value for key, value in settings.items() if key in options})
+    if fformat in FORMATS and FORMATS[fformat] == 'tif' and encoder.tiff_compression not in (None, 'none') \
+            and not encoder.supports(fformat):
+        print(f"The {backend} encoder cannot write {encoder.tiff_compression} TIFF here, "
+              f"writing them uncompressed")
+        encoder.tiff_compression = 'none'
+    return encoder
+
+
+def benchmark(image: np.ndarray, candidates: list, repeats: int = 3) -> list:
+    """
+    @brief  Times encoders on an image.
+    @param image        RGB image.
+    @param candidates   List of (encoder, format) tuples.
+    @param repeats      Writes per candidate. The fastest is reported.
+    @return List of dictionaries with the 'encoder' settings, 'format', 'seconds' per still and
+            the file size in 'megabytes', or 'error' if the encoder cannot write it.
+    """
+    results = []
+    folder = tempfile.mkdtemp(prefix='encoder_benchmark_')
+    for encoder, fformat in candidates:
+        path = os.path.join(folder, f"still.{FORMATS[fformat]}")
+        result = {'encoder': encoder.settings(), 'format': fformat}
+        try:
+            times = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                encoder.write(path, image, fformat)
+                times.append(time.perf_counter() - started)
+            result['seconds'] = min(times)
+            result['megabytes'] = os.path.getsize(path) / 1e6
+        except IOError as e:
+            result['error'] = str(e)
+        if os.path.exists(path): os.remove(path)
+        results.append(result)
+    os.rmdir(folder)
+    return results
+
+
+def _default_candidates() -> list:
+    candidates = []
+    for backend in ENCODERS:
+        candidates.append((ENCODERS[backend](), 'jpg'))
+        candidates.append((ENCODERS[backend](jpeg_quality=95), 'jpg'))
+        for level in (1, 6):
+            candidates.append((ENCODERS[backend](png_compression=level), 'png'))
+        for compression in TIFF_COMPRESSION:
+            candidates.append((ENCODERS[backend](tiff_compression=compression), 'tif'))
+    return candidates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the encode time and file size of the "
+                                                 "still encoders and formats.")
+    parser.add_argument('image', nargs='?', help="Still to encode (default: a simulated 10 MP core "
+                                                 "picture; real pictures compress differently)")
+    parser.add_argument('--repeats', type=int, default=3, help="Writes per encoder and format")
+    args = parser.parse_args()
+
+    if args.image:
+        still = cv2.imread(args.image)
+        if still is None:
+            print(f"ERROR Could not read {args.image}", file=sys.stderr)
+            sys.exit(1)
+        still = cv2.cvtColor(still, cv2.COLOR_BGR2RGB)
+    else:
+        from simulation import SyntheticCore
+        still = cv2.cvtColor(SyntheticCore().render(10.0, 3584, 2748, 400.0), cv2.COLOR_BGR2RGB)
+        noise = np.random.default_rng(0).normal(0, 2, still.shape)  # Limits lossless compression
+        still = np.clip(still + noise, 0, 255).astype(np.uint8)
+    print(f"{still.shape[1]} x {still.shape[0]} still, {still.nbytes / 1e6:.1f} MB raw")
+    print(f"{'encoder':>8}  {'format':>6}  {'setting':>12}  {'ms':>8}  {'MB':>7}")
+    for result in benchmark(still, _default_candidates(), args.repeats):
+        settings = result['encoder']
+        setting = {'jpg': f"quality {settings['jpeg_quality']}",
+                   'png': f"level {settings['png_compression']}",
+                   'tif': f"{settings['tiff_compression']}"}[result['format']].replace('None', 'default')
+        if 'error' in result:
+            print(f"{settings['backend']:>8}  {result['format']:>6}  {setting:>12}  {'unsupported':>17}")
+        else:
+            print(f"{settings['backend']:>8}  {result['format']:>6}  {setting:>12}  "
+                  f"{result['seconds'] * 1000:>8.0f}  {result['megabytes']:>7.2f}")
@@ -1,12 +1,17 @@
 import sys, time, os
 import threading
 from PyQt5.QtWidgets import  QWidget, QLabel, QCheckBox, QSlider, QApplication, QPushButton, QGridLayout, QLineEdit,\
-QMessageBox, QHBoxLayout, QComboBox
-from PyQt5.QtCore import QThread, Qt, pyqtSignal, pyqtSlot
-from PyQt5.QtGui import QCloseEvent, QImage, QPixmap, QFont
+QMessageBox, QHBoxLayout, QComboBox, QListWidget, QListWidgetItem, QListView, QScrollArea
+from PyQt5.QtCore import QThread, Qt, QSize, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QCloseEvent, QImage, QPixmap, QFont, QIcon, QColor, QPainter
 from tkinter.filedialog import askdirectory
+import cv2
 from camera import Camera, CriticalIOError
 from automationScript import Automation
+from job_queue import JobQueue, CoreJob
+from thumbnails import read_pack, latest_records, THUMBNAIL_WIDTH
+from quality import QualityChecker
+from session_container import read_frame
 
 class InvalidFolderError(Exception):
     def __init__(self, message: str) -> None:
@@ -22,17 +27,72 @@ class video_stream_thread(QThread):
         super().__init__()
         self.camera = camera
     
-    # Signal to trigger change in main GUI
-    change_image = pyqtSignal(QImage)
+    # Signal to trigger change in main GUI, with the frame number
+    change_image = pyqtSignal(QImage, int)
 
     def run(self):
+        previous_frame = None
         while True:
+            frame_number = self.camera.get_frame_number()
             image = self.camera.get_image()  # Converted to QT format
-            if image:
-                scaled_image = image.scaled(640, 480, Qt.KeepAspectRatio)
-                self.change_image.emit(scaled_image)
+            # Only new frames are sent, so the GUI does not redraw the same one. They are sent
+            # as they are: PreviewWidget scales them as it draws, so nothing is copied per frame.
+            if image and frame_number != previous_frame:
+                previous_frame = frame_number
+                self.change_image.emit(image, frame_number)
             time.sleep(0.01)  # Required to be slower than camera
 
+class PreviewWidget(QWidget):
+    def __init__(self, parent: QWidget = None) -> None:
+        """
+        @brief Shows the video stream. The latest frame is kept as it arrives and drawn straight
+            from paintEvent in one scaled draw, so no QPixmap is made per frame, and frames that
+            arrive between two repaints only cost one repaint.
+        @param parent Parent widget.
+        """
+        super().__init__(parent)
+        self._image = None
+        self._frame_number = None
+        self._bounds = QSize(640, 480)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)  # Every pixel is drawn by paintEvent
+        self.setFixedSize(0, 0)
+
+    def set_bounds(self, width: int, height: int) -> None:
+        """
+        @brief Sets the largest size the frames are shown at, keeping their aspect ratio.
+        """
+        self._bounds = QSize(width, height)
+        self.fit()
+
+    def set_frame(self, image: QImage, frame_number: int) -> None:
+        """
+        @brief Shows a frame. Returns immediately, the frame is drawn on the next repaint.
+        @param image        Frame at the camera's resolution. Only a reference is kept, and the
+                            QImage keeps the camera's buffer alive.
+        @param frame_number Camera frame number. A frame already shown is ignored.
+        """
+        if frame_number == self._frame_number or image.isNull(): return
+        self._image, self._frame_number = image, frame_number
+        self.fit()
+        self.update()
+
+    def fit(self) -> None:
+        """
+        @brief Sizes the widget to the frame scaled into the bounds.
+        """
+        if self._image is None: return
+        size = self._image.size().scaled(self._bounds, Qt.KeepAspectRatio)
+        if size != self.size(): self.setFixedSize(size)
+
+    def paintEvent(self, event) -> None:
+        """
+        @brief Draws the latest frame. Part of QWidget and called by pyqt (name can NOT be changed).
+        """
+        if self._image is None: return
+        painter = QPainter(self)
+        painter.drawImage(self.rect(), self._image)
+        painter.end()
+
 class automation_listening_thread(QThread):
     def __init__(self, automation: Automation) -> None:
         """
@@ -44,12 +104,32 @@ class automation_listening_thread(QThread):
 
     automation_status = pyqtSignal(bool)
     automation_message = pyqtSignal(str)
+    pause_status = pyqtSignal(bool)
+    panorama_image = pyqtSignal(QImage)
 
     def run(self): 
         previous_message = ""
+        previous_pause = False
+        previous_panorama = None
         
         while True: 
 
+            # Live panorama of the run, converted here so the GUI thread only displays it
+            panorama = self.Automation.get_live_panorama()
+            if panorama.get_version() != previous_panorama:
+                previous_panorama = panorama.get_version()
+                image = panorama.get_image()
+                if image is None: self.panorama_image.emit(QImage())
+                else:
+                    rgbImage = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    h, w, ch = rgbImage.shape
+                    self.panorama_image.emit(QImage(rgbImage.data, w, h, ch * w, QImage.Format_RGB888).copy())
+
+            # Automation can pause itself, e.g. between cores of a queue
+            if self.Automation.is_paused() != previous_pause:
+                previous_pause = self.Automation.is_paused()
+                self.pause_status.emit(previous_pause)
+
             current_message = self.Automation.get_automation_status()
             # Prevents app from slowing down by only setting message on change
             if current_message != previous_message:
@@ -77,6 +157,7 @@ class GUI(QWidget):
         self.height = 480
         
         self.image_name = "tree-core"  # Default value
+        self.job_queue = JobQueue("job_queue.yaml")
         self.capture_path = self.capture_path = os.path.expanduser('~/Desktop')  # Default to desktop
         self.initial_image_number = 0
                 
@@ -100,19 +181,34 @@ class GUI(QWidget):
             self.Automation = Automation(self.camera)
         except CriticalIOError as e:
             raise e
+        if self.Automation.get_connection_error() is not None:
+            QMessageBox.critical(None, "Error Encountered",
+                                 self.Automation.get_connection_error(), QMessageBox.Ok)
         self.camera_options_widget = None
         self.initUI()
 
-    @pyqtSlot(QImage)
-    def set_image(self, image: QPixmap) -> None:
+    @pyqtSlot(QImage, int)
+    def set_image(self, image: QImage, frame_number: int) -> None:
         """
         @brief Sets the image from the camera in the GUI so a stream shows.
-        @param image Image from the video_stream_thread.
+        @param image        Image from the video_stream_thread.
+        @param frame_number Camera frame number of the image.
         """
+        self.video_label.set_frame(image, frame_number)
     
-        image = image.scaled(self.video_width, self.video_height, Qt.KeepAspectRatio)
-        self.video_label.setPixmap(QPixmap.fromImage(image))
-    
+    @pyqtSlot(QImage)
+    def set_panorama(self, image: QImage) -> None:
+        """
+        @brief Shows the live panorama of the run below the video stream. Red lines mark gaps
+            between pictures, yellow lines seams that did not register.
+        @param image Panorama from the automation_listening_thread.
+        """
+        if image.isNull():
+            self.panorama_label.clear()
+            return
+        image = image.scaled(self.video_width, self.panorama_label.height(), Qt.KeepAspectRatio)
+        self.panorama_label.setPixmap(QPixmap.fromImage(image))
+
     @pyqtSlot(bool)
     def change_automation_status(self, value: bool) -> None :
         """
@@ -123,6 +219,15 @@ class GUI(QWidget):
             self.start_stop_button.setText("Stop Automation")
         else:
             self.start_stop_button.setText("Start Automation")
+        self.update_queue_button()
+
+    @pyqtSlot(bool)
+    def change_pause_status(self, value: bool) -> None :
+        """
+        @brief Sets the pause button text from the Automation Script
+        @param value Pause status from the automation_listening_thread.
+        """
+        self.pause_play_button.setText("Play" if value else "Pause")
 
     @pyqtSlot(str)
     def change_automation_message(self, value: str) -> None :
@@ -177,7 +282,7 @@ class GUI(QWidget):
         self.right_side = QWidget()
         self.right_grid = QGridLayout(self.right_side)
         self.grid.addWidget(self.right_side, 0, 6, 3, 1)
-        self.right_side.setFixedHeight(300)
+        self.right_side.setFixedHeight(340)
 
         # Title
         self.title_label = QLabel(self.title, self)
@@ -185,13 +290,19 @@ class GUI(QWidget):
         self.title_label.setStyleSheet('QLabel { font-size: 30pt;}')
 
         # Video label for displaying the stream
-        self.video_label = QLabel(self)
+        self.video_label = PreviewWidget(self)
+        self.video_label.set_bounds(self.video_width, self.video_height)
         self.grid.addWidget(self.video_label, 1, 0, 1, 5, Qt.AlignCenter )  # Spanning 6 columns
 
         # Automation Messages
         self.message_label = QLabel(self)
         self.grid.addWidget(self.message_label, 2, 1, 1, 5, Qt.AlignCenter)
 
+        # Live panorama of the run
+        self.panorama_label = QLabel(self)
+        self.panorama_label.setFixedHeight(120)
+        self.grid.addWidget(self.panorama_label, 3, 0, 1, 5, Qt.AlignCenter)
+
         # Create Image Path Selection Button
         self.path_button = QPushButton(self)
         self.path_button.setText("Set Image Path")
@@ -246,11 +357,18 @@ class GUI(QWidget):
         # Create Automation buttons
         self.single_picture_button = QPushButton(self)
         self.single_picture_button.setText("Take Single Image")
-        self.right_grid.addWidget(self.single_picture_button, 6, 0, 1, 2)
+        self.right_grid.addWidget(self.single_picture_button, 6, 0, 1, 1)
         self.single_picture_button.clicked.connect(
             lambda: self.take_single_image()
         )
 
+        self.resume_button = QPushButton(self)
+        self.resume_button.setText("Resume Automation")
+        self.right_grid.addWidget(self.resume_button, 6, 1, 1, 1)
+        self.resume_button.clicked.connect(
+            lambda: self.resume_automation()
+        )
+
         self.start_stop_button = QPushButton(self)
         self.start_stop_button.setText("Start Automation")
         self.right_grid.addWidget(self.start_stop_button, 7, 0, 1, 1)
@@ -272,6 +390,28 @@ class GUI(QWidget):
             lambda: self.open_camera_options_widget()
         )
 
+        self.add_job_button = QPushButton(self)
+        self.add_job_button.setText("Add Core to Queue")
+        self.right_grid.addWidget(self.add_job_button, 9, 0, 1, 1)
+        self.add_job_button.clicked.connect(
+            lambda: self.add_to_queue()
+        )
+
+        self.run_queue_button = QPushButton(self)
+        self.right_grid.addWidget(self.run_queue_button, 9, 1, 1, 1)
+        self.run_queue_button.clicked.connect(
+            lambda: self.run_queue()
+        )
+        self.update_queue_button()
+
+        self.gallery_button = QPushButton(self)
+        self.gallery_button.setText("Review Captures")
+        self.right_grid.addWidget(self.gallery_button, 10, 0, 1, 2)
+        self.gallery_button.clicked.connect(
+            lambda: self.open_gallery_widget()
+        )
+        self.gallery_widget = None
+
 
         # Start Video Thread
         self.video_thread = video_stream_thread(self.camera)
@@ -282,6 +422,8 @@ class GUI(QWidget):
         self.listening_thread = automation_listening_thread(self.Automation)
         self.listening_thread.automation_status.connect(self.change_automation_status)
         self.listening_thread.automation_message.connect(self.change_automation_message)
+        self.listening_thread.pause_status.connect(self.change_pause_status)
+        self.listening_thread.panorama_image.connect(self.set_panorama)
         self.listening_thread.start()
 
         # Starts the GUI
@@ -291,6 +433,7 @@ class GUI(QWidget):
         # return super().closeEvent(a0)
         print("Closing!")
         if self.camera_options_widget is not None: self.camera_options_widget.close()
+        if self.gallery_widget is not None: self.gallery_widget.close()
         self.Automation.change_status(False)
 
     def on_image_name_change(self, text: str) -> None:
@@ -356,6 +499,11 @@ class GUI(QWidget):
         self.camera_options_widget.launch_dialog()
 
 
+    def open_gallery_widget(self) -> None:
+        self.gallery_widget = GalleryGUI(self.Automation.get_thumbnail_pack_path(self.image_name),
+                                         self.Automation.get_capture_location(), self.stylesheet)
+        self.gallery_widget.show()
+
     def start_stop_automation(self) -> None:
         """
         @brief Called when the start/stop button is pressed. On windows when the start button
@@ -372,6 +520,40 @@ class GUI(QWidget):
             print("Automation stopped")
             self.Automation.change_status(False)
 
+    def add_to_queue(self) -> None:
+        """
+        @brief Adds the core currently entered in the text boxes to the job queue.
+        """
+        try:
+            job = CoreJob(self.image_name, float(self.core_length), float(self.shift_length),
+                          self.capture_path, self.camera.get_profile())
+        except ValueError:
+            QMessageBox.warning(self, "Invalid input", "Core and shift length must be numbers.",
+                                QMessageBox.Ok)
+            return
+        self.job_queue.add(job)
+        self.update_queue_button()
+
+    def run_queue(self) -> None:
+        """
+        @brief Captures every pending core in the queue. Automation pauses between cores so the
+            operator can load the next one and press play.
+        """
+        if self.Automation.is_active() or not self.job_queue.pending(): return
+        self.Automation.start_queue(self.job_queue)
+
+    def update_queue_button(self) -> None:
+        self.run_queue_button.setText(f"Run Queue ({len(self.job_queue.pending())})")
+
+    def resume_automation(self) -> None:
+        """
+        @brief Called when the resume button is pressed. Continues an interrupted run of the current
+            core from its progress journal, skipping the images already on disk.
+        """
+        if self.Automation.is_active(): return
+        self.Automation.start_automation(self.image_name, float(self.core_length),
+                                         float(self.shift_length), resume=True)
+
     def choose_directory(self):
         """
         @brief Called when the start/stop button is pressed. On windows when the start button
@@ -411,6 +593,7 @@ class GUI(QWidget):
         """
         self.video_width = int(self.size().width() * 0.75)
         self.video_height = int(self.size().height() * 0.8)
+        self.video_label.set_bounds(self.video_width, self.video_height)
         super().resizeEvent(event)
 
     def run_in_thread(function):
@@ -737,6 +920,106 @@ class CameraOptionsGUI(QWidget):
         self.load_default_slider_values()
 
 
+
+class GalleryGUI(QWidget):
+    def __init__(self, pack_path: str, capture_dir: str, stylesheet: str) -> None:
+        """
+        @brief This widget shows the thumbnails of a core's stills from its thumbnail pack, with
+            each still's exposure, clipping and focus. Full images are only loaded when a
+            thumbnail is double-clicked.
+        @param pack_path    Thumbnail pack of the core.
+        @param capture_dir  Folder the stills are saved in.
+        @param stylesheet   Stylesheet of the main window.
+        """
+        super().__init__()
+        self._pack_path = pack_path
+        self._capture_dir = capture_dir
+        self._viewer = None
+        self.setStyleSheet(stylesheet + """
+            QListWidget { color: white; font-size: 8pt; }
+        """)
+        self.setWindowTitle(f"Review {os.path.basename(capture_dir)}")
+        self.resize(900, 600)
+        self.initUI()
+        self.load_pack()
+
+    def initUI(self) -> None:
+        self.grid = QGridLayout(self)
+
+        self.summary_label = QLabel(self)
+        self.grid.addWidget(self.summary_label, 0, 0)
+
+        self.refresh_button = QPushButton(self)
+        self.refresh_button.setText("Refresh")
+        self.grid.addWidget(self.refresh_button, 0, 1)
+        self.refresh_button.clicked.connect(
+            lambda: self.load_pack()
+        )
+
+        self.thumbnail_list = QListWidget(self)
+        self.thumbnail_list.setViewMode(QListView.IconMode)
+        self.thumbnail_list.setResizeMode(QListView.Adjust)
+        self.thumbnail_list.setIconSize(QSize(THUMBNAIL_WIDTH, THUMBNAIL_WIDTH))
+        self.thumbnail_list.setUniformItemSizes(True)
+        self.thumbnail_list.itemDoubleClicked.connect(self.open_image)
+        self.grid.addWidget(self.thumbnail_list, 1, 0, 1, 2)
+
+    def load_pack(self) -> None:
+        """
+        @brief Shows the newest thumbnail of every still in the pack.
+        """
+        started = time.time()
+        self.thumbnail_list.clear()
+        records = latest_records(read_pack(self._pack_path))
+        checker = QualityChecker(last_position=max((record.get('position', record.get('index', 0))
+                                                    for record, _ in records), default=None))
+        for record, _ in records: checker.check(record)
+        failures = {}  # A still can fail when checked, or later against the stills after it
+        for failure in checker.take_failures():
+            failures.setdefault(failure['file'], []).extend(failure['reasons'])
+        failed = 0
+        for record, thumbnail in records:
+            pixmap = QPixmap()
+            pixmap.loadFromData(thumbnail, "JPG")
+            text = (f"{record['file']}\nmean {record['mean']:.0f}  focus {record['focus']:.0f}\n"
+                    f"clipped {record['clipped_high']:.1f}% / {record['clipped_low']:.1f}%")
+            reasons = failures.get(record['file'])
+            if reasons:
+                failed += 1
+                text += f"\nFAILED: {', '.join(reasons)}"
+            item = QListWidgetItem(QIcon(pixmap), text)
+            item.setData(Qt.UserRole, record['file'])
+            item.setToolTip(f"Stage position: {record.get('stage_mm')} mm")
+            if reasons: item.setForeground(QColor(255, 80, 80))
+            self.thumbnail_list.addItem(item)
+        self.summary_label.setText(f"{len(records)} still(s), {failed} failing the quality check, "
+                                   f"loaded in {time.time() - started:.2f} s"
+                                   if records else f"No thumbnails in {self._pack_path}")
+
+    def open_image(self, item: QListWidgetItem) -> None:
+        """
+        @brief Loads a still at full size in its own scrollable window.
+        @param item Thumbnail that was double-clicked.
+        """
+        path = os.path.join(self._capture_dir, item.data(Qt.UserRole))
+        image = read_frame(path)
+        if image is None:
+            QMessageBox.warning(self, "Error encountered", f"Could not open {path}", QMessageBox.Ok)
+            return
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        label = QLabel()
+        label.setPixmap(QPixmap.fromImage(QImage(image.data, image.shape[1], image.shape[0],
+                                                 image.shape[1] * 3, QImage.Format_RGB888)))
+        self._viewer = QScrollArea()
+        self._viewer.setWindowTitle(os.path.basename(path))
+        self._viewer.setWidget(label)
+        self._viewer.resize(1200, 900)
+        self._viewer.show()
+
+    def closeEvent(self, a0: QCloseEvent | None) -> None:
+        if self._viewer is not None: self._viewer.close()
+
+
 if __name__ == '__main__':
     try:
         app = QApplication(sys.argv)
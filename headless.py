@@ -0,0 +1,202 @@
+import os, sys, time, argparse, threading
+import yaml
+from camera import Camera, camera_type
+from automationScript import Arduino, Automation
+from job_queue import JobQueue, CoreJob
+
+
+class StatusReporter:
+    def __init__(self, automation: Automation, status_file: str = None, quiet: bool = False) -> None:
+        """
+        @brief  Reports automation progress without a GUI. Plays the part of the GUI's
+                automation_listening_thread.
+        @param automation   The Automation class.
+        @param status_file  Optional file that is rewritten with the latest status.
+        @param quiet        If True, nothing is printed to stdout.
+        """
+        self._automation = automation
+        self._status_file = status_file
+        self._quiet = quiet
+        self._previous_message = None
+        self._started = time.time()
+
+    def poll(self) -> None:
+        """
+        @brief  Reports the automation status if it changed since the last poll.
+        """
+        message = self._automation.get_automation_status()
+        if message == self._previous_message: return
+        self._previous_message = message
+        if not self._quiet:
+            print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+        if self._status_file:
+            self.write_status(message)
+
+    def write_status(self, message: str) -> None:
+        """
+        @brief  Atomically rewrites the status file so readers never see a partial file.
+        @param message  Status message to record.
+        """
+        done, total = self._automation.get_progress()
+        status = {
+            'message': message,
+            'active': self._automation.is_active(),
+            'position': done,
+            'total': total,
+            'elapsed_s': round(time.time() - self._started, 1),
+            'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        temporary_path = self._status_file + '.tmp'
+        with open(temporary_path, 'w') as stream:
+            yaml.safe_dump(status, stream)
+        os.replace(temporary_path, self._status_file)
+
+
+def follow(automation: Automation, camera: Camera, thread: threading.Thread,
+           reporter: StatusReporter = None) -> None:
+    """
+    @brief  Reports on an automation thread until it finishes. Ctrl+C stops the automation.
+    @param automation   The Automation class.
+    @param camera       The Camera used by automation.
+    @param thread       Thread returned by start_automation or start_queue.
+    @param reporter     Reporter to poll while the thread runs.
+    """
+    try:
+        while thread.is_alive():
+            if reporter is not None: reporter.poll()
+            thread.join(0.1)
+    except KeyboardInterrupt:
+        print("Stopping automation...", flush=True)
+        automation.change_status(False)
+        thread.join()
+    camera.wait_for_still_image(10.0)
+    if reporter is not None: reporter.poll()
+
+
+def ask_operator(job: CoreJob) -> bool:
+    """
+    @brief  Asks on the terminal for the next core to be loaded.
+    @param job  The next job.
+    @return True to capture the job, false to stop the queue.
+    """
+    answer = input(f"Load core '{job.core_id}' ({job.core_length} cm) and press Enter, "
+                   f"or type q to stop: ")
+    return answer.strip().lower() != 'q'
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Capture a tree core without the GUI.")
+    parser.add_argument('name', nargs='?', help="Image/core name, also used as the folder name")
+    parser.add_argument('--core-length', type=float, default=20.0, help="Core length (cm)")
+    parser.add_argument('--shift-length', type=float, default=3.0, help="Shift length (mm)")
+    parser.add_argument('--output', default=os.path.expanduser('~/Desktop'),
+                        help="Folder to create the core folder in")
+    parser.add_argument('--profile', default="camera_configuration.yaml", help="Camera profile")
+    parser.add_argument('--start-number', default="0", help="Initial image number")
+    parser.add_argument('--status-file', default=None, help="File to keep the latest status in")
+    parser.add_argument('--port', default=None, help="Arduino serial port (default: find CH340)")
+    parser.add_argument('--simulate', action='store_true',
+                        help="Use the virtual Arduino and simulated camera")
+    parser.add_argument('--quiet', action='store_true', help="Do not print progress to stdout")
+    parser.add_argument('--no-settle', action='store_true',
+                        help="Use fixed waits instead of detecting when the stage has settled")
+    parser.add_argument('--settle-threshold', type=float, default=None,
+                        help="Mean preview frame difference (grey levels) that counts as settled")
+    parser.add_argument('--trigger-delay', type=int, default=None,
+                        help="Let the arduino trigger the camera this many ms after each move "
+                             "(camera trigger input wired to the arduino)")
+    parser.add_argument('--scan-program', action='store_true',
+                        help="Let the arduino run the whole capture as one scan program")
+    parser.add_argument('--dwell', type=int, default=None,
+                        help="Milliseconds a scan program stays at each position for the picture")
+    parser.add_argument('--no-retake', action='store_true',
+                        help="Keep stills that fail the quality check instead of retaking them")
+    parser.add_argument('--session-container', action='store_true',
+                        help="Store the images in one <name>_session.frames file instead of one "
+                             "file per position")
+    parser.add_argument('--archive', default=None,
+                        help="Copy each completed core folder here in the background, with verified "
+                             "checksums and a manifest")
+    parser.add_argument('--archive-bandwidth', type=float, default=None,
+                        help="Largest archive transfer rate (MB/s)")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted capture of this core from its journal. With "
+                             "--queue, stopped cores (or only this one) are queued again and resumed")
+    parser.add_argument('--queue', default=None,
+                        help="Job queue file. With a name the core is added to the queue, "
+                             "without one every pending core in the queue is captured")
+    parser.add_argument('--home', action='store_true',
+                        help="Home the stage to the limit switch first, so image positions are "
+                             "absolute, then return to the start")
+    parser.add_argument('--no-prompt', action='store_true',
+                        help="Do not wait for the operator between queued cores")
+    args = parser.parse_args(argv)
+
+    if args.queue and args.name and not args.resume:
+        JobQueue(args.queue).add(CoreJob(args.name, args.core_length, args.shift_length,
+                                         args.output, args.profile))
+        print(f"Added '{args.name}' to {args.queue}")
+        return 0
+    if not args.queue and not args.name:
+        parser.error("a core name or --queue is required")
+
+    virtual_arduino = None
+    if args.simulate:
+        from simulation import VirtualArduino, SimulatedCamera
+        virtual_arduino = VirtualArduino()
+        args.port = virtual_arduino.start()
+        camera = SimulatedCamera(stage=virtual_arduino, config_path=args.profile)
+    else:
+        camera = Camera(args.profile)
+
+    try:
+        if camera.type() == camera_type.UNKNOWN:
+            print("ERROR Could not open a camera.", file=sys.stderr)
+            return 1
+        if not camera.is_microscope() and not args.simulate:
+            print("WARNING Microscope camera not connected, using the next camera.", file=sys.stderr)
+
+        arduino = Arduino(port=args.port)
+        if not arduino.is_connected():
+            print(f"ERROR Could not connect to arduino: {arduino.get_connection_error()}",
+                  file=sys.stderr)
+            return 1
+        if args.home and not arduino.home(return_to_start=True):
+            return 1
+
+        automation = Automation(camera, arduino)
+        automation.set_settle_detection(not args.no_settle, args.settle_threshold)
+        if args.trigger_delay is not None: automation.set_hardware_trigger(True, args.trigger_delay)
+        automation.set_scan_program(args.scan_program, args.dwell)
+        automation.set_auto_retake(not args.no_retake)
+        automation.set_session_container(args.session_container)
+        automation.set_archive(args.archive, args.archive_bandwidth)
+        reporter = StatusReporter(automation, args.status_file, args.quiet)
+        if args.queue:
+            prompt = (lambda job: True) if args.no_prompt else ask_operator
+            queue = JobQueue(args.queue)
+            if args.resume:
+                for job in queue.requeue(args.name): print(f"Resuming stopped core '{job.core_id}'")
+            thread = automation.start_queue(queue, prompt)
+        else:
+            automation.set_capture_location(os.path.join(args.output, args.name))
+            automation.set_counter_value(args.start_number)
+            thread = automation.start_automation(args.name, args.core_length, args.shift_length,
+                                                 args.resume)
+        follow(automation, camera, thread, reporter)
+        if automation.get_archiver().pending():
+            print("Waiting for the archive copy to finish...", flush=True)
+            automation.get_archiver().wait()
+        failed = [name for manifest in automation.get_archiver().take_results() for name in manifest['failed']]
+        if failed: print(f"ERROR {len(failed)} file(s) were not archived: {', '.join(failed)}", file=sys.stderr)
+        if not automation.is_completed():
+            done, total = automation.get_progress()
+            print(f"ERROR Capture did not complete, stopped at position {done} / {total}", file=sys.stderr)
+    finally:
+        camera.close()
+        if virtual_arduino is not None: virtual_arduino.stop()
+    return 1 if failed or not automation.is_completed() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import os, time, threading
+import yaml
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+STOPPED = 'stopped'
+
+
+class CoreJob:
+    def __init__(self, core_id: str, core_length: float, shift_length: float, output_dir: str,
+                 profile: str = "camera_configuration.yaml", status: str = PENDING,
+                 started: str = None, finished: str = None) -> None:
+        """
+        @brief  One core to capture.
+        @param core_id      Image/core name, also used as the folder name.
+        @param core_length  Core size (in cm).
+        @param shift_length Length to shift each turn (in mm).
+        @param output_dir   Folder the core folder is created in.
+        @param profile      Camera profile to capture with.
+        @param status       One of pending, running, done or stopped.
+        @param started      Time the capture started.
+        @param finished     Time the capture finished.
+        """
+        self.core_id = core_id
+        self.core_length = float(core_length)
+        self.shift_length = float(shift_length)
+        self.output_dir = output_dir
+        self.profile = profile
+        self.status = status
+        self.started = started
+        self.finished = finished
+
+    def capture_dir(self) -> str:
+        """
+        @brief  Gets the folder the core's images are saved in.
+        """
+        return os.path.join(self.output_dir, self.core_id)
+
+    def to_dict(self) -> dict:
+        return {
+            'core_id': self.core_id,
+            'core_length': self.core_length,
+            'shift_length': self.shift_length,
+            'output_dir': self.output_dir,
+            'profile': self.profile,
+            'status': self.status,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'CoreJob':
+        return cls(**values)
+
+
+class JobQueue:
+    def __init__(self, path: str = "job_queue.yaml") -> None:
+        """
+        @brief  A queue of cores to capture that is saved to a YAML file after every change, so it
+                survives restarts of the program.
+        @param path Queue file.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self.jobs = []
+        self.load()
+
+    def load(self) -> None:
+        """
+        @brief  Loads the queue file. A missing file is an empty queue.
+        """
+        try:
+            with open(self._path, "r") as stream:
+                entries = yaml.safe_load(stream) or []
+        except OSError:
+            entries = []
+        except yaml.YAMLError as e:
+            print('YAML ERROR >', e)
+            entries = []
+        self.jobs = [CoreJob.from_dict(entry) for entry in entries]
+        for job in self.jobs:
+            if job.status == RUNNING: job.status = PENDING  # Interrupted by a crash or shutdown
+
+    def save(self) -> None:
+        """
+        @brief  Atomically writes the queue file.
+        """
+        with self._lock:
+            temporary_path = self._path + '.tmp'
+            with open(temporary_path, "w") as stream:
+                yaml.safe_dump([job.to_dict() for job in self.jobs], stream, sort_keys=False)
+            os.replace(temporary_path, self._path)
+
+    def add(self, job: CoreJob) -> None:
+        self.jobs.append(job)
+        self.save()
+
+    def pending(self) -> list:
+        return [job for job in self.jobs if job.status == PENDING]
+
+    def next_pending(self) -> CoreJob:
+        pending = self.pending()
+        return pending[0] if pending else None
+
+    def mark(self, job: CoreJob, status: str) -> None:
+        """
+        @brief  Updates a job's status and saves the queue.
+        """
+        job.status = status
+        if status == RUNNING: job.started = time.strftime('%Y-%m-%d %H:%M:%S')
+        if status in (DONE, STOPPED): job.finished = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.save()
+
+    def requeue(self, core_id: str = None) -> list:
+        """
+        @brief  Makes stopped jobs pending again. They were started, so running the queue resumes
+                them from their journals.
+        @param core_id  Only requeue this core. Defaults to every stopped job.
+        @return The requeued jobs.
+        """
+        jobs = [job for job in self.jobs if job.status == STOPPED and core_id in (None, job.core_id)]
+        for job in jobs: job.status = PENDING
+        if jobs: self.save()
+        return jobs
+
+    def clear_finished(self) -> None:
+        self.jobs = [job for job in self.jobs if job.status not in (DONE, STOPPED)]
+        self.save()
+
+
+def timing_summary(capture_log: list, started: float, finished: float) -> dict:
+    """
+    @brief  Summarizes how long a run took.
+    @param capture_log  Entries from Automation.get_capture_log(), or journal.captured_images. The
+                        time between images of different sessions of a resumed run is left out
+                        of the per position times.
+    @param started      Start time of the run (seconds since epoch).
+    @param finished     End time of the run (seconds since epoch).
+    @return Dictionary of timings in seconds.
+    """
+    ordered = sorted(capture_log, key=lambda entry: entry['time'])
+    intervals = [later['time'] - earlier['time'] for earlier, later in zip(ordered, ordered[1:])
+                 if earlier.get('session') == later.get('session')]
+    return {
+        'total_s': round(finished - started, 2),
+        'images': len(capture_log),
+        'mean_position_s': round(sum(intervals) / len(intervals), 3) if intervals else None,
+        'min_position_s': round(min(intervals), 3) if intervals else None,
+        'max_position_s': round(max(intervals), 3) if intervals else None,
+    }
+
+
+def write_manifest(job: CoreJob, capture_log: list, started: float, finished: float) -> str:
+    """
+    @brief  Writes <core_id>_manifest.yaml in the core folder, listing the images and timings.
+    @param job          The captured job.
+    @param capture_log  Images of the run, from journal.captured_images, so a resumed run lists
+                        the images of every session.
+    @param started      Start time of the run (seconds since epoch).
+    @param finished     End time of the run (seconds since epoch).
+    @return Path of the manifest.
+    """
+    manifest = {
+        'job': job.to_dict(),
+        'timing': timing_summary(capture_log, started, finished),
+        'images': [
+            {
+                'index': entry['index'],
+                'file': os.path.basename(entry['file']),
+                'time': round(entry['time'] - started, 3),
+                'stage_mm': entry.get('stage_mm'),
+            }
+            for entry in capture_log
+        ],
+    }
+    os.makedirs(job.capture_dir(), exist_ok=True)
+    path = os.path.join(job.capture_dir(), f"{job.core_id}_manifest.yaml")
+    with open(path, "w") as stream:
+        yaml.safe_dump(manifest, stream, sort_keys=False)
+    return path
@@ -0,0 +1,129 @@
+import os, json, time, hashlib
+from session_container import frame_exists, frame_digest
+
+
+def file_checksum(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    @brief  Hashes a file with chunked reads, so large images are never fully loaded. A frame
+            held in a session container is hashed from its mapped pixels.
+    @param path         File to hash.
+    @param chunk_size   Bytes read at a time.
+    @return SHA-256 hex digest.
+    """
+    digest = frame_digest(path)
+    if digest is not None: return digest
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CaptureJournal:
+    def __init__(self, path: str, append: bool = True) -> None:
+        """
+        @brief  Append-only progress journal of a capture run, one JSON object per line. Each line is
+                flushed to disk before the run continues, so a crash loses at most the line being
+                written.
+        @param path     Journal file.
+        @param append   If False, any previous journal at path is replaced.
+        """
+        self._path = path
+        self._stream = open(path, "a" if append else "w")
+
+    def record(self, event: str, **values) -> None:
+        """
+        @brief  Appends an entry to the journal.
+        @param event    Entry type: start, captured, shifting, shifted, failed or finished.
+        @param values   Other fields of the entry.
+        """
+        entry = {'event': event, 'time': round(time.time(), 3)}
+        entry.update(values)
+        self._stream.write(json.dumps(entry) + "\n")
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+def read_journal(path: str) -> list:
+    """
+    @brief  Reads a journal, ignoring a line that was cut off by a crash.
+    @param path Journal file.
+    @return List of entries, empty if the journal does not exist.
+    """
+    entries = []
+    try:
+        with open(path, "r") as stream:
+            for line in stream:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    except OSError:
+        pass
+    return entries
+
+
+def captured_images(entries: list) -> list:
+    """
+    @brief  Lists the images of the last run in a journal, over every session it was captured in.
+            Positions a resume went back to only count from the session that captured them again,
+            and a position captured more than once (e.g. retaken) is listed with its last capture.
+    @param entries  Entries from read_journal.
+    @return 'captured' entries in position order, each with the 'session' it was captured in: 0
+            for the first, then one more for each resume.
+    """
+    starts = [i for i, entry in enumerate(entries) if entry['event'] == 'start']
+    if not starts: return []
+    captured = {}
+    session = 0
+    for entry in entries[starts[-1] + 1:]:
+        if entry['event'] == 'resume':
+            session += 1
+            captured = {position: image for position, image in captured.items() if position < entry['position']}
+        elif entry['event'] == 'captured':
+            captured[entry['position']] = dict(entry, session=session)
+    return [captured[position] for position in sorted(captured)]
+
+
+def resume_point(entries: list, capture_dir: str) -> dict:
+    """
+    @brief  Works out where an interrupted run can continue from. A position counts as finished
+            only if its image is on disk with the checksum recorded in the journal, and the run
+            continues after the last position for which that is true of it and every one before it.
+    @param entries      Entries from read_journal.
+    @param capture_dir  Folder the images were saved in.
+    @return None if there is no run to resume, otherwise a dictionary with the run's 'start'
+            entry, the next 'position' to capture, its image 'index', the 'stage_position' the
+            stage was last sent to, and whether the run already 'finished'.
+    """
+    starts = [i for i, entry in enumerate(entries) if entry['event'] == 'start']
+    if not starts: return None
+    start = entries[starts[-1]]
+    entries = entries[starts[-1] + 1:]
+
+    captured = {}
+    stage_position = 0
+    for entry in entries:
+        if entry['event'] == 'captured':
+            captured[entry['position']] = entry
+        elif entry['event'] in ('shifting', 'shifted'):
+            # The firmware finishes a move it was sent even if the host dies, so a move that was
+            # started counts as done.
+            stage_position = entry['stage_position']
+
+    position = 0
+    while position in captured:
+        path = os.path.join(capture_dir, captured[position]['file'])
+        if not frame_exists(path) or file_checksum(path) != captured[position]['sha256']: break
+        position += 1
+
+    return {
+        'start': start,
+        'position': position,
+        'index': start['first_index'] + position,
+        'stage_position': stage_position,
+        'finished': position > start['total'],
+    }
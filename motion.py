@@ -0,0 +1,84 @@
+import numpy as np
+
+STEPS_PER_TENTH_MM = 161  # rotate_amount in Tree_Ring.ino
+TIMER_TICK = 0.5e-6  # Timer1 tick in Tree_Ring.ino: 16 MHz with a /8 prescaler
+HOME_MAX_STEPS = 1610000  # Homing gives up after this many steps
+HOME_BACKOFF_STEPS = 16100  # or after backing off this far from the switch
+
+
+class MotionProfile:
+    def __init__(self, start_speed: float = 1000.0, cruise_speed: float = 8000.0,
+                 acceleration: float = 20000.0) -> None:
+        """
+        @brief  Trapezoidal motion profile, matching step() in Tree_Ring.ino. Each step runs at
+                sqrt(start_speed^2 + 2 * acceleration * n), where n is the number of steps to the
+                nearest end of the move, capped where the speed reaches cruise_speed.
+        @param start_speed  Speed (steps/s) the motor starts and stops at without stalling.
+        @param cruise_speed Top speed (steps/s).
+        @param acceleration Acceleration (steps/s^2).
+        """
+        self.start_speed = float(start_speed)
+        self.cruise_speed = float(cruise_speed)
+        self.acceleration = float(acceleration)
+
+    @classmethod
+    def constant(cls, speed: float) -> 'MotionProfile':
+        """
+        @brief  Profile without ramps, e.g. 1 / (2 * 150us) for the original firmware.
+        @param speed    Speed in steps/s.
+        """
+        return cls(speed, speed, 1.0)
+
+    def ramp_steps(self) -> int:
+        """
+        @brief  Steps needed to accelerate from start to cruise speed.
+        """
+        if self.cruise_speed <= self.start_speed: return 0
+        return int((self.cruise_speed ** 2 - self.start_speed ** 2) / (2.0 * self.acceleration))
+
+    def step_speeds(self, steps: int) -> np.ndarray:
+        """
+        @brief  Speed of every step of a move.
+        @param steps    Steps in the move.
+        @return Array of speeds in steps/s.
+        """
+        i = np.arange(steps)
+        n = np.minimum(np.minimum(i, steps - 1 - i), self.ramp_steps())
+        return np.sqrt(self.start_speed ** 2 + 2.0 * self.acceleration * n)
+
+    def half_periods(self, steps: int) -> np.ndarray:
+        """
+        @brief  Pulse half-periods of every step as Timer1 times them. half_period_ticks() in
+                Tree_Ring.ino truncates 1e6 / speed to whole 0.5 us ticks, and in CTC mode the timer
+                fires OCR1A + 1 ticks after the last time. step() loads the first step's value into
+                OCR1A before the pin first rises, so both halves of every step, the first included,
+                take that step's value.
+        @param steps    Steps in the move.
+        @return Array of half-periods in seconds.
+        """
+        return (np.floor(1000000.0 / self.step_speeds(steps)) + 1.0) * TIMER_TICK
+
+    def move_time(self, steps: int) -> float:
+        """
+        @brief  How long a move takes.
+        @param steps    Steps in the move.
+        @return Seconds.
+        """
+        if steps <= 0: return 0.0
+        return float(2.0 * self.half_periods(steps).sum())
+
+    def position_at(self, steps: int, elapsed: float) -> int:
+        """
+        @brief  How many steps of a move are done after some time.
+        @param steps    Steps in the move.
+        @param elapsed  Seconds since the move started.
+        @return Steps done.
+        """
+        if steps <= 0: return 0
+        return int(np.searchsorted(np.cumsum(2.0 * self.half_periods(steps)), elapsed, side='right'))
+
+    def steps_for_mm(self, millimeters: float) -> int:
+        """
+        @brief  Converts a distance to steps.
+        """
+        return int(round(millimeters * 10 * STEPS_PER_TENTH_MM))
@@ -0,0 +1,118 @@
+import threading
+import numpy as np
+
+
+class QualityChecker:
+    def __init__(self, focus_ratio: float = 0.5, exposure_tolerance: float = 0.25,
+                 max_clipped: float = 5.0, neighbours: int = 3, exposure_range: tuple = (16.0, 240.0),
+                 min_focus: float = None, end_tolerance: float = 2.0, last_position: int = None) -> None:
+        """
+        @brief  Judges stills from the summaries ThumbnailWriter makes of them (see
+                thumbnails.summarize). A still fails if it is blurred or badly exposed compared
+                with the stills next to it, or if too much of it is clipped. Comparing with the
+                neighbours rather than fixed levels keeps the check independent of the camera,
+                lighting and wood. A still checked before any of its neighbours arrived (e.g. the
+                first of a run) is checked against fixed levels, and again against its neighbours
+                once the next still arrives. The first and last stills only have neighbours on one
+                side and often show the end of the core, so they are compared more loosely, as is a
+                still with only one neighbour to compare with.
+        @param focus_ratio          A still is blurred if its focus score is below this fraction
+                                    of its neighbours' median.
+        @param exposure_tolerance   A still is badly exposed if its mean grey level differs from
+                                    its neighbours' median by more than this fraction.
+        @param max_clipped          Largest percentage of saturated or black pixels allowed.
+        @param neighbours           Positions either side a still is compared with.
+        @param exposure_range       Lowest and highest mean grey level of a still with no
+                                    neighbours to compare with.
+        @param min_focus            Lowest focus score of a still with no neighbours to compare
+                                    with, or None not to judge its focus alone. Depends on the
+                                    camera and magnification.
+        @param end_tolerance        Factor the focus ratio and exposure tolerance are loosened by
+                                    for the first and last still, and for a still with one
+                                    neighbour.
+        @param last_position        Position of the last still of the run, if known.
+        """
+        self.focus_ratio = focus_ratio
+        self.exposure_tolerance = exposure_tolerance
+        self.max_clipped = max_clipped
+        self.neighbours = neighbours
+        self.exposure_range = exposure_range
+        self.min_focus = min_focus
+        self.end_tolerance = end_tolerance
+        self.last_position = last_position
+        self._lock = threading.Lock()
+        self._records = {}
+        self._alone = set()  # Positions checked before they had neighbours
+        self._failures = []
+
+    def reset(self, last_position: int = None) -> None:
+        """
+        @brief  Forgets every still, e.g. when a new run starts.
+        @param last_position    Position of the last still of the new run, if known.
+        """
+        with self._lock:
+            self.last_position = last_position
+            self._records = {}
+            self._alone = set()
+            self._failures = []
+
+    def check(self, record: dict) -> list:
+        """
+        @brief  Judges a still. Thread-safe, so it can be one of ThumbnailWriter's listeners.
+        @param record   Thumbnail record with the still's 'position' (or 'index') and summary.
+        @return List of the reasons the still failed: 'blurred', 'exposure', 'overexposed' or
+                'underexposed'. Empty if it passed. Stills checked again because this one is
+                their first neighbour are only reported through take_failures.
+        """
+        position = record.get('position', record.get('index', 0))
+        with self._lock:
+            self._records[position] = record
+            self._alone.discard(position)
+            reasons = self._judge(position)
+            if reasons: self._failures.append(dict(record, position=position, reasons=reasons))
+            for other in sorted(self._alone):
+                if abs(other - position) > self.neighbours: continue
+                self._alone.discard(other)
+                earlier = self._judge_alone(self._records[other])
+                later = [reason for reason in self._judge(other) if reason not in earlier]
+                if later: self._failures.append(dict(self._records[other], position=other, reasons=later))
+        return reasons
+
+    def _judge(self, position: int) -> list:
+        record = self._records[position]
+        nearby = [self._records[other] for other in range(position - self.neighbours,
+                                                          position + self.neighbours + 1)
+                  if other != position and other in self._records]
+        if not nearby:
+            self._alone.add(position)
+            return self._judge_alone(record)
+        reasons = []
+        # One still is a poor reference, e.g. for the second still when the first shows the end of the core
+        loosen = self.end_tolerance if position in (0, self.last_position) or len(nearby) < 2 else 1.0
+        focus = float(np.median([other['focus'] for other in nearby]))
+        if record['focus'] < self.focus_ratio / loosen * focus: reasons.append('blurred')
+        mean = float(np.median([other['mean'] for other in nearby]))
+        if abs(record['mean'] - mean) > self.exposure_tolerance * loosen * max(mean, 1.0):
+            reasons.append('exposure')
+        return reasons + self._judge_clipping(record)
+
+    def _judge_alone(self, record: dict) -> list:
+        reasons = []
+        if self.min_focus is not None and record['focus'] < self.min_focus: reasons.append('blurred')
+        if not self.exposure_range[0] <= record['mean'] <= self.exposure_range[1]: reasons.append('exposure')
+        return reasons + self._judge_clipping(record)
+
+    def _judge_clipping(self, record: dict) -> list:
+        reasons = []
+        if record['clipped_high'] > self.max_clipped: reasons.append('overexposed')
+        if record['clipped_low'] > self.max_clipped: reasons.append('underexposed')
+        return reasons
+
+    def take_failures(self) -> list:
+        """
+        @brief  Gets the stills that failed since the last call. Returns immediately.
+        @return List of failed records, each with its 'position' and 'reasons'.
+        """
+        with self._lock:
+            failures, self._failures = self._failures, []
+        return failures
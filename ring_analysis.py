@@ -0,0 +1,371 @@
+import os, re, sys, time, argparse
+import cv2
+import numpy as np
+from journal import read_journal
+from stitching import Stitcher, RegistrationCache, find_frames, stage_positions, read_dzi_region
+from session_container import read_frame
+from shading import ShadingCorrection
+
+
+def find_band(grey: np.ndarray) -> tuple:
+    """
+    @brief  Finds the rows the core covers from the mean brightness of each row, which differs
+            between the core and the background it is mounted on.
+    @param grey Grey image of the core running left to right.
+    @return (top, bottom) rows of the middle 60% of the core, or the middle half of the image if
+            the core cannot be told apart from the background.
+    """
+    height = grey.shape[0]
+    rows = grey.mean(axis=1)
+    fallback = (height // 4, height - height // 4)
+    if rows.max() - rows.min() < 10: return fallback
+    threshold, _ = cv2.threshold(rows.astype(np.uint8).reshape(-1, 1), 0, 255,
+                                 cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # The core is whichever side of the threshold the middle row is on
+    inside = (rows > threshold) == (rows[height // 2] > threshold)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], inside.astype(np.int8), [0]))))
+    runs = edges.reshape(-1, 2)
+    top, bottom = runs[np.argmax(runs[:, 1] - runs[:, 0])]
+    if bottom - top < height // 10 or bottom - top == height: return fallback
+    margin = (bottom - top) // 5
+    return int(top + margin), int(bottom - margin)
+
+
+def _band_profiles(grey: np.ndarray, band: tuple) -> tuple:
+    """
+    @brief  Mean brightness of each column inside the band, and of the background rows outside.
+    """
+    top, bottom = max(band[0], 0), min(band[1], grey.shape[0])
+    inside = grey[top:bottom].mean(axis=0)
+    outside_rows = np.concatenate((grey[:max(top - (bottom - top) // 2, 0)],
+                                   grey[bottom + (bottom - top) // 2:]))
+    outside = outside_rows.mean(axis=0) if len(outside_rows) else np.full_like(inside, np.nan)
+    return inside, outside
+
+
+def profile_from_frames(frames: list, offsets: list, band: tuple = None, shading=None) -> tuple:
+    """
+    @brief  Builds the brightness profile along a core straight from its frames, without
+            stitching them: each frame's column profile is blended in at its offset.
+    @param frames   Frame paths in order.
+    @param offsets  Frame offsets from Stitcher.register.
+    @param band     (top, bottom) rows of the core in the first frame. Found if None.
+    @param shading  Optional ShadingCorrection applied to each frame.
+    @return (profile, background) arrays, one value per panorama column. background is NaN where
+            no background rows were visible.
+    """
+    weights = None
+    total = background = weight = None
+    for path, (x, y) in zip(frames, offsets):
+        grey = read_frame(path, cv2.IMREAD_GRAYSCALE)
+        if grey is None: raise IOError(f"Could not read {path}")
+        if shading is not None: grey = shading.apply(grey)
+        if weights is None:
+            if band is None: band = find_band(grey)
+            band = (band[0] + offsets[0][1], band[1] + offsets[0][1])  # In panorama rows
+            weights = Stitcher(feather=64)._weights(grey.shape[1])
+            width = offsets[-1][0] + grey.shape[1]
+            total, background, weight = np.zeros(width), np.zeros(width), np.zeros(width)
+        inside, outside = _band_profiles(grey.astype(np.float32), (band[0] - y, band[1] - y))
+        total[x:x + len(inside)] += inside * weights
+        background[x:x + len(inside)] += outside * weights
+        weight[x:x + len(inside)] += weights
+    return _fill_gaps(total, weight), _fill_gaps(background, weight)
+
+
+def profile_from_panorama(path: str, band: tuple = None, chunk: int = 8192) -> tuple:
+    """
+    @brief  Builds the brightness profile along a stitched core. A Deep Zoom or .npy panorama is
+            read in chunks of columns, so it never has to fit in memory.
+    @param path     Panorama (.dzi, .npy or an image file).
+    @param band     (top, bottom) rows of the core. Found from an overview if None.
+    @param chunk    Columns read at a time.
+    @return (profile, background) arrays, see profile_from_frames.
+    """
+    if path.lower().endswith('.dzi'):
+        with open(path) as stream: descriptor = stream.read()
+        width = int(re.search(r'Width="(\d+)"', descriptor).group(1))
+        height = int(re.search(r'Height="(\d+)"', descriptor).group(1))
+        read = lambda x0, x1, y0, y1: read_dzi_region(path, x0, y0, x1 - x0, y1 - y0)
+        if band is None:
+            levels = int(np.ceil(np.log2(max(width, height)))) + 1
+            level = max(levels - 1 - int(np.ceil(np.log2(max(height / 512, 1)))), 0)
+            overview = read_dzi_region(path, 0, 0, width, height, level)
+            scale = height / overview.shape[0]
+            top, bottom = find_band(cv2.cvtColor(overview, cv2.COLOR_BGR2GRAY).astype(np.float32))
+            band = (int(top * scale), int(bottom * scale))
+    else:
+        image = np.load(path, mmap_mode='r') if path.lower().endswith('.npy') else cv2.imread(path)
+        if image is None: raise IOError(f"Could not read {path}")
+        height, width = image.shape[:2]
+        read = lambda x0, x1, y0, y1: image[y0:y1, x0:x1]
+        if band is None:
+            step = max(width // 4096, 1)
+            band = find_band(image[:, ::step].mean(axis=2, dtype=np.float32))
+
+    profiles = [[], []]
+    for x in range(0, width, chunk):
+        end = min(x + chunk, width)
+        grey = read(x, end, 0, height).mean(axis=2, dtype=np.float32)
+        for i, values in enumerate(_band_profiles(grey, band)): profiles[i].append(values)
+    return np.concatenate(profiles[0]), np.concatenate(profiles[1])
+
+
+def _fill_gaps(total: np.ndarray, weight: np.ndarray) -> np.ndarray:
+    covered = weight > 0
+    profile = np.where(covered, total / np.maximum(weight, 1e-9), np.nan)
+    if covered.any() and not covered.all():
+        columns = np.arange(len(profile))
+        profile[~covered] = np.interp(columns[~covered], columns[covered], profile[covered])
+    return profile
+
+
+def core_extent(profile: np.ndarray, background: np.ndarray) -> tuple:
+    """
+    @brief  Finds the columns between the ends of the core, where the band looks unlike the
+            background beside it.
+    @return (first, last + 1) columns; the whole profile if no background was visible.
+    """
+    difference = np.abs(profile - background)
+    if np.isnan(difference).all(): return 0, len(profile)
+    difference = np.nan_to_num(difference)
+    core = difference > 0.5 * np.percentile(difference, 90)
+    columns = np.flatnonzero(core)
+    if len(columns) == 0: return 0, len(profile)
+    return int(columns[0]), int(columns[-1]) + 1
+
+
+def _smooth(values: np.ndarray, sigma: float) -> np.ndarray:
+    if sigma < 0.5: return values.astype(np.float32)
+    row = values.astype(np.float32).reshape(1, -1)
+    return cv2.GaussianBlur(row, (0, 0), sigmaX=sigma, sigmaY=0.1, borderType=cv2.BORDER_REFLECT).ravel()
+
+
+def find_boundaries(profile: np.ndarray, px_per_mm: float, smooth_mm: float = 0.02,
+                    detrend_mm: float = 1.0, min_ring_mm: float = 0.15,
+                    min_contrast: float = 5.0) -> np.ndarray:
+    """
+    @brief  Finds ring boundaries in a brightness profile running from pith to bark. A boundary
+            is where the dark latewood of one ring gives way to the light earlywood of the next,
+            i.e. a peak in the gradient of the profile.
+    @param profile      Brightness profile, pith first.
+    @param px_per_mm    Columns of the profile per mm.
+    @param smooth_mm    Gaussian smoothing applied first, against grain and noise.
+    @param detrend_mm   Scale of slow brightness changes (staining, lighting) that are removed.
+    @param min_ring_mm  Narrowest ring accepted; weaker boundaries closer than this are dropped.
+    @param min_contrast Smallest gradient peak accepted, in multiples of the gradient's typical
+                        (median absolute) deviation.
+    @return Column of every boundary, in order.
+    """
+    smooth = _smooth(profile, smooth_mm * px_per_mm)
+    detrended = smooth - _smooth(profile, detrend_mm * px_per_mm)
+    gradient = np.gradient(detrended)
+    deviation = 1.4826 * np.median(np.abs(gradient - np.median(gradient)))
+    strength = gradient / max(deviation, 1e-6)
+
+    peaks = np.flatnonzero((strength[1:-1] > strength[:-2]) & (strength[1:-1] >= strength[2:]) &
+                           (strength[1:-1] > min_contrast)) + 1
+    # Strongest first, dropping peaks too close to one already kept
+    spacing = min_ring_mm * px_per_mm
+    kept = []
+    for peak in peaks[np.argsort(-strength[peaks])]:
+        index = np.searchsorted(kept, peak)
+        if index > 0 and peak - kept[index - 1] < spacing: continue
+        if index < len(kept) and kept[index] - peak < spacing: continue
+        kept.insert(index, int(peak))
+    return np.array(kept, dtype=np.int64)
+
+
+def write_rwl(path: str, series: str, widths_mm: np.ndarray, last_year: int,
+              precision: float = 0.01) -> None:
+    """
+    @brief  Writes ring widths as a Tucson (decadal) .rwl file.
+    @param path         Output file.
+    @param series       Series name, up to 8 characters.
+    @param widths_mm    Ring widths from pith to bark.
+    @param last_year    Year the outermost ring grew.
+    @param precision    0.01 or 0.001 mm. Widths are stored as integers of this unit, and the
+                        series ends with the matching stop marker (999 or -9999).
+    """
+    series = re.sub(r'\s', '_', series)[:8]
+    values = np.round(np.asarray(widths_mm) / precision).astype(int)
+    first_year = last_year - len(values) + 1
+    stop = 999 if precision == 0.01 else -9999
+    lines, year, line = [], first_year, None
+    for value in list(values) + [stop]:
+        if line is None or year % 10 == 0:
+            if line is not None: lines.append(line)
+            line = f"{series:<8}{year:>4}"
+        line += f"{value:>6}"
+        year += 1
+    lines.append(line)
+    with open(path, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+
+
+def write_pos(path: str, boundaries_mm: np.ndarray, y_mm: float, first_year: int, dpi: float,
+              image: str = '') -> None:
+    """
+    @brief  Writes ring boundaries as a CooRecorder .pos file, so they can be checked and
+            corrected by hand.
+    @param path             Output file.
+    @param boundaries_mm    Boundary positions along the core, pith first.
+    @param y_mm             Position across the core the path runs along.
+    @param first_year       Year of the ring that starts at the first boundary.
+    @param dpi              Image resolution in dots per inch.
+    @param image            Image the positions refer to.
+    """
+    lines = [
+        "#CooRecorder-compatible positions written by ring_analysis.py",
+        f"#Imagefile {os.path.basename(image)}",
+        f"#DPI {dpi:.4f}",
+        "#All coordinates in millimeters (mm)",
+        "SCALE 1",
+        f"#C DATED {first_year};",
+        f"#C Written={time.strftime('%Y-%m-%d %H:%M')};",
+    ]
+    lines += [f"{x:.3f},{y_mm:.3f}" for x in boundaries_mm]
+    with open(path, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+
+
+def calibrate(frames: list, positions_mm: list, pixel_size_um: float = None,
+              magnification: float = None) -> float:
+    """
+    @brief  Works out how many image pixels make a mm of core. The stage shifts are the primary
+            reference: registering a few frames measures how many pixels each shift moved the
+            image. Without usable frames, the sensor pixel size (Camera.get_pixel_size) and the
+            optics' magnification give it instead.
+    @param frames        Frame paths of the run.
+    @param positions_mm  Stage position of each frame, or None for evenly spaced frames.
+    @param pixel_size_um Sensor pixel size in um.
+    @param magnification Optical magnification.
+    @return Pixels per mm, or None if neither reference is available.
+    """
+    if len(frames) >= 2 and positions_mm is not None:
+        stitcher = Stitcher()
+        stitcher.register(frames[:4], positions_mm[:4])
+        if stitcher.px_per_mm is not None and not all(pair[3] for pair in stitcher.pairs):
+            return stitcher.px_per_mm
+    if pixel_size_um and magnification: return 1000.0 * magnification / pixel_size_um
+    return None
+
+
+def analyze(profile: np.ndarray, background: np.ndarray, px_per_mm: float, pith: str = 'left',
+            **options) -> dict:
+    """
+    @brief  Measures the rings in a core's brightness profile.
+    @param profile      Profile from profile_from_frames or profile_from_panorama.
+    @param background   Background profile from the same function.
+    @param px_per_mm    Calibration, see calibrate.
+    @param pith         Which end of the image the pith is at, 'left' or 'right'.
+    @param options      Filter settings passed to find_boundaries.
+    @return Dictionary with the 'boundaries_mm' from the pith end of the core and the ring
+            'widths_mm' between them.
+    """
+    first, last = core_extent(profile, background)
+    profile = profile[first:last]
+    if pith == 'right': profile = profile[::-1]
+    boundaries = find_boundaries(profile, px_per_mm, **options)
+    boundaries_mm = boundaries / px_per_mm
+    return {
+        'core_mm': len(profile) / px_per_mm,
+        'boundaries_mm': boundaries_mm,
+        'widths_mm': np.diff(boundaries_mm),
+    }
+
+
+def analyze_capture(folder: str, name: str = None, panorama: str = None, px_per_mm: float = None,
+                    magnification: float = None, pith: str = 'left', last_year: int = None,
+                    output: str = None, shading: bool = False, **options) -> dict:
+    """
+    @brief  Measures the rings of a captured core and writes them as <name>.rwl and <name>.pos.
+    @param folder           Capture folder.
+    @param name             Image name, see find_frames.
+    @param panorama         Stitched panorama to measure. If None, the frames are used directly.
+    @param px_per_mm        Calibration. Measured from the frames if None, see calibrate.
+    @param magnification    Optical magnification, used with the sensor pixel size the run
+                            journaled if the frames cannot calibrate.
+    @param pith             See analyze.
+    @param last_year        Year of the outermost complete ring. Defaults to last year.
+    @param output           Output path without extension. Defaults to <folder>/<name>.
+    @param shading          Correct the frames' shading first, see stitching.stitch_folder.
+    @param options          Filter settings passed to find_boundaries.
+    @return Result of analyze, plus timings and the files written.
+    """
+    started = time.time()
+    frames = find_frames(folder, name)
+    if name is None:
+        if not frames: raise FileNotFoundError(f"No frames found in {folder}")
+        name = os.path.basename(frames[0]).rsplit('_', 1)[0]
+    journal_path = os.path.join(folder, f"{name}_journal.jsonl")
+    positions = stage_positions(frames, journal_path) if frames else None
+
+    offsets = None
+    if panorama is None:
+        if not frames: raise FileNotFoundError(f"No frames found in {folder}")
+        cache = RegistrationCache(os.path.join(folder, f"{name}_registration.json"))
+        correction = ShadingCorrection.for_run(folder, name, frames) if shading else None
+        stitcher = Stitcher(px_per_mm=px_per_mm, cache=cache, shading=correction)
+        offsets = stitcher.register(frames, positions)
+        if px_per_mm is None: px_per_mm = stitcher.px_per_mm
+    if px_per_mm is None:
+        starts = [entry for entry in read_journal(journal_path) if entry['event'] == 'start']
+        pixel_size = starts[-1].get('pixel_size_um') if starts else None
+        px_per_mm = calibrate(frames, positions, pixel_size[0] if pixel_size else None, magnification)
+    if px_per_mm is None:
+        raise ValueError("Cannot calibrate: pass px_per_mm, or a magnification for a run that "
+                         "journaled its pixel size")
+
+    if panorama is None: profile, background = profile_from_frames(frames, offsets, shading=stitcher.shading)
+    else: profile, background = profile_from_panorama(panorama)
+    result = analyze(profile, background, px_per_mm, pith, **options)
+
+    if last_year is None: last_year = time.localtime().tm_year - 1
+    if output is None: output = os.path.join(folder, name)
+    write_rwl(output + '.rwl', name, result['widths_mm'], last_year)
+    write_pos(output + '.pos', result['boundaries_mm'], 0.0, last_year - len(result['widths_mm']) + 1,
+              px_per_mm * 25.4, panorama or frames[0])
+    result.update({
+        'px_per_mm': px_per_mm,
+        'rings': len(result['widths_mm']),
+        'files': [output + '.rwl', output + '.pos'],
+        'seconds': round(time.time() - started, 2),
+    })
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the ring widths of a captured core.")
+    parser.add_argument('folder', help="Capture folder")
+    parser.add_argument('--name', default=None, help="Image name (default: the most common one)")
+    parser.add_argument('--panorama', default=None,
+                        help="Measure this stitched panorama instead of the frames")
+    parser.add_argument('--px-per-mm', type=float, default=None,
+                        help="Calibration (default: measured from the stage shifts)")
+    parser.add_argument('--magnification', type=float, default=None,
+                        help="Optical magnification, used with the camera's pixel size if the "
+                             "frames cannot calibrate")
+    parser.add_argument('--pith', choices=('left', 'right'), default='left',
+                        help="End of the image the pith is at")
+    parser.add_argument('--last-year', type=int, default=None,
+                        help="Year of the outermost complete ring (default: last year)")
+    parser.add_argument('--output', default=None, help="Output path without extension")
+    parser.add_argument('--shading', action='store_true',
+                        help="Correct vignetting before measuring, see stitching.py --shading")
+    parser.add_argument('--smooth', type=float, default=0.02, help="Smoothing (mm)")
+    parser.add_argument('--detrend', type=float, default=1.0, help="Detrending scale (mm)")
+    parser.add_argument('--min-ring', type=float, default=0.15, help="Narrowest ring (mm)")
+    parser.add_argument('--min-contrast', type=float, default=5.0,
+                        help="Weakest boundary, in deviations of the profile's gradient")
+    args = parser.parse_args()
+
+    result = analyze_capture(args.folder, args.name, args.panorama, args.px_per_mm,
+                             args.magnification, args.pith, args.last_year, args.output,
+                             args.shading, smooth_mm=args.smooth, detrend_mm=args.detrend,
+                             min_ring_mm=args.min_ring, min_contrast=args.min_contrast)
+    print(f"{result['rings']} rings over {result['core_mm']:.1f} mm, "
+          f"mean width {np.mean(result['widths_mm']) if result['rings'] else 0:.3f} mm "
+          f"({result['px_per_mm']:.1f} px/mm, {result['seconds']} s)")
+    print("Wrote " + ", ".join(result['files']))
+    sys.exit(0)
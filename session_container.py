@@ -0,0 +1,377 @@
+import os, json, glob, time, hashlib, argparse, threading
+import cv2
+import numpy as np
+
+CONTAINER_SUFFIX = '_session.frames'
+_MAGIC = b'TRIMFRM1'
+_HEADER_SIZE = 4096
+_RECORD_SIZE = 512
+_ALIGNMENT = 4096
+
+
+class SessionContainer:
+    def __init__(self, path: str, writable: bool = False) -> None:
+        """
+        @brief  Opens a session container: a single file holding every still of a run, instead of
+                one loose image file per position. The file starts with a header, followed by a
+                table of fixed-size JSON records and then the frames themselves, uncompressed in
+                fixed-size slots that start on page boundaries, so any frame can be memory-mapped
+                and sliced without copying. Frames are appended, and a frame only counts once its
+                record is written after its pixels are on disk. The record is synced to disk before
+                write returns, and a record cut off by a crash ends the table when it is read, so a
+                crash loses at most the frame being written. A frame written again (e.g. retaken) goes to a new slot, and the old
+                one stays valid until the new record replaces it.
+        @param path     Container file, see create.
+        @param writable Open for writing frames as well.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # Unbuffered, so refresh reads the table from the file rather than a stale buffer of it
+        self._stream = open(path, 'r+b' if writable else 'rb', buffering=0)
+        header = self._stream.read(_HEADER_SIZE)
+        if header[:len(_MAGIC)] != _MAGIC: raise ValueError(f"{path} is not a session container")
+        self.header = json.loads(header[len(_MAGIC):].rstrip(b'\x00'))
+        self.shape = (self.header['height'], self.header['width'], self.header['channels'])
+        self.frame_bytes = int(np.prod(self.shape))
+        self.frame_stride = self.header.get('frame_stride', self.frame_bytes)  # Version 1 had no padding
+        self._records = 0
+        self._latest = {}  # Newest record of each frame
+        self._slots = 0
+        self._map = None
+        self.refresh()
+
+    @classmethod
+    def create(cls, path: str, height: int, width: int, channels: int = 3,
+               max_frames: int = 4096, **attributes) -> 'SessionContainer':
+        """
+        @brief  Creates an empty container, replacing any file at path.
+        @param path         Container file, usually <name>_session.frames in the capture folder.
+        @param height       Frame height.
+        @param width        Frame width.
+        @param channels     Channels of each frame (BGR).
+        @param max_frames   Records the table has room for. Each write and annotate takes one.
+        @param attributes   Other values to keep in the header, e.g. the image name.
+        @return Container open for writing.
+        """
+        table_end = _HEADER_SIZE + max_frames * _RECORD_SIZE
+        frame_bytes = height * width * channels
+        header = dict(attributes, version=2, height=height, width=width, channels=channels,
+                      dtype='uint8', max_frames=max_frames, record_size=_RECORD_SIZE,
+                      data_offset=(table_end + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT,
+                      frame_stride=(frame_bytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT,
+                      created=time.strftime('%Y-%m-%d %H:%M:%S'))
+        encoded = _MAGIC + json.dumps(header).encode()
+        if len(encoded) > _HEADER_SIZE: raise ValueError("Container attributes are too long")
+        with open(path, 'wb') as stream:
+            stream.write(encoded.ljust(_HEADER_SIZE, b'\x00'))
+            stream.truncate(header['data_offset'])  # An all-zero table: no frames
+        return cls(path, writable=True)
+
+    def refresh(self) -> None:
+        """
+        @brief  Rereads the frame table, e.g. to see frames another program appended since.
+        """
+        with self._lock:
+            self._stream.seek(_HEADER_SIZE + self._records * _RECORD_SIZE)
+            while self._records < self.header['max_frames']:
+                record = self._stream.read(_RECORD_SIZE)
+                if len(record) < _RECORD_SIZE or not record[0]: break
+                try:
+                    record = json.loads(record.rstrip(b'\x00'))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break  # Cut off by a crash
+                self._add_record(record)
+
+    def _add_record(self, record: dict) -> None:
+        # A frame written again (e.g. retaken) gets a newer record pointing at its new slot
+        self._records += 1
+        self._latest[record['file']] = record
+        self._slots = max(self._slots, record['slot'] + 1)
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._latest
+
+    def names(self) -> list:
+        """
+        @brief  Gets the file names of the frames, in slot order, i.e. the order they were first
+                written.
+        """
+        return sorted(self._latest, key=lambda name: self._latest[name]['slot'])
+
+    def record(self, name: str) -> dict:
+        """
+        @brief  Gets the metadata of a frame: its 'file' name, 'slot', 'sha256' checksum of its
+                pixels, the 'time' it was written and what the writer added.
+        """
+        return self._latest[name]
+
+    def table(self) -> list:
+        """
+        @brief  Gets the newest metadata record of every frame, in slot order.
+        """
+        return [self.record(name) for name in self.names()]
+
+    def frames(self) -> np.ndarray:
+        """
+        @brief  Maps all slots, without reading or copying them. Slots of frames that were
+                written again hold their old pixels.
+        @return Read-only array of shape (slots, height, width, channels).
+        """
+        with self._lock:
+            count = self._slots
+            if self._map is None or len(self._map) != count:
+                if count:
+                    slots = np.memmap(self.path, dtype=np.uint8, mode='r', offset=self.header['data_offset'],
+                                      shape=(count, self.frame_stride))
+                    self._map = slots[:, :self.frame_bytes].reshape((count,) + self.shape)  # A view
+                else:
+                    self._map = np.empty((0,) + self.shape, np.uint8)
+            return self._map
+
+    def frame(self, name: str) -> np.ndarray:
+        """
+        @brief  Maps a frame, without reading or copying it.
+        @param name File name the frame was written under.
+        @return Read-only BGR array, like cv2.imread gives.
+        """
+        if name not in self._latest: self.refresh()
+        return self.frames()[self._latest[name]['slot']]
+
+    def checksum(self, name: str) -> str:
+        """
+        @brief  Hashes a frame's pixels as they are in the file now, to check them against the
+                checksum recorded when they were written.
+        @return SHA-256 hex digest.
+        """
+        return hashlib.sha256(self.frame(name)).hexdigest()
+
+    def write(self, name: str, image: np.ndarray, **metadata) -> dict:
+        """
+        @brief  Appends a frame, or a new version of a frame of the same name. The pixels go to
+                a new slot and are flushed to disk before the record that points at them is
+                written, so the previous version stays readable until then.
+        @param name     File name of the frame, e.g. core_0003.tif. Exporting writes it to this name.
+        @param image    BGR image of the container's shape.
+        @param metadata Other values to keep in the frame's record, e.g. its stage position.
+        @return The frame's record.
+        """
+        if image.shape != self.shape: raise ValueError(f"Frame is {image.shape}, the container holds {self.shape}")
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        with self._lock:
+            slot = self._slots
+            if self._records >= self.header['max_frames']: raise IOError(f"{self.path} is full")
+            record = dict(metadata, file=name, slot=slot, time=round(time.time(), 3),
+                          sha256=hashlib.sha256(image.data).hexdigest())
+            encoded = json.dumps(record).encode()
+            if len(encoded) >= _RECORD_SIZE: raise ValueError(f"Metadata of {name} is too long")
+            self._stream.seek(self.header['data_offset'] + slot * self.frame_stride)
+            self._stream.write(image.data)
+            self._stream.write(b'\x00' * (self.frame_stride - self.frame_bytes))
+            os.fsync(self._stream.fileno())
+            self._write_record(encoded, record)
+        return record
+
+    def annotate(self, name: str, **metadata) -> dict:
+        """
+        @brief  Adds values to the metadata of a frame, e.g. once it has been journaled.
+        @param name     File name of the frame.
+        @param metadata Values to add or replace.
+        @return The frame's new record.
+        """
+        with self._lock:
+            if self._records >= self.header['max_frames']: raise IOError(f"{self.path} is full")
+            record = dict(self._latest[name], **metadata)
+            encoded = json.dumps(record).encode()
+            if len(encoded) >= _RECORD_SIZE: raise ValueError(f"Metadata of {name} is too long")
+            self._write_record(encoded, record)
+        return record
+
+    def _write_record(self, encoded: bytes, record: dict) -> None:
+        # The record only counts once it is on disk
+        self._stream.seek(_HEADER_SIZE + self._records * _RECORD_SIZE)
+        self._stream.write(encoded.ljust(_RECORD_SIZE, b'\x00'))
+        os.fsync(self._stream.fileno())
+        self._add_record(record)
+
+    def close(self) -> None:
+        with self._lock:
+            self._map = None
+            self._stream.close()
+        with _OPEN_LOCK:
+            if _OPEN.get(os.path.abspath(self.path)) is self: del _OPEN[os.path.abspath(self.path)]
+
+
+_OPEN = {}  # Containers opened by open_container, so every reader in the program shares one
+_OPEN_LOCK = threading.Lock()
+
+
+def open_container(path: str) -> SessionContainer:
+    """
+    @brief  Gets the program's shared reader of a container, or the writer if the program is
+            writing it.
+    """
+    key = os.path.abspath(path)
+    with _OPEN_LOCK:
+        if key not in _OPEN: _OPEN[key] = SessionContainer(path)
+        return _OPEN[key]
+
+
+def register_container(container: SessionContainer) -> None:
+    """
+    @brief  Makes open_container return a container the program is writing.
+    """
+    with _OPEN_LOCK:
+        _OPEN[os.path.abspath(container.path)] = container
+
+
+def locate(path: str) -> tuple:
+    """
+    @brief  Finds the container that holds the frame a path names, if there is no file at the
+            path itself. Frames are stored under their usual file names, so a still of a run
+            captured into a container keeps its path.
+    @param path Image path, e.g. tree_core/core_0003.tif.
+    @return (container, name) tuple, or None if the path is a file or no container holds it.
+    """
+    if os.path.exists(path): return None
+    name = os.path.basename(path)
+    for container_path in sorted(glob.glob(os.path.join(glob.escape(os.path.dirname(path) or '.'),
+                                                        '*' + CONTAINER_SUFFIX))):
+        try:
+            container = open_container(container_path)
+        except (OSError, ValueError):
+            continue
+        if name not in container: container.refresh()
+        if name in container: return container, name
+    return None
+
+
+def read_frame(path: str, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    """
+    @brief  Reads an image file, or the frame of that name from a session container next to it.
+    @param path     Image path.
+    @param flags    cv2.imread flags: IMREAD_COLOR, IMREAD_GRAYSCALE or IMREAD_REDUCED_*.
+    @return BGR (or grey) image, or None if it could not be read. Container frames are only
+            copied if they have to be converted.
+    """
+    found = locate(path)
+    if found is None: return cv2.imread(path, flags)
+    frame = found[0].frame(found[1])
+    reduced = {cv2.IMREAD_REDUCED_COLOR_2: 2, cv2.IMREAD_REDUCED_COLOR_4: 4, cv2.IMREAD_REDUCED_COLOR_8: 8,
+               cv2.IMREAD_REDUCED_GRAYSCALE_2: 2, cv2.IMREAD_REDUCED_GRAYSCALE_4: 4,
+               cv2.IMREAD_REDUCED_GRAYSCALE_8: 8}
+    if flags in reduced:
+        factor = reduced[flags]
+        frame = cv2.resize(frame, (frame.shape[1] // factor, frame.shape[0] // factor),
+                           interpolation=cv2.INTER_AREA)
+    if flags in (cv2.IMREAD_GRAYSCALE, cv2.IMREAD_REDUCED_GRAYSCALE_2, cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                 cv2.IMREAD_REDUCED_GRAYSCALE_8):
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame
+
+
+def frame_exists(path: str) -> bool:
+    """
+    @brief  Checks that an image file, or a container frame of that name next to it, exists.
+    """
+    return os.path.exists(path) or locate(path) is not None
+
+
+def frame_checksum(path: str) -> str:
+    """
+    @brief  Gets the checksum a container recorded for a frame when it was written. Cheap, but it
+            says nothing about the pixels now in the file: use frame_digest to check them.
+    @return SHA-256 hex digest of the frame's pixels, or None if path is not a container frame.
+    """
+    found = locate(path)
+    return found[0].record(found[1])['sha256'] if found is not None else None
+
+
+def frame_digest(path: str) -> str:
+    """
+    @brief  Hashes the pixels of a container frame as they are in the file now.
+    @return SHA-256 hex digest, or None if path is not a container frame.
+    """
+    found = locate(path)
+    return found[0].checksum(found[1]) if found is not None else None
+
+
+def container_frames(folder: str, name: str = None) -> list:
+    """
+    @brief  Lists the frames held by the session containers in a folder as image paths, which
+            read_frame and the functions above accept.
+    @param folder   Capture folder.
+    @param name     Image name, or None for every container in the folder.
+    @return Paths, in the order the frames were first written.
+    """
+    pattern = (glob.escape(name) if name else '*') + CONTAINER_SUFFIX
+    frames = []
+    for container_path in sorted(glob.glob(os.path.join(glob.escape(folder), pattern))):
+        try:
+            container = open_container(container_path)
+        except (OSError, ValueError) as e:
+            print(f"Could not open {container_path}: {e}")
+            continue
+        container.refresh()
+        frames.extend(os.path.join(folder, frame) for frame in container.names())
+    return frames
+
+
+def export(path: str, output: str = None, fformat: str = None, encoder=None, progress=None) -> list:
+    """
+    @brief  Writes the frames of a container out as loose image files.
+    @param path     Container file.
+    @param output   Folder to write to. Defaults to the container's folder.
+    @param fformat  File format (jpg, png or tif). Defaults to each frame's own extension.
+    @param encoder  encoders.Encoder to write with. Defaults to the 'threaded' encoder with
+                    lossless or high quality settings.
+    @param progress Optional function called with (done, total).
+    @return Paths written.
+    """
+    from encoders import make_encoder
+    if encoder is None:
+        encoder = make_encoder({'backend': 'threaded', 'jpeg_quality': 95, 'png_compression': 1,
+                                'tiff_compression': 'deflate'}, fformat)
+    output = output or os.path.dirname(path) or '.'
+    os.makedirs(output, exist_ok=True)
+    container = SessionContainer(path)
+    written = []
+    try:
+        names = container.names()
+        for done, name in enumerate(names):
+            stem, extension = os.path.splitext(name)
+            target = os.path.join(output, f"{stem}.{fformat}" if fformat else name)
+            encoder.write(target, cv2.cvtColor(container.frame(name), cv2.COLOR_BGR2RGB),
+                          fformat or extension.lstrip('.'))
+            written.append(target)
+            if progress is not None: progress(done + 1, len(names))
+    finally:
+        container.close()
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect a session container or export its "
+                                                 "frames as loose image files.")
+    parser.add_argument('command', choices=('info', 'export'))
+    parser.add_argument('container', help="Container file (<name>_session.frames)")
+    parser.add_argument('--output', default=None, help="Folder to export to (default: the container's)")
+    parser.add_argument('--format', default=None, choices=('jpg', 'png', 'tif'),
+                        help="Export format (default: each frame's own)")
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        container = SessionContainer(args.container)
+        print(f"{args.container}: {len(container)} frame(s) of {container.shape[1]} x "
+              f"{container.shape[0]} x {container.shape[2]}, created {container.header['created']}")
+        for record in container.table():
+            extra = {key: value for key, value in record.items() if key not in ('file', 'slot', 'sha256')}
+            print(f"  {record['slot']:>5}  {record['file']}  {json.dumps(extra)}")
+        container.close()
+    else:
+        started = time.time()
+        paths = export(args.container, args.output, args.format,
+                       progress=lambda done, total: print(f"\r{done} / {total}", end='', flush=True))
+        print(f"\nExported {len(paths)} frame(s) in {time.time() - started:.1f} s")
@@ -0,0 +1,87 @@
+import time
+import numpy as np
+from camera import Camera
+
+
+class SettleDetector:
+    def __init__(self, camera: Camera, threshold: float = 1.5, noise_factor: float = 2.0,
+                 stable_frames: int = 2, step: int = 8) -> None:
+        """
+        @brief  Decides when the stage has stopped vibrating by comparing consecutive preview frames.
+        @param camera        Camera whose preview is watched.
+        @param threshold     Mean absolute frame difference (grey levels, 0~255) below which a frame
+                             counts as still.
+        @param noise_factor  The threshold is raised to this multiple of the sensor noise measured by
+                             calibrate(), so noisy cameras still settle.
+        @param stable_frames Number of still frames in a row needed to call the stage settled.
+        @param step          Downsampling step applied to preview frames before comparing them.
+        """
+        self._camera = camera
+        self._threshold = threshold
+        self._noise_factor = noise_factor
+        self._stable_frames = stable_frames
+        self._step = step
+        self._noise = 0.0
+        self.last_difference = None
+
+    def set_threshold(self, threshold: float) -> None: self._threshold = threshold
+
+    def get_threshold(self) -> float:
+        """
+        @brief  Gets the threshold in use, including the allowance for sensor noise.
+        """
+        return max(self._threshold, self._noise_factor * self._noise)
+
+    def _next_frame(self, frame_number: int, deadline: float) -> tuple:
+        """
+        @brief  Waits for a preview frame newer than frame_number.
+        @return (frame number, grey float32 frame) tuple, or (frame_number, None) at the deadline.
+        """
+        while time.time() < deadline:
+            if self._camera.get_frame_number() != frame_number:
+                frame = self._camera.get_preview_array(self._step)
+                if frame is not None:
+                    return self._camera.get_frame_number(), frame.mean(axis=2, dtype=np.float32)
+            time.sleep(0.002)
+        return frame_number, None
+
+    def calibrate(self, frames: int = 4, timeout: float = 2.0) -> float:
+        """
+        @brief  Measures the frame difference of a stationary stage, i.e. the sensor noise.
+        @param frames   Number of frame pairs to measure.
+        @param timeout  Maximum seconds to spend.
+        @return Mean noise difference, 0 if no frames arrived.
+        """
+        deadline = time.time() + timeout
+        number, previous = self._next_frame(-1, deadline)
+        differences = []
+        for _ in range(frames):
+            number, frame = self._next_frame(number, deadline)
+            if frame is None or previous is None: break
+            differences.append(float(np.abs(frame - previous).mean()))
+            previous = frame
+        self._noise = float(np.median(differences)) if differences else 0.0
+        return self._noise
+
+    def wait(self, min_wait: float, timeout: float) -> bool:
+        """
+        @brief  Blocks until the preview has been still for stable_frames frames.
+        @param min_wait Seconds to wait before looking, e.g. the time the move itself takes.
+        @param timeout  Maximum seconds to wait in total.
+        @return True if the stage settled, false if the timeout was reached first.
+        """
+        started = time.time()
+        deadline = started + timeout
+        if min_wait > 0: time.sleep(min(min_wait, timeout))
+
+        threshold = self.get_threshold()
+        number, previous = self._next_frame(self._camera.get_frame_number(), deadline)
+        still = 0
+        while previous is not None:
+            number, frame = self._next_frame(number, deadline)
+            if frame is None: break
+            self.last_difference = float(np.abs(frame - previous).mean())
+            previous = frame
+            still = still + 1 if self.last_difference < threshold else 0
+            if still >= self._stable_frames: return True
+        return False
@@ -0,0 +1,134 @@
+import os, sys, hashlib, argparse
+import cv2
+import numpy as np
+from session_container import read_frame
+
+SHADING_SUFFIX = "_shading.npy"
+
+
+def estimate_profile(frames: list, from_run: bool = True, max_frames: int = 64, scale: float = 0.125,
+                     sigma: float = 4.0) -> np.ndarray:
+    """
+    @brief  Estimates the illumination across the field of view (vignetting and uneven lighting)
+            as the median of frames. Shading is smooth, so the frames are reduced first and the
+            median is blurred, which also keeps the estimate fast and small.
+    @param frames       Frame paths. Frames of a run, or captures of the blank stage.
+    @param from_run     The frames are of a core. The ring pattern moves between frames and drops
+                        out of the median, but the core lies along the same rows of every frame,
+                        so each row is divided by its own mean: only the shading along the rows,
+                        which is what shows at the seams, is kept. For blank stage captures
+                        (False) the full shading is kept.
+    @param max_frames   Largest number of frames used, spread evenly over the run.
+    @param scale        Downscaling applied to the frames.
+    @param sigma        Blur of the median in reduced pixels, to remove what is left of the content.
+    @return float32 array (reduced height, reduced width, channels) with a mean of 1 in each channel.
+    """
+    if len(frames) < 3: raise ValueError("At least 3 frames are needed to estimate the shading")
+    picked = [frames[int(i)] for i in np.linspace(0, len(frames) - 1, min(max_frames, len(frames)))]
+    stack = None
+    for i, path in enumerate(picked):
+        image = read_frame(path)
+        if image is None: raise IOError(f"Could not read {path}")
+        small = cv2.resize(image, (max(int(image.shape[1] * scale), 8), max(int(image.shape[0] * scale), 8)),
+                           interpolation=cv2.INTER_AREA)
+        if stack is None: stack = np.empty((len(picked),) + small.shape, np.uint8)
+        stack[i] = small
+    profile = np.median(stack, axis=0).astype(np.float32)
+    profile = np.maximum(cv2.GaussianBlur(profile, (0, 0), sigma), 1.0)
+    if from_run: profile /= profile.mean(axis=1, keepdims=True)
+    profile /= profile.mean(axis=(0, 1), keepdims=True)
+    return profile
+
+
+def profile_path(folder: str, name: str) -> str:
+    """
+    @brief  Gets the path a run's shading profile is kept at, <folder>/<name>_shading.npy.
+    """
+    return os.path.join(folder, f"{name}{SHADING_SUFFIX}")
+
+
+def save_profile(path: str, profile: np.ndarray) -> None:
+    np.save(path, profile.astype(np.float32))
+
+
+def load_profile(path: str) -> np.ndarray:
+    return np.load(path).astype(np.float32)
+
+
+class ShadingCorrection:
+    def __init__(self, profile: np.ndarray) -> None:
+        """
+        @brief  Divides frames by a shading profile, so every part of the field of view is equally
+                bright. The profile is enlarged to the frame size once and kept as a gain, so
+                correcting a frame is a single vectorized multiply.
+        @param profile  Profile from estimate_profile.
+        """
+        self.profile = np.asarray(profile, dtype=np.float32)
+        self.fingerprint = hashlib.sha256(self.profile.tobytes()).hexdigest()[:16]
+        self._gains = {}  # Gain of each frame shape seen
+
+    def gain(self, shape: tuple) -> np.ndarray:
+        """
+        @brief  Gets the gain for frames of a shape: (height, width) for grey frames,
+                (height, width, channels) for color ones.
+        """
+        if shape not in self._gains:
+            profile = cv2.resize(self.profile, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+            if profile.ndim == 2: profile = profile[:, :, None]
+            profile = profile.mean(axis=2) if len(shape) == 2 else np.broadcast_to(profile, shape)
+            self._gains[shape] = np.ascontiguousarray(1.0 / profile, dtype=np.float32)
+        return self._gains[shape]
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        """
+        @brief  Corrects a frame.
+        @param image    uint8 BGR or grey frame.
+        @return Corrected uint8 frame.
+        """
+        corrected = np.multiply(image, self.gain(image.shape), dtype=np.float32)
+        corrected += 0.5
+        np.clip(corrected, 0, 255, out=corrected)
+        return corrected.astype(np.uint8)
+
+    @classmethod
+    def for_run(cls, folder: str, name: str, frames: list = None) -> 'ShadingCorrection':
+        """
+        @brief  Loads a run's shading profile, estimating it from the run's frames and saving it
+                if there is none yet.
+        @param folder   Capture folder.
+        @param name     Image name.
+        @param frames   The run's frames, needed if there is no profile yet.
+        """
+        path = profile_path(folder, name)
+        if os.path.exists(path): return cls(load_profile(path))
+        profile = estimate_profile(frames)
+        save_profile(path, profile)
+        return cls(profile)
+
+
+if __name__ == '__main__':
+    from stitching import find_frames
+    parser = argparse.ArgumentParser(description="Estimate the shading (vignetting) of a run for the "
+                                                 "stitcher, from its own frames or from captures of "
+                                                 "the blank stage.")
+    parser.add_argument('folder', help="Capture folder the profile is for")
+    parser.add_argument('--name', default=None, help="Image name (default: the most common one)")
+    parser.add_argument('--blank', default=None,
+                        help="Folder of captures of the blank stage to estimate the shading from")
+    parser.add_argument('--frames', type=int, default=64, help="Largest number of frames used")
+    args = parser.parse_args()
+
+    frames = find_frames(args.folder, args.name)
+    if not frames:
+        print(f"ERROR No frames found in {args.folder}", file=sys.stderr)
+        sys.exit(1)
+    name = args.name or os.path.basename(frames[0]).rsplit('_', 1)[0]
+    source = find_frames(args.blank) if args.blank else frames
+    try:
+        profile = estimate_profile(source, args.blank is None, args.frames)
+    except (ValueError, IOError) as e:
+        print(f"ERROR {e}", file=sys.stderr)
+        sys.exit(1)
+    path = profile_path(args.folder, name)
+    save_profile(path, profile)
+    print(f"Shading from {len(source)} frame(s): {profile.min():.3f} ~ {profile.max():.3f}, saved to {path}")
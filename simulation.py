@@ -0,0 +1,644 @@
+import os, sys, time, tty, select, threading, tempfile, argparse, collections
+import numpy as np
+from camera import Camera, camera_type
+from motion import MotionProfile, STEPS_PER_TENTH_MM, HOME_MAX_STEPS, HOME_BACKOFF_STEPS
+
+# Firmware constants mirrored from arduino/Tree_Ring/Tree_Ring.ino
+ORIGINAL_MILLIMETERS = 30           # millimeters (tenths of a mm)
+ACTIVATE_DELAY_S = 1000e-6          # delayMicroseconds(1000) in activate()
+IDLE_TIMEOUT_MS = 100               # idle_timeout default
+QUEUE_SIZE = 8                      # Moves the firmware can queue
+
+
+class VirtualArduino:
+    def __init__(self, time_scale: float = 1.0, vibration_mm: float = 0.05,
+                 settle_time: float = 0.3, limit_switch_mm: float = -5.0) -> None:
+        """
+        @brief  Emulates the Tree_Ring.ino firmware over a pseudo-terminal so that the Arduino class
+                can connect to it like a real board. Step timing follows the firmware's motion
+                profile, which the host can change with the S, V and A commands. Like the firmware,
+                moves run in the background and queue up, so commands are answered during a move.
+        @param time_scale   Multiplier applied to every modelled delay (0.1 runs moves 10x faster).
+        @param vibration_mm Amplitude of the stage's ringing when a move stops.
+        @param settle_time  Time constant (s) with which the ringing dies down.
+        @param limit_switch_mm  Where the limit switch closes, relative to the power-on position.
+        """
+        self._time_scale = time_scale
+        self._vibration_mm = vibration_mm
+        self._settle_time = settle_time
+        self._master = None
+        self._slave = None
+        self._port = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.RLock()
+
+        self.millimeters = ORIGINAL_MILLIMETERS
+        self.motion_profile = MotionProfile()
+        self._command = None
+        self._argument = b''
+        self.is_clockwise = True
+        self.is_active = False
+        self.is_holding = False
+        self.idle_timeout_ms = IDLE_TIMEOUT_MS
+        self.activations = 0  # Times the driver was woken up
+        self._last_activity = 0.0
+
+        self._position_steps = 0    # Stage position when the current move started
+        self._zero = 0              # Stage position of the firmware's position 0
+        self._switch_steps = int(round(limit_switch_mm * 10 * STEPS_PER_TENTH_MM))
+        self.is_homed = False
+        # Current move: start time, step completion times, steps, direction, profile, on_done
+        self._move = None
+        self._queue = collections.deque()  # Moves waiting: clockwise, steps, profile, on_done
+        self._last_end = 0.0
+        self._last_direction = 0
+        self.moves = []  # (start time, end time, steps, direction) for every finished move
+
+        self.trigger_delay_ms = 0
+        self._trigger_at = None
+        self.trigger_listeners = []  # Called in a new thread whenever the trigger line fires
+        self._program = None  # Scan program: state, moves, index, steps, settle, dwell, trigger, since
+
+    def start(self) -> str:
+        """
+        @brief  Opens the pseudo-terminal and starts serving firmware commands.
+        @return Port name to pass to Arduino(port=...).
+        """
+        if sys.platform == 'win32':
+            raise OSError("The virtual Arduino needs a pseudo-terminal and is not available on Windows.")
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self._port = os.ttyname(self._slave)
+        self._running = True
+        self._activate()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self._port
+
+    def stop(self) -> None:
+        """
+        @brief  Stops the emulator and closes the pseudo-terminal.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None: os.close(fd)
+        self._master = self._slave = None
+
+    def port(self) -> str: return self._port
+
+    def step_time(self, steps: int) -> float:
+        """
+        @brief  Models how long the firmware takes for a move of a number of steps.
+        @param steps    Number of step pulses.
+        @return Seconds of (unscaled) motor time.
+        """
+        return self.motion_profile.move_time(steps)
+
+    def _steps_done(self, now: float) -> int:
+        start, step_times, steps = self._move[:3]
+        return min(int(np.searchsorted(step_times, now - start, side='right')), steps)
+
+    def _update(self, now: float = None) -> None:
+        """
+        @brief  Finishes moves whose time is up and starts the queued ones, as the timer interrupt
+                and start_next_move() do in the firmware. A queued move starts the moment the
+                previous one ended.
+        """
+        if now is None: now = time.time()
+        with self._lock:
+            while True:
+                if self._move is not None:
+                    start, step_times, steps, direction, _, on_done = self._move
+                    end = start + step_times[-1]
+                    if now < end: return
+                    self._position_steps += direction * steps
+                    self._last_end = end
+                    self._last_direction = direction
+                    self.moves.append((start, end, steps, direction))
+                    self._move = None
+                    self._last_activity = end
+                    if on_done is not None: on_done()
+                    elif not self._queue and self.trigger_delay_ms > 0 and self._program is None:
+                        self._trigger_at = end + self.trigger_delay_ms / 1000.0 * self._time_scale
+                if not self._queue: return
+                self._trigger_at = None
+                clockwise, steps, profile, on_done = self._queue.popleft()
+                start = max(self._last_end, now - 0.001) if self._last_end else now
+                if not self.is_active:
+                    self._activate()
+                    start = time.time()
+                step_times = np.cumsum(2.0 * profile.half_periods(steps)) * self._time_scale
+                self._move = (start, step_times, steps, -1 if clockwise else 1, profile, on_done)
+
+    def position_steps(self) -> float:
+        """
+        @brief  Gets the stage position relative to where it was at power-on, interpolated while a move is in progress. Anticlockwise
+                (L) moves count up, clockwise (H) moves count down.
+        @return Position in steps.
+        """
+        now = time.time()
+        self._update(now)
+        with self._lock:
+            if self._move is None:
+                return float(self._position_steps) + self._vibration(now - self._last_end)
+            return float(self._position_steps + self._move[3] * self._steps_done(now))
+
+    def _vibration(self, since_stop: float) -> float:
+        """
+        @brief  Models the stage ringing after a move as a damped 12 Hz oscillation.
+        @param since_stop   Seconds since the last move stopped.
+        @return Offset in steps.
+        """
+        tau = self._settle_time * self._time_scale
+        if self._last_end <= 0 or tau <= 0 or since_stop > 6 * tau: return 0.0
+        amplitude = self._vibration_mm * STEPS_PER_TENTH_MM * 10 * self._last_direction
+        return amplitude * np.exp(-since_stop / tau) * np.cos(2 * np.pi * 12.0 * since_stop)
+
+    def position_mm(self) -> float:
+        """
+        @brief  Gets the stage position in mm.
+        """
+        return self.position_steps() / (STEPS_PER_TENTH_MM * 10)
+
+    def is_moving(self) -> bool:
+        self._update()
+        return self._move is not None
+
+    def _sleep(self, seconds: float) -> None:
+        if seconds > 0: time.sleep(seconds * self._time_scale)
+
+    def _write(self, data: bytes) -> None:
+        """
+        @brief  Writes to the host. Bytes the host never reads are dropped once the pty buffer is
+                full, like an overflowing UART.
+        """
+        try:
+            os.write(self._master, data)
+        except (BlockingIOError, OSError):
+            pass
+
+    def _activate(self) -> None:
+        if not self.is_active:
+            self.is_active = True
+            self.activations += 1
+            self._sleep(ACTIVATE_DELAY_S)
+        self._last_activity = time.time()
+
+    def _queue_move(self, clockwise: bool, steps: int) -> None:
+        """
+        @brief  Emulates queue_move(): the move is queued and the command returns at once.
+        """
+        with self._lock:
+            if len(self._queue) == QUEUE_SIZE:
+                self._write(b"E queue full\r\n")
+                return
+            self._queue.append((clockwise, steps, self.motion_profile, None))
+        self._update()
+
+    def _planned_position(self) -> int:
+        """
+        @brief  Gets the firmware position once every queued move has run.
+        """
+        with self._lock:
+            position = self._position_steps - self._zero
+            if self._move is not None: position += self._move[2] * self._move[3]
+            return position + sum(-steps if clockwise else steps for clockwise, steps, _, _ in self._queue)
+
+    def _start_homing(self) -> None:
+        """
+        @brief  Emulates start_homing() and update_homing(). As the switch position is known, the
+                move towards it and the slow move back off it are worked out up front.
+        """
+        self._update()
+        with self._lock:
+            if self._move is not None:
+                self._write(b"E busy\r\n")
+                return
+            self._queue.clear()
+            # The seek has no ramp, so the interrupt stops on the step that closed the switch.
+            seek_profile = MotionProfile.constant(self.motion_profile.start_speed)
+            hit = max(1, self._position_steps - self._switch_steps)
+            seek = min(hit, HOME_MAX_STEPS)
+            backoff = self._switch_steps - (self._position_steps - seek) + 1
+            if hit > HOME_MAX_STEPS or backoff > HOME_BACKOFF_STEPS:
+                self._queue.append((True, seek, seek_profile, lambda: self._write(b"E home failed\r\n")))
+                return
+
+            def homed() -> None:
+                offset = self._position_steps - self._zero
+                self._zero = self._position_steps
+                self.is_homed = True
+                self._write(f"Z {offset}\r\n".encode())
+            self._queue.append((True, seek, seek_profile, None))
+            self._queue.append((False, backoff, MotionProfile.constant(self.motion_profile.start_speed),
+                                homed))
+        self._update()
+
+    def _stop_moving(self) -> None:
+        """
+        @brief  Emulates the X command: drops the queue and slows the current move to a stop.
+        """
+        now = time.time()
+        with self._lock:
+            homing = any(entry[3] is not None for entry in self._queue) or \
+                (self._move is not None and self._move[5] is not None)
+            if homing: self._write(b"E home stopped\r\n")
+            if self._program is not None:
+                self._program = None
+                self._write(b"Q stopped\r\n")
+            self._queue.clear()
+            if self._move is None: return
+            start, step_times, steps, direction, profile, _ = self._move
+            done = self._steps_done(now)
+            n = min(done, steps - 1 - done, profile.ramp_steps())
+            new_steps = min(done + n + 1, steps)
+            # The remaining steps slow down like the end of a move of new_steps steps
+            tail = 2.0 * profile.half_periods(new_steps)[done:] * self._time_scale
+            elapsed = step_times[done - 1] if done > 0 else 0.0
+            self._move = (start, np.concatenate((step_times[:done], elapsed + np.cumsum(tail))),
+                          new_steps, direction, profile, None)
+
+    def _fire_trigger(self) -> None:
+        """
+        @brief  Emulates fire_trigger(): tells the listeners and replies "T <position>".
+        """
+        self._trigger_at = None
+        for listener in self.trigger_listeners:
+            threading.Thread(target=listener, daemon=True).start()
+        self._write(b"T " + self._status().split()[2] + b"\r\n")
+
+    def _start_program(self, values: list) -> None:
+        """
+        @brief  Emulates start_program().
+        @param values   Moves, steps, settle ms, dwell ms and trigger flag.
+        """
+        self._update()
+        values = (values + [0] * 5)[:5]
+        moves, steps, settle, dwell, trigger = values
+        if self._move is not None or self._queue or moves < 0 or steps == 0:
+            self._write(b"E busy\r\n")
+            return
+        self._program = {'state': 'settling', 'moves': moves, 'index': 0, 'steps': steps,
+                         'settle': max(settle, 0) / 1000.0 * self._time_scale,
+                         'dwell': max(dwell, 0) / 1000.0 * self._time_scale,
+                         'trigger': trigger != 0, 'since': time.time()}
+
+    def _update_program(self) -> None:
+        """
+        @brief  Emulates update_program(): settle, report (and trigger), dwell, move.
+        """
+        program = self._program
+        if program is None: return
+        now = time.time()
+        if program['state'] == 'moving':
+            if self.is_moving() or self._queue: return
+            program['state'] = 'settling'
+            program['since'] = self._last_end
+        elif program['state'] == 'settling' and now - program['since'] >= program['settle']:
+            if program['trigger']:
+                for listener in self.trigger_listeners:
+                    threading.Thread(target=listener, daemon=True).start()
+            position = self._status().split()[2]
+            self._write(b"Q " + str(program['index']).encode() + b" " + position + b"\r\n")
+            program['state'] = 'dwelling'
+            program['since'] = now
+        elif program['state'] == 'dwelling' and now - program['since'] >= program['dwell']:
+            if program['index'] == program['moves']:
+                self._program = None
+                self._write(b"Q done\r\n")
+                return
+            program['index'] += 1
+            self._queue_move(program['steps'] < 0, abs(program['steps']))
+            program['state'] = 'moving'
+
+    def _status(self) -> bytes:
+        now = time.time()
+        self._update(now)
+        with self._lock:
+            homed = 1 if self.is_homed else 0
+            # Homing moves are not in the firmware's queue
+            queued = sum(1 for entry in self._queue if entry[3] is None and entry[2] is self.motion_profile)
+            if self._move is None:
+                moving = 0 if self._program is None else 1
+                return f"S {moving} {self._position_steps - self._zero} 0 {queued} {homed}\r\n".encode()
+            done = self._steps_done(now)
+            position = self._position_steps - self._zero + self._move[3] * done
+            return f"S 1 {position} {self._move[2] - done} {queued} {homed}\r\n".encode()
+
+    def _set_argument(self, command: int, value: int) -> None:
+        """
+        @brief  Applies a command that takes a number, like read_number() in Tree_Ring.ino.
+        """
+        if command == ord('I'):
+            self.idle_timeout_ms = max(value, 0)
+            return
+        if command == ord('K'):
+            self.is_holding = value != 0
+            if self.is_holding: self._activate()
+            return
+        if command == ord('T'):
+            self.trigger_delay_ms = max(value, 0)
+            return
+        if command == ord('G'):
+            distance = value - self._planned_position()
+            if distance != 0: self._queue_move(distance < 0, abs(distance))
+            return
+        value = max(value, 100)
+        if command == ord('S'): self.motion_profile.start_speed = float(value)
+        elif command == ord('V'): self.motion_profile.cruise_speed = float(value)
+        elif command == ord('A'): self.motion_profile.acceleration = float(value)
+
+    def _handle(self, byte: int) -> None:
+        """
+        @brief  Handles one command byte the same way loop() in Tree_Ring.ino does.
+        """
+        if self._command == ord('Q'):
+            # Collecting the numbers of a scan program up to the end of the line
+            if byte not in b'\r\n':
+                self._argument += bytes([byte])
+                return
+            values = [int(value) for value in self._argument.split() if value.lstrip(b'-').isdigit()]
+            self._command = None
+            self._argument = b''
+            self._start_program(values)
+            return
+        if self._command is not None:
+            # Collecting the number after S, V, A or G, like collect_argument()
+            if chr(byte).isdigit() or (byte == ord('-') and not self._argument):
+                self._argument += bytes([byte])
+                return
+            self._set_argument(self._command, int(self._argument if self._argument.strip(b'-') else b'0'))
+            self._command = None
+            self._argument = b''
+            if byte in b'\r\n': return
+
+        if byte in b'SVAGTQIK':
+            self._command = byte
+        elif byte == ord('H'):
+            self._write(b"Clockwise\r\n")
+            self.is_clockwise = True
+        elif byte == ord('L'):
+            self._write(b"AntiClockwise\r\n")
+            self.is_clockwise = False
+        elif byte == ord('M'):
+            self._queue_move(self.is_clockwise, STEPS_PER_TENTH_MM * self.millimeters)
+        elif byte == ord('R'):
+            self.millimeters = ORIGINAL_MILLIMETERS
+            self._write(f"{self.millimeters}\r\n".encode())
+        elif byte == ord('+'):
+            self.millimeters += 1
+            self._write(f"{self.millimeters}\r\n".encode())
+        elif byte == ord('-'):
+            self.millimeters -= 1
+            self._write(f"{self.millimeters}\r\n".encode())
+        elif byte == ord('='):
+            self._write(f"{self.millimeters}\r\n".encode())
+        elif byte == ord('?'):
+            self._write(self._status())
+        elif byte == ord('P'):
+            position = self._status().split()[2]
+            self._write(b"P " + position + b"\r\n")
+        elif byte == ord('X'):
+            self._stop_moving()
+        elif byte == ord('Z'):
+            self._start_homing()
+        elif byte == ord('F'):
+            self._fire_trigger()
+
+    def _serve(self) -> None:
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.005)
+            if readable:
+                try:
+                    data = os.read(self._master, 64)
+                except (BlockingIOError, OSError):
+                    data = b''
+                for byte in data:
+                    self._handle(byte)
+            self._update()
+            self._update_program()
+            if self._trigger_at is not None and time.time() >= self._trigger_at:
+                self._fire_trigger()
+            if self.is_holding or self._move is not None or self._queue or self._program is not None:
+                self._last_activity = max(self._last_activity, time.time())
+            elif self.is_active and \
+                    time.time() - self._last_activity >= self.idle_timeout_ms / 1000.0 * self._time_scale:
+                self.is_active = False
+
+
+class SyntheticCore:
+    def __init__(self, length_mm: float = 200.0, seed: int = 0) -> None:
+        """
+        @brief  A procedurally generated tree core with known ring boundaries, used by the
+                SimulatedCamera so that captured runs contain real structure.
+        @param length_mm    Length of the core in mm.
+        @param seed         Random seed for the ring widths.
+        """
+        rng = np.random.default_rng(seed)
+        widths = rng.uniform(0.4, 3.0, size=int(length_mm / 0.4) + 1)
+        boundaries = np.concatenate(([0.0], np.cumsum(widths)))
+        self.length_mm = length_mm
+        self.boundaries = boundaries[boundaries <= length_mm]
+        self._grain = np.convolve(rng.normal(size=int(length_mm * 100) + 8), np.ones(4) / 2, 'same')
+
+    def ring_widths(self) -> np.ndarray:
+        """
+        @brief  Gets the true ring widths in mm.
+        """
+        return np.diff(self.boundaries)
+
+    def render(self, x0_mm: float, width: int, height: int, px_per_mm: float) -> np.ndarray:
+        """
+        @brief  Renders the part of the core starting at x0_mm as a BGR frame.
+        @param x0_mm     Core coordinate of the left edge of the frame.
+        @param width     Frame width in pixels.
+        @param height    Frame height in pixels.
+        @param px_per_mm Magnification.
+        @return uint8 array of shape (height, width, 3).
+        """
+        rows = np.arange(height, dtype=np.float32)[:, None]
+        cols = np.arange(width, dtype=np.float32)[None, :]
+        x = x0_mm + (cols + 0.02 * (rows - height / 2)) / px_per_mm  # Rings lean slightly
+        index = np.clip(np.searchsorted(self.boundaries, x) - 1, 0, len(self.boundaries) - 2)
+        start = self.boundaries[index]
+        fraction = (x - start) / (self.boundaries[index + 1] - start)
+        latewood = np.clip((fraction - 0.6) / 0.4, 0.0, 1.0)
+        grain_index = np.clip((x * 100).astype(np.int64), 0, len(self._grain) - 1)
+        grain = 8.0 * self._grain[grain_index] * (1.0 + 0.5 * np.sin(rows * 0.21))
+        value = 200.0 - 110.0 * latewood * latewood + grain
+
+        inside = (x >= 0) & (x <= self.length_mm) & (np.abs(rows - height / 2) < height * 0.3)
+        value = np.where(inside, value, 55.0)
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = np.clip(value * 0.55, 0, 255)  # B
+        frame[..., 1] = np.clip(value * 0.80, 0, 255)  # G
+        frame[..., 2] = np.clip(value, 0, 255)         # R
+        return frame
+
+
+class _SimulatedCapture:
+    def __init__(self, core: SyntheticCore, stage: VirtualArduino, width: int, height: int,
+                 px_per_mm: float, fps: float) -> None:
+        """
+        @brief  Stands in for cv2.VideoCapture, rendering the synthetic core at the stage position.
+        """
+        self._core = core
+        self._stage = stage
+        self._width = width
+        self._height = height
+        self._px_per_mm = px_per_mm
+        self._frame_period = 1.0 / fps
+        self._last_read = 0.0
+        self._lock = threading.Lock()
+
+    def read(self) -> tuple:
+        with self._lock:
+            wait = self._last_read + self._frame_period - time.time()
+            if wait > 0: time.sleep(wait)
+            self._last_read = time.time()
+        position = self._stage.position_mm() if self._stage is not None else 0.0
+        return True, self._core.render(position, self._width, self._height, self._px_per_mm)
+
+    def isOpened(self) -> bool: return True
+
+    def release(self) -> None: pass
+
+
+class SimulatedCamera(Camera):
+    def __init__(self, stage: VirtualArduino = None, core: SyntheticCore = None, width: int = 640,
+                 height: int = 480, px_per_mm: float = 100.0, fps: float = 30.0,
+                 config_path: str = "camera_configuration.yaml") -> None:
+        """
+        @brief  Camera that renders a SyntheticCore at the VirtualArduino's stage position. It
+                behaves like the webcam fallback of Camera, so the rest of the program is unchanged.
+        @param stage     Virtual Arduino whose position is imaged. If None, the view never moves.
+        @param core      Core to image. If None, a default SyntheticCore is used.
+        @param width     Frame width in pixels.
+        @param height    Frame height in pixels.
+        @param px_per_mm Magnification in pixels per mm.
+        @param fps       Preview frame rate.
+        @param config_path  Camera profile to load settings from.
+        """
+        self._sim_capture = _SimulatedCapture(core if core is not None else SyntheticCore(), stage,
+                                              width, height, px_per_mm, fps)
+        super().__init__(config_path)
+        if stage is not None: stage.trigger_listeners.append(self._trigger_input)
+
+    def _trigger_input(self) -> None:
+        """
+        @brief  Wired to the virtual Arduino's trigger line, like the microscope's trigger input.
+        """
+        if self.is_trigger_mode(): self.save_triggered_image()
+
+    def load_camera(self) -> None:
+        self._cam_type = camera_type.WEBCAM
+        self._cam_name = 'Simulated'
+        self._hcam = self._sim_capture
+        self.connect_stream()
+
+
+def run_benchmark(core_length: float, shift_length: float, time_scale: float = 1.0,
+                  output_dir: str = None, settle: bool = True, trigger_delay_ms: int = None,
+                  scan_program: bool = False, session_container: bool = False) -> dict:
+    """
+    @brief  Runs a full automation pass against the virtual Arduino and simulated camera.
+    @param core_length  Core size (in cm).
+    @param shift_length Length to shift each turn (in mm).
+    @param time_scale   Time scale passed to the VirtualArduino.
+    @param output_dir   Folder to save images to. A temporary folder is used if None.
+    @param settle       Detect settling from the preview instead of using fixed waits.
+    @param trigger_delay_ms If given, the virtual Arduino triggers the camera this long after each
+                            move instead of the host taking each picture.
+    @param scan_program Let the virtual Arduino run the capture as a scan program.
+    @param session_container Store the pictures in a session container instead of loose files.
+    @return Dictionary of timing results. panorama_backlog is the number of pictures the live
+            panorama had not placed yet when the run ended, retakes the number of stills retaken
+            because they failed the quality check.
+    """
+    from automationScript import Arduino, Automation
+    from journal import read_journal
+    from stitching import find_frames
+
+    if output_dir is None: output_dir = tempfile.mkdtemp(prefix='trim_benchmark_')
+    virtual_arduino = VirtualArduino(time_scale=time_scale)
+    port = virtual_arduino.start()
+    camera = SimulatedCamera(stage=virtual_arduino)
+    try:
+        automation = Automation(camera, Arduino(port=port))
+        automation.set_settle_detection(settle)
+        automation.set_hardware_trigger(trigger_delay_ms is not None, trigger_delay_ms)
+        automation.set_scan_program(scan_program)
+        automation.set_session_container(session_container)
+        automation.set_capture_location(output_dir)
+        automation.set_counter_value("0")
+
+        start = time.time()
+        automation.run_automation("benchmark", core_length, shift_length)
+        camera.wait_for_still_image(5.0)
+        elapsed = time.time() - start
+        panorama_frames = automation.get_live_panorama().get_frame_count()
+        retakes = sum(1 for entry in read_journal(automation.get_journal_path("benchmark"))
+                      if entry['event'] == 'retake')
+    finally:
+        camera.close()
+        virtual_arduino.stop()
+
+    images = find_frames(output_dir, "benchmark")
+    motor_time = sum(end - begin for begin, end, _, _ in virtual_arduino.moves)
+    return {
+        'output_dir': output_dir,
+        'positions': len(images),
+        'moves': len(virtual_arduino.moves),
+        'total_s': elapsed,
+        'per_position_s': elapsed / max(len(images), 1),
+        'motor_s': motor_time,
+        'motor_fraction': motor_time / elapsed if elapsed > 0 else 0.0,
+        'driver_wakeups': virtual_arduino.activations,
+        'panorama_backlog': len(images) + retakes - panorama_frames,
+        'retakes': retakes,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark an automation run without hardware.")
+    parser.add_argument('--core-length', type=float, default=2.0, help="Core length (cm)")
+    parser.add_argument('--shift-length', type=float, default=3.0, help="Shift length (mm)")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Scale for firmware delays")
+    parser.add_argument('--output', default=None, help="Folder to save images to")
+    parser.add_argument('--no-settle', action='store_true', help="Use fixed waits")
+    parser.add_argument('--trigger-delay', type=int, default=None,
+                        help="Let the virtual Arduino trigger the camera this many ms after each move")
+    parser.add_argument('--scan-program', action='store_true',
+                        help="Let the virtual Arduino run the capture as a scan program")
+    parser.add_argument('--session-container', action='store_true',
+                        help="Store the pictures in a session container instead of loose files")
+    parser.add_argument('--compare-trigger', action='store_true',
+                        help="Run with software snaps, the hardware trigger and a triggered scan "
+                             "program, and compare")
+    args = parser.parse_args()
+
+    if args.compare_trigger:
+        delay = args.trigger_delay if args.trigger_delay is not None else 300
+        runs = {
+            'software': run_benchmark(args.core_length, args.shift_length, args.time_scale, None,
+                                      not args.no_settle),
+            'trigger': run_benchmark(args.core_length, args.shift_length, args.time_scale, None,
+                                     not args.no_settle, delay),
+            'program': run_benchmark(args.core_length, args.shift_length, args.time_scale, None,
+                                     not args.no_settle, delay, True),
+        }
+        print(f"{'':>16}  " + "  ".join(f"{run:>10}" for run in runs))
+        for key in ('positions', 'total_s', 'per_position_s', 'motor_fraction'):
+            print(f"{key:>16}  " + "  ".join(f"{runs[run][key]:>10.3f}" if isinstance(runs[run][key], float)
+                                          else f"{runs[run][key]:>10}" for run in runs))
+    else:
+        results = run_benchmark(args.core_length, args.shift_length, args.time_scale, args.output,
+                                not args.no_settle, args.trigger_delay, args.scan_program,
+                                args.session_container)
+        for key, value in results.items():
+            print(f"{key:>16}: {value:.3f}" if isinstance(value, float) else f"{key:>16}: {value}")
@@ -0,0 +1,816 @@
+import os, re, sys, json, math, time, queue, hashlib, argparse, threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from journal import read_journal, file_checksum
+from session_container import read_frame, frame_checksum, container_frames
+from shading import ShadingCorrection
+
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'tif', 'tiff', 'bmp')
+JPEG_MAX_SIZE = 65535  # Largest width or height a JPEG can have
+REDUCED_READS = {0.5: cv2.IMREAD_REDUCED_COLOR_2, 0.25: cv2.IMREAD_REDUCED_COLOR_4,
+                 0.125: cv2.IMREAD_REDUCED_COLOR_8}  # Scales OpenCV can decode to directly
+
+
+def find_frames(folder: str, name: str = None) -> list:
+    """
+    @brief  Finds the frames of a run, named <name>_NNNN.<format> like Automation saves them,
+            whether they are loose files or held in a session container (see read_frame).
+    @param folder   Capture folder.
+    @param name     Image name. If None, the most common name in the folder is used.
+    @return Paths in image number order.
+    """
+    pattern = re.compile(r'^(.*)_(\d{4,})\.(' + '|'.join(IMAGE_EXTENSIONS) + r')$', re.IGNORECASE)
+    runs = {}
+    files = set(os.listdir(folder))
+    files.update(os.path.basename(path) for path in container_frames(folder))
+    for file in files:
+        match = pattern.match(file)
+        if match: runs.setdefault(match.group(1), []).append((int(match.group(2)), file))
+    if name is None:
+        if not runs: return []
+        name = max(runs, key=lambda run: len(runs[run]))
+    return [os.path.join(folder, file) for _, file in sorted(runs.get(name, []))]
+
+
+def stage_positions(frames: list, journal_path: str) -> list:
+    """
+    @brief  Looks up where the stage was for each frame in the run's journal.
+    @param frames       Frame paths from find_frames.
+    @param journal_path The run's <name>_journal.jsonl.
+    @return Stage position in mm of every frame, or None if the journal does not cover them all.
+    """
+    entries = read_journal(journal_path)
+    starts = [entry for entry in entries if entry['event'] == 'start']
+    shift_length = starts[-1].get('shift_length') if starts else None
+    positions = {}
+    for entry in entries:
+        if entry['event'] != 'captured': continue
+        if entry.get('stage_mm') is not None:
+            positions[entry['file']] = entry['stage_mm']
+        elif shift_length is not None:
+            positions[entry['file']] = entry['position'] * shift_length
+    if any(os.path.basename(frame) not in positions for frame in frames): return None
+    return [positions[os.path.basename(frame)] for frame in frames]
+
+
+def _grey(image: np.ndarray, scale: float) -> np.ndarray:
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    if scale != 1.0:
+        grey = cv2.resize(grey, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return grey.astype(np.float32)
+
+
+def _correlate(a: np.ndarray, b: np.ndarray) -> tuple:
+    """
+    @brief  Phase correlation with a Hanning window.
+    @return (x shift, y shift) of b relative to a.
+    """
+    # phaseCorrelate can write to slices of larger arrays, so it gets copies
+    a, b = np.ascontiguousarray(a), np.ascontiguousarray(b)
+    window = cv2.createHanningWindow((a.shape[1], a.shape[0]), cv2.CV_32F)
+    (x, y), _ = cv2.phaseCorrelate(a, b, window)
+    return x, y
+
+
+def _overlap_score(a: np.ndarray, b: np.ndarray, dx: float, dy: float) -> float:
+    """
+    @brief  Normalised cross-correlation of the parts of grey frames a and b that overlap at an
+            offset. Close to 1 where the frames show the same thing.
+    """
+    height, width = a.shape
+    dx, dy = int(round(dx)), int(round(dy))
+    if not (0 <= dx < width and abs(dy) < height): return 0.0
+    overlap_a = a[max(dy, 0):height + min(dy, 0), dx:]
+    overlap_b = b[max(-dy, 0):height + min(-dy, 0), :width - dx]
+    overlap_a = overlap_a - overlap_a.mean()
+    overlap_b = overlap_b - overlap_b.mean()
+    norm = np.sqrt((overlap_a ** 2).sum() * (overlap_b ** 2).sum())
+    return float((overlap_a * overlap_b).sum() / norm) if norm > 0 else 0.0
+
+
+def _register_grey(a: np.ndarray, b: np.ndarray, prior_dx: float) -> tuple:
+    width = a.shape[1]
+    if prior_dx is None:
+        best = (0.0, 0.0, 0.0)
+        for candidate in np.linspace(0.1 * width, 0.9 * width, 17):
+            dx, dy, confidence = _register_grey(a, b, candidate)
+            # A match far from the overlap tried is one of the wrong overlap's artefacts
+            if abs(dx - candidate) < 0.1 * width and confidence > best[2]: best = (dx, dy, confidence)
+        return best
+
+    prior = int(round(min(max(prior_dx, 0), width - 8)))
+    x, y = _correlate(a[:, prior:], b[:, :width - prior])
+    # Small overlaps can correlate with a spurious peak, when the prior itself may match better
+    measured = (prior - x, -y, _overlap_score(a, b, prior - x, -y))
+    predicted = (float(prior), 0.0, _overlap_score(a, b, prior, 0))
+    return measured if measured[2] >= predicted[2] else predicted
+
+
+def register_pair(a: np.ndarray, b: np.ndarray, prior_dx: float = None, scale: float = 0.5) -> tuple:
+    """
+    @brief  Measures how far frame b is offset from frame a, so that b[y, x] shows the same point
+            as a[y + dy, x + dx]. With a prior, only the overlap the prior predicts is correlated,
+            which is faster and cannot lock onto a wrapped-around match.
+    @param a        Earlier frame (BGR or grey).
+    @param b        Later frame, the same size as a.
+    @param prior_dx Expected x offset in pixels, e.g. from the shift length. If None, overlaps
+                    from 10% to 90% of the frame are tried and the best match is kept, assuming
+                    the stage moves content leftwards.
+    @param scale    Downscaling applied before correlating.
+    @return (dx, dy, confidence) tuple; confidence is the normalised cross-correlation of the
+            overlap (1 for a perfect match, around 0 for unrelated frames).
+    """
+    prior = prior_dx * scale if prior_dx is not None else None
+    dx, dy, confidence = _register_grey(_grey(a, scale), _grey(b, scale), prior)
+    return dx / scale, dy / scale, confidence
+
+
+class NpySink:
+    def __init__(self, path: str) -> None:
+        """
+        @brief  Writes a panorama to a .npy file through a memory map, one strip at a time, so the
+                panorama never has to fit in memory. np.load(path, mmap_mode='r') reads it back.
+        @param path Output file.
+        """
+        self.path = path
+        self._array = None
+
+    def begin(self, width: int, height: int) -> None:
+        self._array = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.uint8,
+                                                shape=(height, width, 3))
+
+    def write(self, x: int, strip: np.ndarray) -> None:
+        """
+        @brief  Stores finished columns of the panorama. Strips arrive left to right.
+        @param x        Column of the strip's left edge.
+        @param strip    BGR strip of the panorama's full height.
+        """
+        self._array[:, x:x + strip.shape[1]] = strip
+
+    def close(self) -> str:
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+        return self.path
+
+
+class ImageSink(NpySink):
+    def __init__(self, path: str) -> None:
+        """
+        @brief  Writes a panorama as an ordinary image file. Strips are collected in a temporary
+                memory-mapped .npy next to the output and encoded when the panorama is finished.
+        @param path Output file; the format comes from its extension.
+        """
+        super().__init__(path + '.part.npy')
+        self._output = path
+
+    def begin(self, width: int, height: int) -> None:
+        extension = os.path.splitext(self._output)[1].lower()
+        if extension in ('.jpg', '.jpeg') and max(width, height) > JPEG_MAX_SIZE:
+            raise ValueError(f"A {width} x {height} panorama is too large for JPEG, use .tif, "
+                             f".png or .npy")
+        super().begin(width, height)
+
+    def close(self) -> str:
+        temporary_path = super().close()
+        try:
+            if not cv2.imwrite(self._output, np.load(temporary_path, mmap_mode='r')):
+                raise IOError(f"Could not write {self._output}")
+        finally:
+            os.remove(temporary_path)
+        return self._output
+
+
+class _DziLevel:
+    def __init__(self, sink: 'DziSink', level: int, width: int, height: int,
+                 smaller: '_DziLevel') -> None:
+        """
+        @brief  One level of a Deep Zoom pyramid. Collects strips until a column of tiles is
+                complete, hands the tiles to the sink to encode, and passes a half size copy of
+                each strip to the next smaller level.
+        """
+        self._sink = sink
+        self.level = level
+        self.width = width
+        self.height = height
+        self._smaller = smaller
+        self._buffer = np.zeros((height, 0, 3), np.uint8)
+        self._start = 0  # Column of the panorama at self._buffer[:, 0]
+        self._column = 0  # Next column of tiles to write
+        self._odd = None  # Column left over from halving the last strip
+
+    def write(self, strip: np.ndarray) -> None:
+        tile, overlap = self._sink.tile_size, self._sink.overlap
+        self._buffer = np.concatenate((self._buffer, strip), axis=1)
+        while self._column * tile < self.width:
+            right = min((self._column + 1) * tile + overlap, self.width)
+            if self._start + self._buffer.shape[1] < right: break
+            left = max(self._column * tile - overlap, 0)
+            for row in range(math.ceil(self.height / tile)):
+                top, bottom = max(row * tile - overlap, 0), min((row + 1) * tile + overlap, self.height)
+                self._sink.write_tile(self.level, self._column, row,
+                                      self._buffer[top:bottom, left - self._start:right - self._start])
+            self._column += 1
+            drop = max(self._column * tile - overlap - self._start, 0)
+            self._buffer = self._buffer[:, drop:]
+            self._start += drop
+
+        if self._smaller is not None:
+            if self._odd is not None: strip = np.concatenate((self._odd, strip), axis=1)
+            even = strip.shape[1] // 2 * 2
+            self._odd = strip[:, even:] if even < strip.shape[1] else None
+            if even: self._smaller.write(self._halve(strip[:, :even]))
+
+    def close(self) -> None:
+        if self._smaller is None: return
+        if self._odd is not None: self._smaller.write(self._halve(np.concatenate((self._odd, self._odd), axis=1)))
+        self._smaller.close()
+
+    def _halve(self, strip: np.ndarray) -> np.ndarray:
+        """
+        @brief  Averages 2 x 2 blocks of an even width strip.
+        """
+        if strip.shape[0] % 2: strip = np.concatenate((strip, strip[-1:]), axis=0)
+        blocks = strip.reshape(strip.shape[0] // 2, 2, strip.shape[1] // 2, 2, 3).astype(np.uint16)
+        return ((blocks.sum(axis=(1, 3)) + 2) // 4).astype(np.uint8)
+
+
+class DziSink:
+    def __init__(self, path: str, tile_size: int = 254, overlap: int = 1, tile_format: str = 'jpg',
+                 quality: int = 90, workers: int = None) -> None:
+        """
+        @brief  Writes a panorama as a Deep Zoom image: a .dzi descriptor and a <name>_files folder
+                with a folder of tiles for every level of the pyramid, from the full size image
+                down to a single pixel. Viewers such as OpenSeadragon, or read_dzi_region, only
+                load the tiles they show, so any part of a gigapixel core opens quickly. Tiles are
+                written while the strips arrive and encoded on a pool of threads.
+        @param path         Output .dzi file.
+        @param tile_size    Tile width and height, not counting the overlap.
+        @param overlap      Pixels each tile shares with its neighbours.
+        @param tile_format  Tile file format, 'jpg' or 'png'.
+        @param quality      JPEG quality (0~100).
+        @param workers      Encoding threads. Defaults to the number of CPUs.
+        """
+        self.path = path
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_format = tile_format
+        self._parameters = [cv2.IMWRITE_JPEG_QUALITY, quality] if tile_format == 'jpg' else []
+        self._workers = workers or os.cpu_count() or 1
+        self._tiles_dir = os.path.splitext(path)[0] + '_files'
+        self._largest = None
+        self._pool = None
+        self._pending = []
+
+    def begin(self, width: int, height: int) -> None:
+        self._width, self._height = width, height
+        levels = math.ceil(math.log2(max(width, height))) + 1
+        self._largest = None
+        for level in range(levels):  # Smallest first, so each level knows the next smaller one
+            scale = 2 ** (levels - 1 - level)
+            self._largest = _DziLevel(self, level, math.ceil(width / scale),
+                                      math.ceil(height / scale), self._largest)
+            os.makedirs(os.path.join(self._tiles_dir, str(level)), exist_ok=True)
+        self._pool = ThreadPoolExecutor(self._workers)
+
+    def write(self, x: int, strip: np.ndarray) -> None:
+        """
+        @brief  Adds finished columns of the panorama. Strips arrive left to right.
+        """
+        self._largest.write(strip)
+
+    def write_tile(self, level: int, column: int, row: int, tile: np.ndarray) -> None:
+        # Waits for old tiles once enough are queued, to bound the memory they hold
+        while len(self._pending) >= 4 * self._workers: self._pending.pop(0).result()
+        path = os.path.join(self._tiles_dir, str(level), f"{column}_{row}.{self.tile_format}")
+        self._pending.append(self._pool.submit(self._encode, path, tile.copy()))
+
+    def _encode(self, path: str, tile: np.ndarray) -> None:
+        success, data = cv2.imencode('.' + self.tile_format, tile, self._parameters)
+        if not success: raise IOError(f"Could not encode {path}")
+        with open(path, 'wb') as stream:
+            stream.write(data.tobytes())
+
+    def close(self) -> str:
+        if self._pool is None: return self.path
+        try:
+            self._largest.close()
+            for future in self._pending: future.result()
+        finally:
+            self._pool.shutdown()
+            self._pool = None
+            self._pending = []
+        with open(self.path, 'w') as stream:
+            stream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                         '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                         f'Format="{self.tile_format}" Overlap="{self.overlap}" '
+                         f'TileSize="{self.tile_size}">\n'
+                         f'  <Size Width="{self._width}" Height="{self._height}"/>\n'
+                         '</Image>\n')
+        return self.path
+
+
+def read_dzi_region(path: str, x: int, y: int, width: int, height: int, level: int = None) -> np.ndarray:
+    """
+    @brief  Reads part of a Deep Zoom image, loading only the tiles it covers.
+    @param path     The .dzi file.
+    @param x        Left edge of the region, in pixels of the level.
+    @param y        Top edge of the region, in pixels of the level.
+    @param width    Region width.
+    @param height   Region height.
+    @param level    Pyramid level; the largest (full size) level if None.
+    @return BGR image, cut off at the edges of the level.
+    """
+    with open(path) as stream: descriptor = stream.read()
+    field = lambda name: re.search(name + r'="([^"]+)"', descriptor).group(1)
+    tile, overlap, tile_format = int(field('TileSize')), int(field('Overlap')), field('Format')
+    full_width, full_height = int(field('Width')), int(field('Height'))
+    levels = math.ceil(math.log2(max(full_width, full_height))) + 1
+    if level is None: level = levels - 1
+    scale = 2 ** (levels - 1 - level)
+    level_width, level_height = math.ceil(full_width / scale), math.ceil(full_height / scale)
+    width, height = min(width, level_width - x), min(height, level_height - y)
+
+    region = np.zeros((max(height, 0), max(width, 0), 3), np.uint8)
+    tiles_dir = os.path.join(os.path.splitext(path)[0] + '_files', str(level))
+    for row in range(y // tile, (y + height - 1) // tile + 1):
+        for column in range(x // tile, (x + width - 1) // tile + 1):
+            image = cv2.imread(os.path.join(tiles_dir, f"{column}_{row}.{tile_format}"))
+            if image is None: continue
+            # Tile pixel (0, 0) is at the tile's corner minus the overlap, except on the first row/column
+            left = column * tile - (overlap if column else 0)
+            top = row * tile - (overlap if row else 0)
+            x0, y0 = max(x, column * tile), max(y, row * tile)
+            x1, y1 = min(x + width, (column + 1) * tile), min(y + height, (row + 1) * tile)
+            region[y0 - y:y1 - y, x0 - x:x1 - x] = image[y0 - top:y1 - top, x0 - left:x1 - left]
+    return region
+
+
+def make_sink(path: str):
+    """
+    @brief  Picks the sink for an output path from its extension.
+    """
+    if path.lower().endswith('.dzi'): return DziSink(path)
+    return NpySink(path) if path.lower().endswith('.npy') else ImageSink(path)
+
+
+class RegistrationCache:
+    def __init__(self, path: str) -> None:
+        """
+        @brief  Remembers the registration of frame pairs between stitches, in a JSON file in the
+                capture folder. Entries are keyed by the contents of both frames and the
+                registration parameters, so a replaced frame or a changed parameter is simply a
+                miss. Frame hashes are remembered against each file's size and modification time,
+                so unchanged frames are not hashed again.
+        @param path Cache file, e.g. <folder>/<name>_registration.json.
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._changed = False
+        try:
+            with open(path, "r") as stream:
+                values = json.load(stream)
+            self._files, self._pairs = values['files'], values['pairs']
+        except (OSError, ValueError, KeyError):
+            self._files, self._pairs = {}, {}
+
+    def frame_hash(self, path: str) -> str:
+        """
+        @brief  Gets the SHA-256 of a frame's contents, hashing it only if it changed on disk.
+        """
+        recorded = frame_checksum(path)  # Session containers hash frames as they are written
+        if recorded is not None: return recorded
+        stat = os.stat(path)
+        name = os.path.basename(path)
+        known = self._files.get(name)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]: return known[2]
+        digest = file_checksum(path)
+        self._files[name] = [stat.st_size, stat.st_mtime_ns, digest]
+        self._changed = True
+        return digest
+
+    def key(self, path_a: str, path_b: str, prior_dx: float, scale: float, shading: str = None) -> str:
+        prior = 'none' if prior_dx is None else f"{prior_dx:.2f}"
+        text = f"{self.frame_hash(path_a)}:{self.frame_hash(path_b)}:{prior}:{scale}"
+        if shading is not None: text += f":{shading}"  # Corrected frames register differently
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key: str) -> tuple:
+        """
+        @brief  Looks up a registration.
+        @return (dx, dy, confidence, frame width) tuple, or None if the pair is not cached.
+        """
+        values = self._pairs.get(key)
+        if values is None: self.misses += 1
+        else: self.hits += 1
+        return tuple(values) if values is not None else None
+
+    def put(self, key: str, values: tuple) -> None:
+        self._pairs[key] = [float(value) for value in values]
+        self._changed = True
+
+    def save(self) -> None:
+        """
+        @brief  Atomically writes the cache file if anything was added.
+        """
+        if not self._changed: return
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, "w") as stream:
+            json.dump({'files': self._files, 'pairs': self._pairs}, stream)
+        os.replace(temporary_path, self.path)
+        self._changed = False
+
+
+class Stitcher:
+    def __init__(self, feather: int = 64, registration_scale: float = 0.5,
+                 min_confidence: float = 0.5, max_correction: float = 0.25,
+                 px_per_mm: float = None, cache: RegistrationCache = None, shading=None) -> None:
+        """
+        @brief  Stitches the frames of a run into one panorama in two streaming passes. The first
+                registers each frame against the one before it, the second blends the frames into
+                the output left to right. At most two frames, plus the blend of the seam in
+                progress, are in memory at once.
+        @param feather              Width in pixels over which frames are blended at seams.
+        @param registration_scale   Downscaling applied to frames before registering them.
+        @param min_confidence       Registrations whose overlap matches worse than this (see
+                                    register_pair) fall back to the offset predicted by the
+                                    stage position.
+        @param max_correction       Largest correction to the predicted offset that is accepted,
+                                    as a fraction of the frame width.
+        @param px_per_mm            Magnification. If None, it is measured from the first pair.
+        @param cache                Registrations to reuse. Pairs found in it are not read or
+                                    registered again.
+        @param shading              Optional ShadingCorrection applied to every frame before it
+                                    is registered or blended (see shading.py).
+        """
+        self.feather = feather
+        self.registration_scale = registration_scale
+        self.min_confidence = min_confidence
+        self.max_correction = max_correction
+        self.px_per_mm = px_per_mm
+        self.cache = cache
+        self.shading = shading
+        self.pairs = []  # (dx, dy, confidence, used prior) of each registered pair
+        self.cached_pairs = 0  # Pairs of the last register call that came from the cache
+
+    def read(self, path: str) -> np.ndarray:
+        """
+        @brief  Reads a frame, shading corrected if the stitcher has a correction.
+        """
+        image = read_frame(path)
+        if image is None: raise IOError(f"Could not read {path}")
+        return image if self.shading is None else self.shading.apply(image)
+
+    def register(self, frames: list, positions_mm: list = None, progress=None) -> list:
+        """
+        @brief  Works out where every frame goes in the panorama.
+        @param frames       Frame paths in order.
+        @param positions_mm Stage position of each frame in mm. If None, the frames are assumed
+                            to be evenly spaced.
+        @param progress     Optional function called with (pairs done, pairs).
+        @return List of integer (x, y) offsets, one per frame.
+        """
+        if positions_mm is None: positions_mm = list(range(len(frames)))
+        self.pairs = []
+        self.cached_pairs = 0
+        offsets = [(0.0, 0.0)]
+        images = {}  # The frames of the pair being registered
+
+        def load(index: int) -> np.ndarray:
+            if index not in images:
+                images[index] = self.read(frames[index])
+                for old in [old for old in images if old < index - 1]: del images[old]
+            return images[index]
+
+        for i in range(1, len(frames)):
+            distance = positions_mm[i] - positions_mm[i - 1]
+            prior = self.px_per_mm * distance if self.px_per_mm is not None else None
+            key = None if self.cache is None else self.cache.key(
+                frames[i - 1], frames[i], prior, self.registration_scale,
+                None if self.shading is None else self.shading.fingerprint)
+            cached = None if key is None else self.cache.get(key)
+            if cached is not None:
+                dx, dy, confidence, width = cached
+                self.cached_pairs += 1
+            else:
+                dx, dy, confidence = register_pair(load(i - 1), load(i), prior, self.registration_scale)
+                width = load(i).shape[1]
+                if key is not None: self.cache.put(key, (dx, dy, confidence, width))
+            fallback = prior is not None and (
+                confidence < self.min_confidence or abs(dx - prior) > self.max_correction * width)
+            if fallback: dx, dy = prior, 0.0
+            if self.px_per_mm is None and distance != 0 and confidence >= self.min_confidence:
+                self.px_per_mm = dx / distance  # The first good pair calibrates the rest
+            self.pairs.append((dx, dy, confidence, fallback))
+            offsets.append((offsets[-1][0] + max(dx, 1.0), offsets[-1][1] + dy))
+            if progress is not None: progress(i, len(frames) - 1)
+        if self.cache is not None: self.cache.save()
+
+        min_y = min(y for _, y in offsets) if offsets else 0.0
+        return [(int(round(x)), int(round(y - min_y))) for x, y in offsets]
+
+    def _weights(self, width: int) -> np.ndarray:
+        """
+        @brief  Blend weight of each column of a frame: rising over the feather width from
+                either edge.
+        """
+        columns = np.arange(width, dtype=np.float32)
+        ramp = np.minimum(columns + 1, width - columns) / max(self.feather, 1)
+        return np.clip(ramp, 1e-3, 1.0)
+
+    def compose(self, frames: list, offsets: list, sink, progress=None) -> tuple:
+        """
+        @brief  Blends the frames into the sink, left to right. Columns are handed to the sink
+                as soon as no later frame can overlap them.
+        @param frames   Frame paths in order.
+        @param offsets  Offsets from register.
+        @param sink     Output with begin(width, height), write(x, strip) and close() methods.
+        @param progress Optional function called with (frames done, frames).
+        @return (width, height) of the panorama.
+        """
+        first = self.read(frames[0])
+        frame_height, frame_width = first.shape[:2]
+        width = max(x for x, _ in offsets) + frame_width
+        height = max(y for _, y in offsets) + frame_height
+        weights = self._weights(frame_width)
+        sink.begin(width, height)
+
+        done = 0  # Columns already handed to the sink
+        total = np.zeros((height, 0, 3), np.float32)
+        weight = np.zeros((height, 0), np.float32)
+        for i, path in enumerate(frames):
+            frame = first if i == 0 else self.read(path)
+            x, y = offsets[i]
+            end = x + frame_width - done
+            if end > total.shape[1]:
+                grow = end - total.shape[1]
+                total = np.concatenate((total, np.zeros((height, grow, 3), np.float32)), axis=1)
+                weight = np.concatenate((weight, np.zeros((height, grow), np.float32)), axis=1)
+            left = x - done
+            total[y:y + frame_height, left:left + frame_width] += frame * weights[None, :, None]
+            weight[y:y + frame_height, left:left + frame_width] += weights[None, :]
+            first = None
+
+            finished = (offsets[i + 1][0] if i + 1 < len(frames) else width) - done
+            if finished > 0:
+                covered = np.maximum(weight[:, :finished], 1e-6)[:, :, None]
+                strip = np.clip(total[:, :finished] / covered + 0.5, 0, 255).astype(np.uint8)
+                sink.write(done, strip)
+                total = total[:, finished:].copy()
+                weight = weight[:, finished:].copy()
+                done += finished
+            if progress is not None: progress(i + 1, len(frames))
+        return width, height
+
+    def stitch(self, frames: list, output: str, positions_mm: list = None, progress=None) -> dict:
+        """
+        @brief  Registers and composes frames into an output file.
+        @param frames       Frame paths in order.
+        @param output       Output path (.dzi, .npy, .tif, .png or .jpg), or a sink.
+        @param positions_mm Stage position of each frame, see register.
+        @param progress     Optional function called with (stage name, done, total).
+        @return Summary of the stitch.
+        """
+        started = time.time()
+        offsets = self.register(frames, positions_mm,
+                                (lambda done, total: progress('register', done, total)) if progress else None)
+        registered = time.time()
+        sink = make_sink(output) if isinstance(output, str) else output
+        try:
+            width, height = self.compose(frames, offsets, sink,
+                                         (lambda done, total: progress('compose', done, total)) if progress else None)
+        finally:
+            path = sink.close()
+        return {
+            'output': path,
+            'frames': len(frames),
+            'width': width,
+            'height': height,
+            'px_per_mm': self.px_per_mm,
+            'fallback_pairs': sum(1 for pair in self.pairs if pair[3]),
+            'cached_pairs': self.cached_pairs,
+            'register_s': round(registered - started, 2),
+            'compose_s': round(time.time() - registered, 2),
+        }
+
+
+class LivePanorama:
+    def __init__(self, scale: float = 0.125, feather: int = 16, min_confidence: float = 0.5,
+                 max_correction: float = 0.25, px_per_mm: float = None) -> None:
+        """
+        @brief  Low resolution panorama that is extended as each picture of a run is saved, so the
+                operator can see the core come together. Frames are handed over with add_frame and
+                placed by a background thread, so the capture never waits for it. Pairs that do
+                not overlap, or whose registration disagrees with the stage position, are marked
+                on the image (red for gaps, yellow for misregistration).
+        @param scale            Size of the panorama relative to the pictures.
+        @param feather          Width in (scaled) pixels over which frames are blended at seams.
+        @param min_confidence   See Stitcher.
+        @param max_correction   See Stitcher.
+        @param px_per_mm        Magnification of the full size pictures. If None, it is measured
+                                from the first pair and kept for later runs.
+        """
+        self.scale = scale
+        self.min_confidence = min_confidence
+        self.max_correction = max_correction
+        self.px_per_mm = px_per_mm
+        self._weights = Stitcher(feather)._weights
+        self._frames = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._generation = 0
+        self._version = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        @brief  Clears the panorama for a new run. Frames still waiting to be placed are dropped.
+        """
+        with self._lock:
+            while not self._frames.empty(): self._frames.get_nowait()
+            self._generation += 1
+            self._previous = None  # (frame, stage mm, x, y) of the last frame placed
+            self._total = None
+            self._weight = None
+            self._image = None
+            self._width = 0
+            self._problems = []  # (frame number, x, 'gap' or 'misregistered')
+            self._placed = 0
+            self._version += 1
+
+    def add_frame(self, path: str, stage_mm: float) -> None:
+        """
+        @brief  Queues a saved picture to be added to the panorama. Returns immediately.
+        @param path     Picture file.
+        @param stage_mm Stage position the picture was taken at.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._place_frames, daemon=True)
+            self._thread.start()
+        self._frames.put((self._generation, path, stage_mm))
+
+    def get_version(self) -> int:
+        """
+        @brief  Gets a number that changes whenever the panorama does, for cheap polling.
+        """
+        return self._version
+
+    def get_frame_count(self) -> int:
+        """
+        @brief  Gets how many frames have been placed since the last reset.
+        """
+        return self._placed
+
+    def get_problems(self) -> list:
+        """
+        @brief  Gets the seams found so far that need checking.
+        @return List of (frame number, 'gap' or 'misregistered') tuples.
+        """
+        with self._lock:
+            return [(number, kind) for number, _, kind in self._problems]
+
+    def get_image(self) -> np.ndarray:
+        """
+        @brief  Gets a copy of the panorama with the problem seams marked.
+        @return BGR image, or None before the first frame is placed.
+        """
+        with self._lock:
+            if self._image is None: return None
+            image = self._image[:, :self._width].copy()
+            problems = list(self._problems)
+        for _, x, kind in problems:
+            colour = (0, 0, 255) if kind == 'gap' else (0, 255, 255)
+            cv2.line(image, (x, 0), (x, image.shape[0] - 1), colour, 2)
+        return image
+
+    def _read(self, path: str) -> np.ndarray:
+        if self.scale in REDUCED_READS: return read_frame(path, REDUCED_READS[self.scale])
+        image = read_frame(path)
+        if image is None: return None
+        return cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def _place_frames(self) -> None:
+        while True:
+            generation, path, stage_mm = self._frames.get()
+            if generation != self._generation: continue
+            frame = self._read(path)
+            if frame is None:
+                print(f"Live panorama could not read {path}")
+                continue
+            try:
+                self._place(generation, frame, stage_mm)
+            except Exception as e:
+                print(f"Live panorama failed on {path}: {e}")
+
+    def _place(self, generation: int, frame: np.ndarray, stage_mm: float) -> None:
+        """
+        @brief  Registers a frame against the last one and blends it into the panorama.
+        """
+        height, width = frame.shape[:2]
+        problem = None
+        if self._previous is None:
+            x, y = 0.0, 0.0
+        else:
+            previous, previous_mm, previous_x, previous_y = self._previous
+            distance = stage_mm - previous_mm
+            prior = self.px_per_mm * self.scale * distance if self.px_per_mm is not None else None
+            if prior is not None and prior >= width:
+                dx, dy = prior, 0.0
+                problem = 'gap'
+            else:
+                dx, dy, confidence = register_pair(previous, frame, prior, 1.0)
+                if prior is not None and (confidence < self.min_confidence or
+                                          abs(dx - prior) > self.max_correction * width):
+                    dx, dy = prior, 0.0
+                    problem = 'misregistered'
+                elif self.px_per_mm is None and distance != 0 and confidence >= self.min_confidence:
+                    self.px_per_mm = dx / self.scale / distance
+            x = previous_x + max(dx, 1.0)
+            y = previous_y + dy
+        margin = height // 4  # Room for the core to drift up or down
+        y = min(max(y, -margin), margin)
+        left, top = int(round(x)), int(round(y)) + margin
+
+        with self._lock:
+            if generation != self._generation: return
+            if self._total is None or left + width > self._total.shape[1]:
+                columns = max(2 * (left + width), 4 * width)
+                total = np.zeros((height + 2 * margin, columns, 3), np.float32)
+                weight = np.zeros((height + 2 * margin, columns), np.float32)
+                image = np.zeros((height + 2 * margin, columns, 3), np.uint8)
+                if self._total is not None:
+                    total[:, :self._total.shape[1]] = self._total
+                    weight[:, :self._weight.shape[1]] = self._weight
+                    image[:, :self._image.shape[1]] = self._image
+                self._total, self._weight, self._image = total, weight, image
+            weights = self._weights(width)
+            region = (slice(top, top + height), slice(left, left + width))
+            self._total[region] += frame * weights[None, :, None]
+            self._weight[region] += weights[None, :]
+            covered = np.maximum(self._weight[:, left:left + width], 1e-6)[:, :, None]
+            self._image[:, left:left + width] = np.clip(
+                self._total[:, left:left + width] / covered + 0.5, 0, 255).astype(np.uint8)
+            self._width = max(self._width, left + width)
+            if problem is not None: self._problems.append((self._placed, left, problem))
+            self._previous = (frame, stage_mm, x, y)
+            self._placed += 1
+            self._version += 1
+
+
+def stitch_folder(folder: str, name: str = None, output: str = None, stitcher: Stitcher = None,
+                  progress=None, cache: bool = True, shading: bool = False) -> dict:
+    """
+    @brief  Stitches a capture folder. Stage positions come from the run's journal if it has one.
+    @param folder   Capture folder.
+    @param name     Image name, see find_frames.
+    @param output   Output path. Defaults to a Deep Zoom image, <folder>/<name>_panorama.dzi.
+    @param stitcher Stitcher with the settings to use.
+    @param progress See Stitcher.stitch.
+    @param cache    Reuse and keep registrations in <folder>/<name>_registration.json, unless the
+                    stitcher has a cache already.
+    @param shading  Correct the frames' shading with <folder>/<name>_shading.npy, estimated from
+                    the frames if there is none yet, unless the stitcher has a correction already.
+    @return Summary of the stitch.
+    """
+    frames = find_frames(folder, name)
+    if not frames: raise FileNotFoundError(f"No frames found in {folder}")
+    if name is None: name = os.path.basename(frames[0]).rsplit('_', 1)[0]
+    if output is None: output = os.path.join(folder, f"{name}_panorama.dzi")
+    positions = stage_positions(frames, os.path.join(folder, f"{name}_journal.jsonl"))
+    if stitcher is None: stitcher = Stitcher()
+    if cache and stitcher.cache is None:
+        stitcher.cache = RegistrationCache(os.path.join(folder, f"{name}_registration.json"))
+    if shading and stitcher.shading is None: stitcher.shading = ShadingCorrection.for_run(folder, name, frames)
+    return stitcher.stitch(frames, output, positions, progress)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stitch the frames of a captured core into one image.")
+    parser.add_argument('folder', help="Capture folder")
+    parser.add_argument('--name', default=None, help="Image name (default: the most common one)")
+    parser.add_argument('--output', default=None,
+                        help="Output file: .dzi for a Deep Zoom pyramid, .tif/.png/.jpg or .npy "
+                             "(default: <name>_panorama.dzi)")
+    parser.add_argument('--feather', type=int, default=64, help="Seam blend width in pixels")
+    parser.add_argument('--scale', type=float, default=0.5, help="Downscaling used for registration")
+    parser.add_argument('--px-per-mm', type=float, default=None,
+                        help="Magnification (default: measured from the first pair)")
+    parser.add_argument('--shading', action='store_true',
+                        help="Correct vignetting with <name>_shading.npy, estimated from the frames "
+                             "if there is none (see shading.py)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Register every pair again instead of reusing earlier registrations")
+    args = parser.parse_args()
+
+    def report(stage: str, done: int, total: int) -> None:
+        print(f"\r{stage} {done} / {total}", end='', flush=True)
+        if done == total: print()
+
+    summary = stitch_folder(args.folder, args.name, args.output,
+                            Stitcher(args.feather, args.scale, px_per_mm=args.px_per_mm), report,
+                            not args.no_cache, args.shading)
+    for key, value in summary.items():
+        print(f"{key:>16}: {value}")
+    sys.exit(0)
@@ -0,0 +1,89 @@
+import os
+import yaml
+import archive
+from archive import archive_folder, verify_archive, hash_file, ARCHIVE_MANIFEST_SUFFIX, PART_SUFFIX
+
+
+def make_core(root, name="core"):
+    folder = os.path.join(root, name)
+    os.makedirs(os.path.join(folder, "rings"))
+    for file_name, content in [("core_0000.tif", b"a" * 3000), ("core_0001.tif", b"b" * 5000),
+                               ("core_journal.jsonl", b'{"event": "start"}\n'),
+                               (os.path.join("rings", "core.pos"), b"1.0\n2.5\n")]:
+        with open(os.path.join(folder, file_name), "wb") as stream:
+            stream.write(content)
+    return folder
+
+
+def test_archive_folder_copies_and_verifies_every_file(tmp_path):
+    folder = make_core(str(tmp_path / "captures"))
+    with open(os.path.join(folder, "core_0002.tif" + PART_SUFFIX), "wb") as stream:
+        stream.write(b"unfinished")
+    manifest = archive_folder(folder, str(tmp_path / "archive"))
+    destination = str(tmp_path / "archive" / "core")
+
+    assert manifest['failed'] == []
+    assert [entry['file'] for entry in manifest['files']] == \
+        ["core_0000.tif", "core_0001.tif", "core_journal.jsonl", "rings/core.pos"]
+    for entry in manifest['files']:
+        target = os.path.join(destination, *entry['file'].split('/'))
+        assert entry['verified'] and entry['sha256'] == hash_file(target)
+        assert entry['bytes'] == os.path.getsize(target)
+    assert manifest['bytes'] == 3000 + 5000 + 19 + 8
+    assert not any(name.endswith(PART_SUFFIX) for name in os.listdir(destination))
+    with open(os.path.join(destination, "core" + ARCHIVE_MANIFEST_SUFFIX)) as stream:
+        assert yaml.safe_load(stream)['files'] == manifest['files']
+    assert verify_archive(destination) == []
+
+
+def test_archive_folder_copies_a_mismatched_file_again(tmp_path, monkeypatch):
+    folder = make_core(str(tmp_path / "captures"))
+    real_hash = archive.hash_file
+    attempts = []
+
+    def flaky_hash(path, *args, **kwargs):
+        if path.endswith("core_0001.tif" + PART_SUFFIX):
+            attempts.append(path)
+            if len(attempts) == 1: return "0" * 64  # The first copy reads back wrong
+        return real_hash(path, *args, **kwargs)
+
+    monkeypatch.setattr(archive, 'hash_file', flaky_hash)
+    manifest = archive_folder(folder, str(tmp_path / "archive"), retries=1)
+    assert len(attempts) == 2 and manifest['failed'] == []
+
+
+def test_archive_folder_reports_files_it_cannot_verify(tmp_path, monkeypatch):
+    folder = make_core(str(tmp_path / "captures"))
+    real_hash, real_copy = archive.hash_file, archive.copy_file
+
+    def bad_hash(path, *args, **kwargs):
+        if path.endswith("core_0001.tif" + PART_SUFFIX): return "0" * 64
+        return real_hash(path, *args, **kwargs)
+
+    def unreadable_copy(source, *args, **kwargs):
+        if source.endswith("core.pos"): raise OSError("Input/output error")
+        return real_copy(source, *args, **kwargs)
+
+    monkeypatch.setattr(archive, 'hash_file', bad_hash)
+    monkeypatch.setattr(archive, 'copy_file', unreadable_copy)
+    manifest = archive_folder(folder, str(tmp_path / "archive"), retries=2)
+    destination = str(tmp_path / "archive" / "core")
+
+    assert manifest['failed'] == ["core_0001.tif", "rings/core.pos"]
+    entries = {entry['file']: entry for entry in manifest['files']}
+    assert not entries["core_0001.tif"]['verified'] and entries["rings/core.pos"]['sha256'] is None
+    assert entries["core_0000.tif"]['verified']
+    for name in ("core_0001.tif", "core_0001.tif" + PART_SUFFIX):
+        assert not os.path.exists(os.path.join(destination, name))
+    assert not os.path.exists(os.path.join(destination, "rings", "core.pos" + PART_SUFFIX))
+
+
+def test_verify_archive_finds_corrupted_and_missing_files(tmp_path):
+    folder = make_core(str(tmp_path / "captures"))
+    archive_folder(folder, str(tmp_path / "archive"))
+    destination = str(tmp_path / "archive" / "core")
+    with open(os.path.join(destination, "core_0000.tif"), "r+b") as stream:
+        stream.seek(1000)
+        stream.write(b"x")
+    os.remove(os.path.join(destination, "rings", "core.pos"))
+    assert verify_archive(destination) == ["core_0000.tif", "rings/core.pos"]
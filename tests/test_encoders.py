@@ -0,0 +1,69 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from encoders import ENCODERS, ThreadedEncoder, write_tiff, make_encoder
+
+
+def still(height=67, width=93, noise=8.0):
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 200, width, dtype=np.float32)[None, :, None]
+    return np.clip(gradient + rng.normal(0, noise, (height, width, 3)), 0, 255).astype(np.uint8)
+
+
+def read_rgb(path):
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    assert image is not None, f"Could not read {path}"
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+@pytest.mark.parametrize('backend', sorted(ENCODERS))
+@pytest.mark.parametrize('fformat, settings', [('png', {'png_compression': 1}),
+                                               ('tif', {'tiff_compression': 'none'}),
+                                               ('tif', {'tiff_compression': 'deflate'}),
+                                               ('tif', {'tiff_compression': 'lzw'})])
+def test_lossless_round_trip(tmp_path, backend, fformat, settings):
+    encoder = ENCODERS[backend](**settings)
+    if not encoder.supports(fformat): pytest.skip(f"{backend} cannot write {settings} here")
+    path = os.path.join(str(tmp_path), f"still.{fformat}")
+    image = still()
+    encoder.write(path, image, fformat)
+    assert np.array_equal(read_rgb(path), image)
+
+
+@pytest.mark.parametrize('backend', sorted(ENCODERS))
+def test_jpeg_round_trip(tmp_path, backend):
+    path = os.path.join(str(tmp_path), "still.jpg")
+    image = still(noise=1.0)
+    ENCODERS[backend](jpeg_quality=95).write(path, image, 'jpeg')
+    assert np.abs(read_rgb(path).astype(int) - image).mean() < 4
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('rows_per_strip', [1, 16, 64, 1000])
+def test_write_tiff_round_trip(tmp_path, compress, rows_per_strip):
+    path = os.path.join(str(tmp_path), "still.tif")
+    image = still()
+    write_tiff(path, image, compress, workers=2, rows_per_strip=rows_per_strip)
+    assert np.array_equal(read_rgb(path), image)
+    from PIL import Image
+    with Image.open(path) as reader:
+        assert np.array_equal(np.asarray(reader), image)
+
+
+def test_threaded_encoder_writes_padded_rows(tmp_path):
+    path = os.path.join(str(tmp_path), "still.tif")
+    padded = still(40, 128)[:, :100]  # Rows longer than the image, as camera buffers can be
+    ThreadedEncoder(tiff_compression='deflate', threads=2).write(path, padded, 'tiff')
+    assert np.array_equal(read_rgb(path), padded)
+
+
+def test_make_encoder():
+    encoder = make_encoder({'backend': 'threaded', 'tiff_compression': 'deflate', 'threads': 2,
+                            'unknown': 1}, 'tif')
+    assert isinstance(encoder, ThreadedEncoder)
+    assert encoder.settings()['threads'] == 2 and encoder.tiff_compression == 'deflate'
+    assert make_encoder(None).name == 'qt'
+    assert make_encoder({'backend': 'nonsense'}).name == 'qt'
+    with pytest.raises(ValueError):
+        make_encoder({'backend': 'pillow', 'tiff_compression': 'jbig'})
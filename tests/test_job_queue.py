@@ -0,0 +1,43 @@
+import os
+import yaml
+from job_queue import CoreJob, JobQueue, PENDING, RUNNING, STOPPED, DONE, timing_summary, write_manifest
+from journal import captured_images
+
+
+def test_queue_is_saved_and_stopped_jobs_requeued(tmp_path):
+    path = os.path.join(str(tmp_path), "queue.yaml")
+    queue = JobQueue(path)
+    for core_id in ("a", "b", "c"):
+        queue.add(CoreJob(core_id, 1.0, 3.0, str(tmp_path)))
+    queue.mark(queue.jobs[0], RUNNING)
+    queue.mark(queue.jobs[0], DONE)
+    queue.mark(queue.jobs[1], STOPPED)
+
+    loaded = JobQueue(path)
+    assert [job.status for job in loaded.jobs] == [DONE, STOPPED, PENDING]
+    assert loaded.next_pending().core_id == "c"
+    assert loaded.requeue("a") == []
+    assert [job.core_id for job in loaded.requeue()] == ["b"]
+    assert [job.status for job in JobQueue(path).jobs] == [DONE, PENDING, PENDING]
+
+
+def test_manifest_of_a_resumed_run(tmp_path):
+    def captured(position, time):
+        return {'event': 'captured', 'time': time, 'position': position, 'index': position,
+                'file': f"b_{position:04d}.tif", 'stage_mm': position * 3.0}
+
+    entries = [{'event': 'start', 'time': 100.0, 'total': 3, 'first_index': 0},
+               captured(0, 101.0), captured(1, 102.0), captured(2, 103.0),
+               # Stopped, then resumed an hour later from position 2
+               {'event': 'resume', 'time': 3700.0, 'position': 2},
+               captured(2, 3701.0), captured(3, 3703.0)]
+    images = captured_images(entries)
+    assert timing_summary(images, 100.0, 3704.0)['max_position_s'] == 2.0
+
+    job = CoreJob("b", 1.0, 3.0, str(tmp_path), status=DONE)
+    with open(write_manifest(job, images, 100.0, 3704.0)) as stream:
+        manifest = yaml.safe_load(stream)
+    assert [image['file'] for image in manifest['images']] == [f"b_{i:04d}.tif" for i in range(4)]
+    assert manifest['images'][2]['time'] == 3601.0
+    assert manifest['timing']['images'] == 4
+    assert manifest['timing']['mean_position_s'] == 1.5
@@ -0,0 +1,87 @@
+import os
+from journal import CaptureJournal, read_journal, captured_images, resume_point, file_checksum
+
+
+def journal_path(folder):
+    return os.path.join(folder, "core_journal.jsonl")
+
+
+def start_run(folder, total=4, first_index=10):
+    journal = CaptureJournal(journal_path(folder), append=False)
+    journal.record('start', image_name='core', core_length=1.0, shift_length=3.0, total=total,
+                   first_index=first_index)
+    return journal
+
+
+def capture(journal, folder, position, content=None):
+    file_name = f"core_{position:04d}.tif"
+    path = os.path.join(folder, file_name)
+    with open(path, "wb") as stream:
+        stream.write(content if content is not None else bytes([position]) * 100)
+    journal.record('captured', position=position, index=10 + position, file=file_name,
+                   sha256=file_checksum(path), stage_position=position, stage_mm=position * 3.0)
+    journal.record('shifting', stage_position=position + 1)
+    return path
+
+
+def test_read_journal_ignores_a_cut_off_line(tmp_path):
+    journal = start_run(str(tmp_path))
+    capture(journal, str(tmp_path), 0)
+    journal.close()
+    path = journal_path(str(tmp_path))
+    with open(path, "a") as stream:
+        stream.write('{"event": "captured", "posi')
+    assert [entry['event'] for entry in read_journal(path)] == ['start', 'captured', 'shifting']
+    assert read_journal(os.path.join(str(tmp_path), "missing.jsonl")) == []
+
+
+def test_resume_point_continues_after_the_last_verified_image(tmp_path):
+    folder = str(tmp_path)
+    journal = start_run(folder)
+    for position in range(3):
+        capture(journal, folder, position)
+    journal.close()
+    point = resume_point(read_journal(journal_path(folder)), folder)
+    assert point['position'] == 3
+    assert point['index'] == 13
+    assert point['stage_position'] == 3
+    assert not point['finished']
+
+
+def test_resume_point_stops_at_a_changed_or_missing_image(tmp_path):
+    folder = str(tmp_path)
+    journal = start_run(folder)
+    paths = [capture(journal, folder, position) for position in range(4)]
+    journal.close()
+    with open(paths[2], "r+b") as stream:
+        stream.write(b'\xff')
+    assert resume_point(read_journal(journal_path(folder)), folder)['position'] == 2
+    os.remove(paths[1])
+    assert resume_point(read_journal(journal_path(folder)), folder)['position'] == 1
+
+
+def test_resume_point_of_a_finished_run(tmp_path):
+    folder = str(tmp_path)
+    journal = start_run(folder, total=2)
+    for position in range(3):
+        capture(journal, folder, position)
+    journal.record('finished')
+    journal.close()
+    assert resume_point(read_journal(journal_path(folder)), folder)['finished']
+    assert resume_point([], folder) is None
+
+
+def test_captured_images_over_resumed_sessions(tmp_path):
+    folder = str(tmp_path)
+    journal = start_run(folder)
+    for position in range(3):
+        capture(journal, folder, position)
+    # The image at position 2 did not survive, so the next session captures it again
+    journal.record('resume', position=2)
+    capture(journal, folder, 2, b'again')
+    capture(journal, folder, 3)
+    journal.close()
+    images = captured_images(read_journal(journal_path(folder)))
+    assert [image['position'] for image in images] == [0, 1, 2, 3]
+    assert [image['session'] for image in images] == [0, 0, 1, 1]
+    assert images[2]['sha256'] == file_checksum(os.path.join(folder, "core_0002.tif"))
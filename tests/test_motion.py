@@ -0,0 +1,51 @@
+import math
+import pytest
+from motion import MotionProfile
+
+
+def firmware_move_time(profile, steps):
+    """
+    Times a move the way Tree_Ring.ino runs it: step() loads OCR1A with the first step's
+    half_period_ticks(), and each Timer1 interrupt comes OCR1A + 1 ticks of 0.5 us after the last.
+    The falling edge of a step loads the next step's ticks.
+    """
+    ramp = 0
+    if profile.cruise_speed > profile.start_speed:
+        ramp = int((profile.cruise_speed ** 2 - profile.start_speed ** 2) / (2.0 * profile.acceleration))
+
+    def half_period_ticks(i):
+        n = min(min(i, steps - 1 - i), ramp)
+        return int(1000000.0 / math.sqrt(profile.start_speed ** 2 + 2.0 * profile.acceleration * n))
+
+    ocr, ticks, steps_done, high = half_period_ticks(0), 0, 0, False
+    while True:
+        ticks += ocr + 1
+        if not high:
+            high = True
+            continue
+        high = False
+        steps_done += 1
+        if steps_done >= steps: return ticks * 0.5e-6
+        ocr = half_period_ticks(steps_done)
+
+
+@pytest.mark.parametrize('steps', [1, 2, 100, 483, 4830])
+def test_ramped_move_time_matches_the_firmware(steps):
+    profile = MotionProfile(1000, 8000, 20000)
+    assert profile.move_time(steps) == pytest.approx(firmware_move_time(profile, steps), abs=1e-9)
+
+
+def test_cruise_move_time_matches_the_firmware():
+    profile = MotionProfile.constant(3333)
+    expected = firmware_move_time(profile, 1000)
+    assert profile.move_time(1000) == pytest.approx(expected, abs=1e-9)
+    # 1e6 / 3333 truncates to 300 ticks, and the timer takes one more
+    assert expected == pytest.approx(1000 * 2 * 301 * 0.5e-6)
+
+
+def test_position_at():
+    profile = MotionProfile()
+    total = profile.move_time(483)
+    assert profile.position_at(483, 0.0) == 0
+    assert profile.position_at(483, total / 2) == pytest.approx(241, abs=2)
+    assert profile.position_at(483, total + 1e-6) == 483
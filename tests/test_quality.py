@@ -0,0 +1,56 @@
+from quality import QualityChecker
+
+
+def summary(position, focus=100.0, mean=120.0, clipped_high=0.0, clipped_low=0.0):
+    return {'file': f"core_{position:04d}.tif", 'position': position, 'focus': focus, 'mean': mean,
+            'clipped_high': clipped_high, 'clipped_low': clipped_low}
+
+
+def run(checker, records):
+    for record in records: checker.check(record)
+    return {failure['position']: failure['reasons'] for failure in checker.take_failures()}
+
+
+def test_clean_run_passes():
+    checker = QualityChecker(last_position=9)
+    assert run(checker, [summary(i, focus=100 + i, mean=118 + i % 3) for i in range(10)]) == {}
+
+
+def test_blurred_and_badly_exposed_stills_fail():
+    records = [summary(i) for i in range(10)]
+    records[4] = summary(4, focus=30.0)
+    records[6] = summary(6, mean=60.0)
+    records[8] = summary(8, clipped_high=12.0)
+    assert run(QualityChecker(last_position=9), records) == {4: ['blurred'], 6: ['exposure'],
+                                                             8: ['overexposed']}
+
+
+def test_first_still_is_checked_once_its_neighbour_arrives():
+    checker = QualityChecker(last_position=5)
+    assert checker.check(summary(0, focus=10.0)) == []  # Nothing to compare with yet
+    checker.check(summary(1))
+    assert run(checker, []) == {0: ['blurred']}
+
+
+def test_still_alone_is_checked_against_fixed_levels():
+    checker = QualityChecker(min_focus=50.0)
+    assert checker.check(summary(0, focus=20.0, mean=250.0)) == ['blurred', 'exposure']
+
+
+def test_end_stills_are_compared_more_loosely():
+    # The ends of a core often show the end of the wood, a little darker or softer than the rest
+    records = [summary(0, focus=40.0, mean=85.0)] + [summary(i) for i in range(1, 9)] + \
+              [summary(9, focus=40.0, mean=160.0)]
+    assert run(QualityChecker(last_position=9), records) == {}
+    assert run(QualityChecker(last_position=12), records) == {9: ['blurred', 'exposure']}
+    # A still that is much worse is still retaken at the ends
+    records[0] = summary(0, focus=10.0)
+    assert run(QualityChecker(last_position=9), records) == {0: ['blurred']}
+
+
+def test_reset_forgets_stills():
+    checker = QualityChecker()
+    checker.check(summary(0))
+    checker.reset(last_position=3)
+    assert checker.last_position == 3
+    assert checker.check(summary(1, focus=10.0)) == []
@@ -0,0 +1,53 @@
+import os
+import numpy as np
+from ring_analysis import write_rwl, write_pos
+
+
+def read_rwl(path):
+    """
+    Parses a Tucson file the way dendro software does: fixed columns, 8 for the series, 4 for the
+    decade's first year, then up to ten 6-wide values.
+    """
+    series, values = None, {}
+    with open(path) as stream:
+        for line in stream.read().splitlines():
+            series = line[:8].strip()
+            year = int(line[8:12])
+            for i in range(12, len(line), 6):
+                values[year] = int(line[i:i + 6])
+                year += 1
+    return series, values
+
+
+def test_write_rwl_decades_and_stop_marker(tmp_path):
+    path = os.path.join(str(tmp_path), "core.rwl")
+    widths = np.linspace(0.5, 2.2, 18)  # 1995 to 2012
+    write_rwl(path, "core 1", widths, 2012)
+    with open(path) as stream:
+        lines = stream.read().splitlines()
+    assert [line[:12] for line in lines] == ["core_1  1995", "core_1  2000", "core_1  2010"]
+    assert [len(line) for line in lines] == [12 + 5 * 6, 12 + 10 * 6, 12 + 4 * 6]
+
+    series, values = read_rwl(path)
+    assert series == "core_1"
+    assert values.pop(2013) == 999
+    assert sorted(values) == list(range(1995, 2013))
+    assert [values[year] for year in sorted(values)] == list(np.round(widths / 0.01).astype(int))
+
+
+def test_write_rwl_thousandths(tmp_path):
+    path = os.path.join(str(tmp_path), "core.rwl")
+    write_rwl(path, "a_very_long_series_name", [1.2344, 0.0504, 2.0], 2020, precision=0.001)
+    series, values = read_rwl(path)
+    assert series == "a_very_l"
+    assert values == {2018: 1234, 2019: 50, 2020: 2000, 2021: -9999}
+
+
+def test_write_pos(tmp_path):
+    path = os.path.join(str(tmp_path), "core.pos")
+    write_pos(path, np.array([1.0, 2.5, 4.125]), 3.2, 2001, 2540.0, image="/data/core.tif")
+    with open(path) as stream:
+        lines = stream.read().splitlines()
+    assert "#Imagefile core.tif" in lines
+    assert "#C DATED 2001;" in lines
+    assert lines[-3:] == ["1.000,3.200", "2.500,3.200", "4.125,3.200"]
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+import pytest
+from session_container import (SessionContainer, CONTAINER_SUFFIX, register_container, read_frame,
+                               frame_exists, frame_checksum, frame_digest, container_frames)
+from journal import CaptureJournal, read_journal, resume_point, file_checksum
+
+SHAPE = (37, 51, 3)  # A frame that does not fill whole pages
+
+
+def frame(value):
+    return np.random.default_rng(value).integers(0, 256, SHAPE, dtype=np.uint8)
+
+
+def create(folder, max_frames=16):
+    path = os.path.join(folder, f"core{CONTAINER_SUFFIX}")
+    return SessionContainer.create(path, *SHAPE, max_frames=max_frames, image_name='core')
+
+
+def test_write_and_read(tmp_path):
+    container = create(str(tmp_path))
+    for i in range(3):
+        container.write(f"core_{i:04d}.tif", frame(i), stage_mm=i * 3.0)
+    container.close()
+
+    reader = SessionContainer(container.path)
+    assert len(reader) == 3
+    assert reader.names() == ["core_0000.tif", "core_0001.tif", "core_0002.tif"]
+    assert reader.record("core_0001.tif")['stage_mm'] == 3.0
+    assert reader.frame_stride % 4096 == 0 and reader.frame_stride >= reader.frame_bytes
+    assert reader.header['data_offset'] % 4096 == 0
+    for i in range(3):
+        assert np.array_equal(reader.frame(f"core_{i:04d}.tif"), frame(i))
+        assert reader.checksum(f"core_{i:04d}.tif") == reader.record(f"core_{i:04d}.tif")['sha256']
+    # Frames are mapped, not copied
+    assert not reader.frame("core_0000.tif").flags['OWNDATA']
+    reader.close()
+
+
+def test_reader_sees_appended_frames(tmp_path):
+    container = create(str(tmp_path))
+    container.write("core_0000.tif", frame(0))
+    reader = SessionContainer(container.path)
+    container.write("core_0001.tif", frame(1))
+    assert "core_0001.tif" not in reader
+    reader.refresh()
+    assert np.array_equal(reader.frame("core_0001.tif"), frame(1))
+    reader.close()
+    container.close()
+
+
+def test_replaced_frame_goes_to_a_new_slot(tmp_path):
+    container = create(str(tmp_path))
+    container.write("core_0000.tif", frame(0))
+    container.write("core_0001.tif", frame(1))
+    container.write("core_0000.tif", frame(2))  # Retaken
+    assert len(container) == 2
+    assert container.names() == ["core_0001.tif", "core_0000.tif"]
+    assert container.record("core_0000.tif")['slot'] == 2
+    assert np.array_equal(container.frame("core_0000.tif"), frame(2))
+    assert np.array_equal(container.frames()[0], frame(0))  # The old version is untouched
+    container.annotate("core_0000.tif", journaled=True)
+    assert container.record("core_0000.tif")['slot'] == 2
+    container.close()
+
+    reader = SessionContainer(container.path)
+    assert reader.record("core_0000.tif")['journaled']
+    assert np.array_equal(reader.frame("core_0000.tif"), frame(2))
+    reader.close()
+
+
+def test_full_container_and_wrong_shape(tmp_path):
+    container = create(str(tmp_path), max_frames=2)
+    with pytest.raises(ValueError):
+        container.write("core_0000.tif", np.zeros((4, 4, 3), np.uint8))
+    container.write("core_0000.tif", frame(0))
+    container.write("core_0001.tif", frame(1))
+    with pytest.raises(IOError):
+        container.write("core_0002.tif", frame(2))
+    container.close()
+
+
+def test_frames_are_found_by_their_paths(tmp_path):
+    folder = str(tmp_path)
+    container = create(folder)
+    register_container(container)
+    container.write("core_0000.tif", frame(0))
+    path = os.path.join(folder, "core_0000.tif")
+    assert frame_exists(path)
+    assert not frame_exists(os.path.join(folder, "core_0001.tif"))
+    assert np.array_equal(read_frame(path), frame(0))
+    assert read_frame(path, 0).shape == SHAPE[:2]  # cv2.IMREAD_GRAYSCALE
+    assert frame_checksum(path) == frame_digest(path) == file_checksum(path)
+    assert container_frames(folder) == [path]
+    container.close()
+
+
+def test_resume_stops_at_a_corrupted_frame(tmp_path):
+    folder = str(tmp_path)
+    container = create(folder)
+    register_container(container)
+    journal = CaptureJournal(os.path.join(folder, "core_journal.jsonl"), append=False)
+    journal.record('start', image_name='core', total=5, first_index=0)
+    for position in range(5):
+        name = f"core_{position:04d}.tif"
+        container.write(name, frame(position))
+        journal.record('captured', position=position, index=position, file=name,
+                       sha256=file_checksum(os.path.join(folder, name)))
+    journal.close()
+    entries = read_journal(os.path.join(folder, "core_journal.jsonl"))
+    assert resume_point(entries, folder)['position'] == 5
+
+    offset = container.header['data_offset'] + container.record("core_0003.tif")['slot'] * container.frame_stride
+    with open(container.path, "r+b") as stream:
+        stream.seek(offset + 100)
+        stream.write(b'\x01\x02\x03')
+    assert frame_checksum(os.path.join(folder, "core_0003.tif")) == container.record("core_0003.tif")['sha256']
+    assert resume_point(entries, folder)['position'] == 3
+    container.close()
+
+
+def test_record_cut_off_by_a_crash_ends_the_table(tmp_path):
+    container = create(str(tmp_path))
+    container.write("core_0000.tif", frame(0))
+    container.write("core_0001.tif", frame(1))
+    container.close()
+    with open(container.path, "r+b") as stream:
+        stream.seek(4096 + 512 + 20)  # Into the second record
+        stream.write(b'\x00' * 492)
+    reader = SessionContainer(container.path)
+    assert reader.names() == ["core_0000.tif"]
+    assert np.array_equal(reader.frame("core_0000.tif"), frame(0))
+    reader.close()
@@ -0,0 +1,104 @@
+import os
+import cv2
+import numpy as np
+from simulation import SyntheticCore
+from shading import estimate_profile, profile_path, save_profile, ShadingCorrection
+from batch_process import fingerprint
+
+WIDTH, HEIGHT = 320, 240
+
+
+def falloff(width=WIDTH, height=HEIGHT, vertical=False):
+    x = (np.arange(width, dtype=np.float32) - width / 2) / (width / 2)
+    y = (np.arange(height, dtype=np.float32) - height / 2) / (height / 2)
+    shading = 1.0 - 0.3 * x[None, :] ** 2 - (0.2 * y[:, None] ** 2 if vertical else 0.0)
+    return np.broadcast_to(shading, (height, width)).astype(np.float32)
+
+
+def shade(image, shading):
+    return np.clip(image * shading[:, :, None] + 0.5, 0, 255).astype(np.uint8)
+
+
+def capture_run(folder, shading, count=8, name="core"):
+    core = SyntheticCore(length_mm=100.0, seed=5)
+    frames = []
+    for i in range(count):
+        path = os.path.join(folder, f"{name}_{i:04d}.png")
+        cv2.imwrite(path, shade(core.render(10.0 + 4.0 * i, WIDTH, HEIGHT, 50.0), shading))
+        frames.append(path)
+    return core, frames
+
+
+def relative(profile, shading):
+    gain = cv2.resize(profile, (WIDTH, HEIGHT), interpolation=cv2.INTER_LINEAR).mean(axis=2)
+    return gain / gain.mean(), shading / shading.mean()
+
+
+def test_estimate_profile_recovers_the_shading_along_the_rows(tmp_path):
+    shading = falloff()
+    _, frames = capture_run(str(tmp_path), shading)
+    profile = estimate_profile(frames)
+    assert profile.dtype == np.float32 and profile.shape == (30, 40, 3)
+    assert np.allclose(profile.mean(axis=(0, 1)), 1.0, atol=1e-3)
+    estimated, expected = relative(profile, shading)
+    columns = slice(WIDTH // 10, WIDTH - WIDTH // 10)  # The blur flattens the falloff at the edges
+    assert np.abs(estimated[:, columns] - expected[:, columns]).max() < 0.05
+
+
+def test_estimate_profile_of_blank_captures_keeps_the_full_shading(tmp_path):
+    shading = falloff(vertical=True)
+    frames = []
+    for i in range(3):
+        path = os.path.join(str(tmp_path), f"blank_{i:04d}.png")
+        cv2.imwrite(path, shade(np.full((HEIGHT, WIDTH, 3), 180.0 + i, np.float32), shading))
+        frames.append(path)
+    estimated, expected = relative(estimate_profile(frames, from_run=False), shading)
+    inner = (slice(HEIGHT // 10, HEIGHT - HEIGHT // 10), slice(WIDTH // 10, WIDTH - WIDTH // 10))
+    assert np.abs(estimated[inner] - expected[inner]).max() < 0.05
+    try:
+        estimate_profile(frames[:2])
+        assert False, "Two frames are too few to estimate from"
+    except ValueError:
+        pass
+
+
+def test_apply_flattens_the_shading(tmp_path):
+    shading = falloff()
+    core, frames = capture_run(str(tmp_path), shading)
+    correction = ShadingCorrection(estimate_profile(frames))
+    truth = core.render(30.0, WIDTH, HEIGHT, 50.0)
+    shaded = shade(truth, shading)
+    corrected = correction.apply(shaded)
+    assert corrected.dtype == np.uint8 and corrected.shape == shaded.shape
+    edges = np.s_[:, list(range(20, 40)) + list(range(WIDTH - 40, WIDTH - 20))]
+    centre = np.s_[:, WIDTH // 2 - 10:WIDTH // 2 + 10]
+    ratio = lambda image: image[edges].mean() / image[centre].mean()
+    assert abs(ratio(corrected) - ratio(truth)) < 0.25 * abs(ratio(shaded) - ratio(truth))
+    assert correction.apply(cv2.cvtColor(shaded, cv2.COLOR_BGR2GRAY)).shape == (HEIGHT, WIDTH)
+
+
+def test_for_run_estimates_once_and_reuses_the_saved_profile(tmp_path):
+    folder = str(tmp_path)
+    _, frames = capture_run(folder, falloff())
+    first = ShadingCorrection.for_run(folder, "core", frames)
+    assert os.path.exists(profile_path(folder, "core"))
+    again = ShadingCorrection.for_run(folder, "core")
+    assert again.fingerprint == first.fingerprint
+    assert np.array_equal(again.profile, first.profile)
+
+
+def test_batch_fingerprint_follows_the_shading_profile(tmp_path):
+    folder = str(tmp_path)
+    _, frames = capture_run(folder, falloff())
+    shaded_settings = {'feather': 64, 'shading': True}
+    before = fingerprint(folder, "core", 'stitch', shaded_settings, checksum=True)
+    ShadingCorrection.for_run(folder, "core", frames)
+    with_profile = fingerprint(folder, "core", 'stitch', shaded_settings, checksum=True)
+    assert with_profile != before
+
+    save_profile(profile_path(folder, "core"), estimate_profile(frames, from_run=False))
+    assert fingerprint(folder, "core", 'stitch', shaded_settings, checksum=True) != with_profile
+    plain = {'feather': 64, 'shading': False}
+    unshaded = fingerprint(folder, "core", 'stitch', plain, checksum=True)
+    save_profile(profile_path(folder, "core"), np.ones((30, 40, 3), np.float32))
+    assert fingerprint(folder, "core", 'stitch', plain, checksum=True) == unshaded
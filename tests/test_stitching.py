@@ -0,0 +1,153 @@
+import os
+import cv2
+import numpy as np
+from simulation import SyntheticCore
+from shading import ShadingCorrection
+from stitching import register_pair, DziSink, read_dzi_region, RegistrationCache, Stitcher
+
+PX_PER_MM = 50.0
+WIDTH, HEIGHT = 320, 120
+
+
+def render_run(folder, count=5, step_mm=3.0, start_mm=20.0, core=None):
+    core = core or SyntheticCore(length_mm=100.0, seed=3)
+    frames = []
+    for i in range(count):
+        path = os.path.join(folder, f"core_{i:04d}.png")
+        cv2.imwrite(path, core.render(start_mm + i * step_mm, WIDTH, HEIGHT, PX_PER_MM))
+        frames.append(path)
+    return core, frames
+
+
+def test_register_pair_measures_the_known_shift():
+    core = SyntheticCore(length_mm=100.0, seed=3)
+    a = core.render(20.0, WIDTH, HEIGHT, PX_PER_MM)
+    b = core.render(23.0, WIDTH, HEIGHT, PX_PER_MM)
+    for prior in (None, 140.0):
+        dx, dy, confidence = register_pair(a, b, prior)
+        assert abs(dx - 150.0) <= 2.0 and abs(dy) <= 2.0
+        assert confidence > 0.9
+
+
+def test_register_finds_the_offsets_and_magnification(tmp_path):
+    _, frames = render_run(str(tmp_path))
+    stitcher = Stitcher()
+    offsets = stitcher.register(frames, positions_mm=[3.0 * i for i in range(len(frames))])
+    for i, (x, y) in enumerate(offsets):
+        assert abs(x - 150 * i) <= 2 * i + 1 and y <= 2
+    assert abs(stitcher.px_per_mm - PX_PER_MM) < 1.0
+    assert not any(pair[3] for pair in stitcher.pairs)
+
+
+def test_register_falls_back_to_the_stage_position_for_a_blank_frame(tmp_path):
+    _, frames = render_run(str(tmp_path))
+    cv2.imwrite(frames[3], np.full((HEIGHT, WIDTH, 3), 128, np.uint8))
+    stitcher = Stitcher(px_per_mm=PX_PER_MM)
+    offsets = stitcher.register(frames, positions_mm=[3.0 * i for i in range(len(frames))])
+    assert [pair[3] for pair in stitcher.pairs] == [False, False, True, True]
+    assert offsets[4][0] - offsets[2][0] == 300
+
+
+def test_stitch_reproduces_the_core(tmp_path):
+    core, frames = render_run(str(tmp_path))
+    output = os.path.join(str(tmp_path), "panorama.npy")
+    summary = Stitcher(px_per_mm=PX_PER_MM).stitch(frames, output, [3.0 * i for i in range(len(frames))])
+    panorama = np.load(output)
+    assert (summary['width'], summary['height']) == (4 * 150 + WIDTH, HEIGHT)
+    assert panorama.shape == (HEIGHT, 4 * 150 + WIDTH, 3)
+    truth = core.render(20.0, panorama.shape[1], HEIGHT, PX_PER_MM)
+    difference = np.abs(panorama.astype(int) - truth.astype(int))
+    assert np.percentile(difference, 99) <= 2
+
+
+def write_dzi(path, image, tile_size=64, strip_width=37):
+    sink = DziSink(path, tile_size=tile_size, tile_format='png', workers=2)
+    sink.begin(image.shape[1], image.shape[0])
+    for x in range(0, image.shape[1], strip_width):
+        sink.write(x, image[:, x:x + strip_width])
+    return sink.close()
+
+
+def test_dzi_sink_writes_every_level_of_tiles(tmp_path):
+    core = SyntheticCore(length_mm=100.0, seed=3)
+    image = core.render(20.0, 920, HEIGHT, PX_PER_MM)
+    path = write_dzi(os.path.join(str(tmp_path), "panorama.dzi"), image)
+    with open(path) as stream: descriptor = stream.read()
+    assert 'TileSize="64"' in descriptor and 'Overlap="1"' in descriptor and 'Format="png"' in descriptor
+    assert '<Size Width="920" Height="120"/>' in descriptor
+
+    tiles_dir = os.path.join(str(tmp_path), "panorama_files")
+    assert sorted(int(level) for level in os.listdir(tiles_dir)) == list(range(11))  # 2 ** 10 >= 920
+    assert sorted(os.listdir(os.path.join(tiles_dir, "0"))) == ["0_0.png"]
+    assert len(os.listdir(os.path.join(tiles_dir, "10"))) == 15 * 2
+    assert cv2.imread(os.path.join(tiles_dir, "10", "0_0.png")).shape == (65, 65, 3)
+    assert cv2.imread(os.path.join(tiles_dir, "10", "1_1.png")).shape == (57, 66, 3)
+    assert cv2.imread(os.path.join(tiles_dir, "10", "14_0.png")).shape == (65, 25, 3)
+    assert cv2.imread(os.path.join(tiles_dir, "9", "0_0.png")).shape == (60, 65, 3)
+
+
+def test_read_dzi_region_matches_the_panorama(tmp_path):
+    core = SyntheticCore(length_mm=100.0, seed=3)
+    image = core.render(20.0, 920, HEIGHT, PX_PER_MM)
+    path = write_dzi(os.path.join(str(tmp_path), "panorama.dzi"), image)
+    assert np.array_equal(read_dzi_region(path, 0, 0, 920, HEIGHT), image)
+    assert np.array_equal(read_dzi_region(path, 100, 30, 200, 50), image[30:80, 100:300])
+    assert np.array_equal(read_dzi_region(path, 900, 100, 64, 64), image[100:, 900:])
+
+    half = read_dzi_region(path, 0, 0, 460, 60, level=9)
+    expected = cv2.resize(image, (460, 60), interpolation=cv2.INTER_AREA)
+    assert np.abs(half.astype(int) - expected.astype(int)).max() <= 1
+
+
+def test_stitch_to_dzi_matches_the_npy_panorama(tmp_path):
+    _, frames = render_run(str(tmp_path))
+    positions = [3.0 * i for i in range(len(frames))]
+    npy = os.path.join(str(tmp_path), "panorama.npy")
+    Stitcher(px_per_mm=PX_PER_MM).stitch(frames, npy, positions)
+    dzi = os.path.join(str(tmp_path), "panorama.dzi")
+    Stitcher(px_per_mm=PX_PER_MM).stitch(frames, DziSink(dzi, tile_format='png'), positions)
+    panorama = np.load(npy)
+    assert np.array_equal(read_dzi_region(dzi, 0, 0, panorama.shape[1], HEIGHT), panorama)
+
+
+def register_cached(folder, frames, **settings):
+    cache = RegistrationCache(os.path.join(folder, "core_registration.json"))
+    stitcher = Stitcher(cache=cache, **settings)
+    offsets = stitcher.register(frames, positions_mm=[3.0 * i for i in range(len(frames))])
+    return stitcher, offsets
+
+
+def test_registration_cache_reuses_unchanged_pairs(tmp_path):
+    folder = str(tmp_path)
+    _, frames = render_run(folder)
+    first, offsets = register_cached(folder, frames)
+    assert first.cached_pairs == 0
+    assert os.path.exists(os.path.join(folder, "core_registration.json"))
+
+    again, cached_offsets = register_cached(folder, frames)
+    assert again.cached_pairs == 4 and again.cache.misses == 0
+    assert cached_offsets == offsets
+
+
+def test_registration_cache_misses_a_replaced_frame(tmp_path):
+    folder = str(tmp_path)
+    core, frames = render_run(folder)
+    register_cached(folder, frames)
+    cv2.imwrite(frames[2], core.render(26.5, WIDTH, HEIGHT, PX_PER_MM))  # Retaken 0.5 mm further on
+    stitcher, offsets = register_cached(folder, frames)
+    assert stitcher.cached_pairs == 2 and stitcher.cache.misses == 2
+    assert abs(offsets[2][0] - 325) <= 3 and abs(offsets[3][0] - 450) <= 4
+
+
+def test_registration_cache_misses_changed_parameters(tmp_path):
+    folder = str(tmp_path)
+    _, frames = render_run(folder)
+    register_cached(folder, frames)
+    assert register_cached(folder, frames, registration_scale=0.25)[0].cached_pairs == 0
+    assert register_cached(folder, frames, px_per_mm=PX_PER_MM)[0].cached_pairs == 0
+
+    vignette = np.ones((15, 40, 3), np.float32)
+    vignette[:, :10] = 0.9
+    shading = ShadingCorrection(vignette / vignette.mean())
+    assert register_cached(folder, frames, shading=shading)[0].cached_pairs == 0
+    assert register_cached(folder, frames, shading=shading)[0].cached_pairs == 4
@@ -0,0 +1,158 @@
+import os, json, queue, struct, threading
+import cv2
+import numpy as np
+from session_container import read_frame
+
+THUMBNAIL_WIDTH = 256
+_RECORD_HEADER = struct.Struct('<II')  # Lengths of the JSON summary and of the JPEG that follow
+
+
+def summarize(image: np.ndarray) -> dict:
+    """
+    @brief  Measures what a reviewer checks a still for.
+    @param image    BGR image.
+    @return Dictionary with the 'mean' grey level (0~255), the percentage of pixels 'clipped_high'
+            (saturated) and 'clipped_low' (black), and the 'focus' score: the variance of the
+            Laplacian, which drops as the image blurs.
+    """
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    histogram = cv2.calcHist([grey], [0], None, [256], [0, 256]).ravel()
+    pixels = float(grey.size)
+    _, deviation = cv2.meanStdDev(cv2.Laplacian(grey, cv2.CV_32F))
+    return {
+        'mean': round(float(np.dot(histogram, np.arange(256)) / pixels), 2),
+        'clipped_high': round(100.0 * float(histogram[-1]) / pixels, 3),
+        'clipped_low': round(100.0 * float(histogram[0]) / pixels, 3),
+        'focus': round(float(deviation[0, 0]) ** 2, 2),
+    }
+
+
+def make_thumbnail(image: np.ndarray, width: int = THUMBNAIL_WIDTH, quality: int = 80) -> bytes:
+    """
+    @brief  Shrinks an image and encodes it as a JPEG.
+    @return JPEG bytes.
+    """
+    scale = width / image.shape[1]
+    small = cv2.resize(image, (width, max(int(round(image.shape[0] * scale)), 1)),
+                       interpolation=cv2.INTER_AREA)
+    return cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def append_record(path: str, record: dict, thumbnail: bytes) -> None:
+    """
+    @brief  Appends a still's summary and thumbnail to a thumbnail pack. The pack is a single
+            append-only file, so a crash loses at most the record being written.
+    @param path         Pack file, e.g. <name>_thumbnails.pack.
+    @param record       Summary of the still.
+    @param thumbnail    JPEG thumbnail.
+    """
+    summary = json.dumps(record).encode()
+    with open(path, 'ab') as stream:
+        stream.write(_RECORD_HEADER.pack(len(summary), len(thumbnail)) + summary + thumbnail)
+        stream.flush()
+
+
+def read_pack(path: str) -> list:
+    """
+    @brief  Reads a thumbnail pack, ignoring a record that was cut off by a crash.
+    @param path Pack file.
+    @return List of (record, JPEG bytes) tuples in the order they were written. A still that was
+            replaced later (e.g. retaken) appears again further on.
+    """
+    records = []
+    try:
+        with open(path, 'rb') as stream:
+            data = stream.read()
+    except OSError:
+        return records
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        summary_length, thumbnail_length = _RECORD_HEADER.unpack_from(data, offset)
+        start = offset + _RECORD_HEADER.size
+        end = start + summary_length + thumbnail_length
+        if end > len(data): break
+        try:
+            record = json.loads(data[start:start + summary_length])
+        except ValueError:
+            break
+        records.append((record, data[start + summary_length:end]))
+        offset = end
+    return records
+
+
+def latest_records(records: list) -> list:
+    """
+    @brief  Keeps only the newest record of each file, in image order.
+    @param records  Records from read_pack.
+    @return List of (record, JPEG bytes) tuples.
+    """
+    latest = {}
+    for record, thumbnail in records: latest[record['file']] = (record, thumbnail)
+    return sorted(latest.values(), key=lambda entry: entry[0].get('index', 0))
+
+
+class ThumbnailWriter:
+    def __init__(self, workers: int = 2) -> None:
+        """
+        @brief  Summarizes each saved still and adds it to the session's thumbnail pack on a pool
+                of background threads, so the capture never waits for it. OpenCV releases the
+                interpreter while it decodes and filters, so the workers run in parallel.
+        @param workers  Number of worker threads.
+        """
+        self._frames = queue.Queue()
+        self._workers = workers
+        self._threads = []
+        self._pack_lock = threading.Lock()
+        self._path = None
+        self.listeners = []  # Called with each record once it is in the pack, from a worker
+
+    def open(self, path: str, append: bool = True) -> None:
+        """
+        @brief  Starts writing to a pack.
+        @param path     Pack file.
+        @param append   If False, any previous pack at path is replaced.
+        """
+        self._frames.join()  # Stills of the previous session go to its own pack
+        if not append and os.path.exists(path): os.remove(path)
+        self._path = path
+
+    def add(self, path: str, index: int, stage_mm: float = None, position: int = None) -> None:
+        """
+        @brief  Queues a saved still to be summarized. Returns immediately.
+        @param path     Still file.
+        @param index    Image number.
+        @param stage_mm Stage position the still was taken at.
+        @param position Position in the run.
+        """
+        if self._path is None: return
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self._workers:
+            self._threads.append(threading.Thread(target=self._write_records, daemon=True))
+            self._threads[-1].start()
+        self._frames.put((self._path, path, index, stage_mm, position))
+
+    def wait(self) -> None:
+        """
+        @brief  Blocks until every queued still is in the pack.
+        """
+        self._frames.join()
+
+    def _write_records(self) -> None:
+        while True:
+            pack, path, index, stage_mm, position = self._frames.get()
+            try:
+                image = read_frame(path)
+                if image is None:
+                    print(f"Could not read {path} for its thumbnail")
+                    continue
+                record = {'file': os.path.basename(path), 'index': index, 'stage_mm': stage_mm,
+                          'width': image.shape[1], 'height': image.shape[0]}
+                if position is not None: record['position'] = position
+                record.update(summarize(image))
+                thumbnail = make_thumbnail(image)
+                with self._pack_lock: append_record(pack, record, thumbnail)
+                for listener in self.listeners: listener(record)
+            except Exception as e:
+                print(f"Thumbnail of {path} failed: {e}")
+            finally:
+                self._frames.task_done()